@@ -0,0 +1,327 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_aio -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+asyncio API for CouchDB.
+
+Needs Twisted to run on the asyncio reactor, installed before anything
+imports the reactor::
+
+    from twisted.internet import asyncioreactor
+    asyncioreactor.install()
+"""
+
+from collections import deque
+from urllib.parse import urlencode
+
+from twisted.internet import defer
+
+from paisley.changes import ChangeReceiver
+from paisley.client import CouchDB, _namequote
+
+# methods of CouchDB that are mirrored as coroutines
+METHODS = [
+    'createDB', 'deleteDB', 'cleanDB', 'compactDB', 'compactDesignDB',
+    'listDB', 'getVersion', 'warmup', 'infoDB', 'listDoc', 'openDoc',
+    'openDocs', 'addAttachments', 'saveDoc', 'deleteDoc', 'saveDocs',
+    'deleteDocs', 'putAttachment', 'getAttachment', 'openView', 'addViews',
+    'tempView', 'map', 'mapped',
+]
+
+
+def _coroutine(name):
+
+    async def method(self, *args, **kwargs):
+        result = getattr(self.couch, name)(*args, **kwargs)
+        if isinstance(result, defer.Deferred):
+            result = await self._future(result)
+        return result
+
+    method.__name__ = name
+    method.__doc__ = "Awaitable L{CouchDB.%s}." % (name, )
+    return method
+
+
+class _Stream(object):
+    """
+    I hand out items received by Twisted to an asyncio consumer.
+
+    L{push} returns a deferred when C{highWater} items are waiting, firing
+    once the consumer has taken them down to C{lowWater}; the receiving
+    protocol pauses until then.
+    """
+
+    def __init__(self, loop, highWater):
+        self._loop = loop
+        self._items = deque()
+        self._highWater = highWater
+        self._lowWater = highWater // 2
+        self._drained = None
+        self._waiter = None
+        self._done = False
+        self._error = None
+
+    def push(self, item):
+        self._items.append(item)
+        self._wake()
+        if len(self._items) >= self._highWater:
+            if self._drained is None:
+                self._drained = defer.Deferred()
+            return self._drained
+        return None
+
+    def finish(self, error=None):
+        self._done = True
+        self._error = error
+        self._wake()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+        self._waiter = None
+
+    async def next(self):
+        while not self._items:
+            if self._done:
+                if self._error is not None:
+                    raise self._error
+                raise StopAsyncIteration
+            self._waiter = self._loop.create_future()
+            await self._waiter
+
+        item = self._items.popleft()
+        if self._drained is not None and len(self._items) <= self._lowWater:
+            d, self._drained = self._drained, None
+            d.callback(None)
+        return item
+
+
+class _Feed(object):
+    """
+    An async iterator over the rows or changes of a streamed response.
+
+    The request is done when iterating starts.  Closing the iterator with
+    L{aclose} stops the response.
+    """
+
+    def __init__(self, client, start, highWater):
+        self._client = client
+        self._start = start
+        self._highWater = highWater
+        self._stream = None
+        self._request = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._stream is None:
+            self._stream = _Stream(self._client.loop, self._highWater)
+            try:
+                self._request = await self._start(self._stream)
+            except BaseException as e:
+                # later calls raise the same error instead of waiting
+                self._stream.finish(e)
+                raise
+            self._request.addCallbacks(self._done, self._failed)
+        return await self._stream.next()
+
+    def _done(self, result):
+        self._stream.finish()
+        return result
+
+    def _failed(self, failure):
+        self._stream.finish(failure.value)
+
+    async def aclose(self):
+        """
+        Stop receiving.
+        """
+        if self._request is not None and not self._request.called:
+            self._request.cancel()
+        if self._stream is not None:
+            self._stream.finish()
+
+
+class ViewFeed(_Feed):
+    """
+    An async iterator over the rows of a view.
+
+    @ivar header: the members of the response other than rows, once
+                  iterating is done.
+    @type header: C{dict}
+    """
+    header = None
+
+    def _done(self, header):
+        self.header = header
+        return _Feed._done(self, header)
+
+
+class AsyncCouchDB(object):
+    """
+    I mirror the methods of L{CouchDB} as coroutines, for use with asyncio.
+
+    Deferreds are bridged to futures of the event loop the reactor runs on;
+    cancelling a future cancels the request.  Rows of views and changes can
+    be iterated as they arrive with L{iterView}, L{iterDocs} and
+    L{iterChanges}.
+
+    @ivar couch: the client doing the requests.
+    @type couch: L{CouchDB}
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Takes the same arguments as L{CouchDB}, and:
+
+        @param couch: an existing client to use instead.
+        @type  couch: L{CouchDB}
+        @param loop:  the event loop; defaults to the one of the reactor.
+        @type  loop:  L{asyncio.AbstractEventLoop}
+        """
+        couch = kwargs.pop('couch', None)
+        loop = kwargs.pop('loop', None)
+        if couch is None:
+            couch = CouchDB(*args, **kwargs)
+        self.couch = couch
+
+        if loop is None:
+            from twisted.internet import reactor
+            loop = getattr(reactor, '_asyncioEventloop', None)
+            assert loop is not None, \
+                "AsyncCouchDB needs the asyncio reactor to be installed."
+        self.loop = loop
+
+    def _future(self, d):
+        """
+        Return a future of our loop firing with the result of C{d}.
+        """
+        future = self.loop.create_future()
+
+        def cb(result):
+            if not future.done():
+                future.set_result(result)
+
+        def eb(failure):
+            if not future.done():
+                future.set_exception(failure.value)
+
+        def cancelled(future):
+            if future.cancelled():
+                d.cancel()
+
+        d.addCallbacks(cb, eb)
+        future.add_done_callback(cancelled)
+        return future
+
+    def iterView(self, dbName, docId, viewId, highWater=1000, **kwargs):
+        """
+        Iterate the rows of a view as they arrive.
+
+        Takes the same arguments as L{CouchDB.openView}, and:
+
+        @param highWater: the number of rows received ahead of the consumer
+                          that pauses receiving.
+        @type  highWater: C{int}
+
+        @rtype: L{ViewFeed}
+        """
+
+        async def start(stream):
+            return self.couch.openView(dbName, docId, viewId,
+                rowCallback=stream.push, **kwargs)
+        return ViewFeed(self, start, highWater)
+
+    def iterDocs(self, dbName, highWater=1000, **kwargs):
+        """
+        Iterate the rows of _all_docs as they arrive.
+
+        Takes the same arguments as L{CouchDB.listDoc}.
+
+        @rtype: L{ViewFeed}
+        """
+
+        async def start(stream):
+            return self.couch.listDoc(dbName, rowCallback=stream.push,
+                **kwargs)
+        return ViewFeed(self, start, highWater)
+
+    def iterChanges(self, dbName, since=None, highWater=1000, **kwargs):
+        """
+        Iterate the changes of a database, continuously.
+
+        Only changes of documents are handed out; see
+        L{paisley.changes.ChangeListener.changed}.  The iterator ends when the
+        server closes the feed, like after the timeout given in C{kwargs}.
+
+        Note that the feed takes a slot of the scheduler as long as it runs.
+
+        @param since: the sequence to start after; by default, start from
+                      the most recent change.
+
+        @rtype: L{_Feed}
+        """
+        assert 'feed' not in kwargs, \
+            "iterChanges always listens continuously."
+
+        async def start(stream):
+            seq = since
+            if seq is None:
+                info = await self.infoDB(dbName)
+                seq = info['update_seq']
+
+            kwargs['feed'] = 'continuous'
+            kwargs['since'] = seq
+            uri = '/%s/_changes?%s' % (_namequote(dbName), urlencode(kwargs))
+            # the feed runs until stopped, so it gets no timeout
+            return self.couch.get(uri, descr='changes', timeout=0,
+                receiverFactory=lambda d: _ChangeFeed(d, stream).receiver)
+        return _Feed(self, start, highWater)
+
+
+for _name in METHODS:
+    setattr(AsyncCouchDB, _name, _coroutine(_name))
+del _name
+
+
+class _ChangeFeed(object):
+    """
+    I receive a continuous changes feed for L{AsyncCouchDB.iterChanges}, as
+    the notifier of a L{ChangeReceiver}.
+    """
+
+    def __init__(self, deferred, stream):
+        self._deferred = deferred
+        self._stream = stream
+        self._paused = False
+        self.receiver = ChangeReceiver(self)
+
+    def changed(self, change):
+        drained = self._stream.push(change)
+        if drained is not None and not self._paused:
+            self._paused = True
+            self.receiver.transport.pauseProducing()
+            drained.addCallback(self._resume)
+
+    def _resume(self, _):
+        self._paused = False
+        if self.receiver.transport is not None:
+            self.receiver.transport.resumeProducing()
+
+    def connectionLost(self, reason):
+        # _newclient and http import reactor
+        from twisted.web._newclient import ResponseDone
+        from twisted.web.http import PotentialDataLoss
+
+        self.receiver.transport = None
+        if self._deferred.called:
+            # cancelled
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self._deferred.callback(None)
+        else:
+            self._deferred.errback(reason)
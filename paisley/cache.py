@@ -0,0 +1,800 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_cache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Caches of documents and view results: in memory with bounded size, and
+on disk to survive restarts.
+"""
+
+import collections
+import json
+import sqlite3
+import sys
+
+from urllib.parse import urlencode
+
+from twisted.internet import defer, task
+
+from paisley.client import Cache, StaleEntry, _namequote
+
+
+def estimateSize(value):
+    """
+    Estimate the number of bytes of memory taken by a value, including the
+    values it contains: the members of JSON containers, and the attributes
+    of objects.
+
+    @rtype: C{int}
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += estimateSize(k) + estimateSize(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            size += estimateSize(v)
+    elif hasattr(value, '__dict__') and not isinstance(value, type):
+        size += estimateSize(vars(value))
+    return size
+
+
+def _seqNumber(seq):
+    if isinstance(seq, int):
+        return seq
+    prefix = seq.split('-', 1)[0]
+    if prefix.isdigit():
+        return int(prefix)
+    return None
+
+
+def _seqNewer(seq, than):
+    """
+    Return whether the update_seq C{seq} comes after C{than}.
+
+    CouchDB 1.x numbers its update_seqs.  From 2.x on they are opaque
+    strings starting with a number, which is compared instead; when the
+    numbers are equal or missing, any other seq is taken to be newer.
+
+    @type seq:  C{int} or C{str}
+    @type than: C{int} or C{str}
+
+    @rtype: C{bool}
+    """
+    number, thanNumber = _seqNumber(seq), _seqNumber(than)
+    if number is not None and thanNumber is not None and \
+            number != thanNumber:
+        return number > thanNumber
+    return seq != than
+
+
+class _Entry(object):
+    __slots__ = ('value', 'size', 'stored', 'etag')
+
+    def __init__(self, value, size, stored, etag):
+        self.value = value
+        self.size = size
+        self.stored = stored
+        self.etag = etag
+
+
+class _Segment(object):
+    """
+    A least recently used cache of entries, with a limit on the number of
+    entries and on their estimated size.
+
+    Entries are keyed by (namespace, key), and their number and size are
+    also accounted per namespace.
+
+    @ivar size:      the estimated size of all entries, in bytes.
+    @type size:      C{int}
+    @ivar hits:      the number of lookups that found a fresh entry.
+    @type hits:      C{int}
+    @ivar misses:    the number of lookups that found none.
+    @type misses:    C{int}
+    @ivar evictions: the number of entries evicted to make room.
+    @type evictions: C{int}
+    """
+
+    def __init__(self, maxEntries=None, maxBytes=None, sizeOf=estimateSize):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self._sizeOf = sizeOf
+        self._entries = collections.OrderedDict() # (namespace, key) -> _Entry
+        self._namespaces = {} # namespace -> [set of keys, size]
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Return the entry of a key, as the most recently used one.
+
+        @type key: (namespace, key) C{tuple}
+
+        @rtype: L{_Entry}
+        """
+        try:
+            entry = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self._entries.move_to_end(key)
+        return entry
+
+    def store(self, key, value, stored=None, etag=None):
+        """
+        @type key: (namespace, key) C{tuple}
+
+        @rtype:   C{bool}
+        @returns: whether the value was stored; values larger than the
+                  byte limit are not.
+        """
+        self.delete(key)
+        size = 0
+        if self.maxBytes is not None:
+            size = self._sizeOf(value)
+            if size > self.maxBytes:
+                return False
+        self._entries[key] = _Entry(value, size, stored, etag)
+        self.size += size
+        namespace = self._namespaces.setdefault(key[0], [set(), 0])
+        namespace[0].add(key[1])
+        namespace[1] += size
+        self._evict()
+        return True
+
+    def delete(self, key):
+        """
+        @type key: (namespace, key) C{tuple}
+
+        @rtype: C{bool}
+        @returns: whether there was an entry to delete.
+        """
+        try:
+            entry = self._entries.pop(key)
+        except KeyError:
+            return False
+        self._forget(key, entry)
+        return True
+
+    def replace(self, key, value, stored=None, etag=None):
+        """
+        Replace the value of an entry, keeping its place in the order.
+
+        @type key: (namespace, key) C{tuple}
+
+        @rtype:   C{bool}
+        @returns: whether there was an entry to replace; a value larger
+                  than the byte limit deletes it instead.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        size = 0
+        if self.maxBytes is not None:
+            size = self._sizeOf(value)
+            if size > self.maxBytes:
+                self.delete(key)
+                return False
+        self.size += size - entry.size
+        self._namespaces[key[0]][1] += size - entry.size
+        entry.value = value
+        entry.size = size
+        entry.stored = stored
+        entry.etag = etag
+        self._evict()
+        return True
+
+    def flush(self, namespace):
+        """
+        Delete all entries of a namespace.
+
+        @rtype:   C{int}
+        @returns: the number of entries deleted.
+        """
+        keys, _ = self._namespaces.get(namespace, ((), 0))
+        keys = list(keys)
+        for key in keys:
+            self.delete((namespace, key))
+        return len(keys)
+
+    def _forget(self, key, entry):
+        self.size -= entry.size
+        namespace = self._namespaces[key[0]]
+        namespace[0].discard(key[1])
+        namespace[1] -= entry.size
+        if not namespace[0]:
+            del self._namespaces[key[0]]
+
+    def _evict(self):
+        while self._entries and (
+                (self.maxEntries is not None and
+                    len(self._entries) > self.maxEntries) or
+                (self.maxBytes is not None and self.size > self.maxBytes)):
+            key, entry = self._entries.popitem(last=False)
+            self._forget(key, entry)
+            self.evictions += 1
+
+    def stats(self, namespace=None):
+        if namespace is not None:
+            keys, size = self._namespaces.get(namespace, ((), 0))
+            return {
+                'entries': len(keys),
+                'bytes': size if self.maxBytes is not None else None,
+            }
+        return {
+            'entries': len(self._entries),
+            # sizes are only estimated with a byte limit
+            'bytes': self.size if self.maxBytes is not None else None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class LRUCache(Cache):
+    """
+    I cache parsed docs and mapped objects in memory, evicting the least
+    recently used ones beyond my limits.
+
+    Documents and objects have limits of their own, on the number of
+    entries and on their estimated size in memory; no limit if None.
+    Estimating sizes takes time in proportion to the size of the values,
+    so it is only done with a byte limit.
+
+    With a freshness window, cached documents are only used as they are
+    for that many seconds.  After that, L{get} raises L{StaleEntry} so the
+    client asks the server whether the document changed, sending its
+    revision as If-None-Match; if it did not, the cached document is used
+    again without transferring it.  Mapped objects are not revalidated:
+    after the window, they are mapped anew from the revalidated document.
+
+    Docs and objects of all namespaces share the limits; L{stats} reports
+    how many entries and bytes each namespace holds, and L{flush} removes
+    them.
+
+    @ivar lookups: the number of lookups of docs and objects.
+    @type lookups: C{int}
+    @ivar hits:    the number of lookups that found an entry.
+    @type hits:    C{int}
+    @ivar cached:  the number of docs and objects in the cache.
+    @type cached:  C{int}
+    @ivar revalidatedHits: the number of stale documents the server said
+                           were not changed.
+    @type revalidatedHits: C{int}
+    @ivar refetches:       the number of stale documents fetched again
+                           because they were changed.
+    @type refetches:       C{int}
+    """
+
+    def __init__(self, maxEntries=10000, maxBytes=None, maxObjects=10000,
+                 maxObjectBytes=None, sizeOf=estimateSize, freshness=None,
+                 clock=None):
+        """
+        @param maxEntries:     the maximum number of docs.
+        @type  maxEntries:     C{int}
+        @param maxBytes:       the maximum estimated size of the docs.
+        @type  maxBytes:       C{int}
+        @param maxObjects:     the maximum number of mapped objects.
+        @type  maxObjects:     C{int}
+        @param maxObjectBytes: the maximum estimated size of the mapped
+                               objects.
+        @type  maxObjectBytes: C{int}
+        @param sizeOf:         estimates the size of a doc or object.
+        @type  sizeOf:         callable
+        @param freshness:      if specified, the number of seconds cached
+                               documents are used without revalidating
+                               them.
+        @type  freshness:      C{float}
+        @param clock:          the clock to measure freshness with.
+        @type  clock:          L{twisted.internet.interfaces.IReactorTime}
+        """
+        if clock is None and freshness is not None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+        self.freshness = freshness
+
+        self._docs = _Segment(maxEntries, maxBytes, sizeOf)
+        self._objects = _Segment(maxObjects, maxObjectBytes, sizeOf)
+        # (namespace, key) of docs found stale, until stored again
+        self._stale = set()
+
+        self.lookups = 0
+        self.revalidatedHits = 0
+        self.refetches = 0
+
+    @property
+    def hits(self):
+        return self._docs.hits + self._objects.hits
+
+    @property
+    def cached(self):
+        return len(self._docs) + len(self._objects)
+
+    def stats(self, namespace=None):
+        """
+        Return the counters and resident size of the docs and of the
+        objects.
+
+        @param namespace: if specified, only return the number of entries
+                          and their estimated size for this namespace.
+        @type  namespace: C{str}
+
+        @rtype:   C{dict} of C{str} -> C{dict}
+        @returns: for docs and objects, a dict with the number of entries,
+                  their estimated size in bytes (None without a byte
+                  limit), and the number of fresh hits, misses and
+                  evictions; for docs also the number of revalidated hits
+                  and of refetches.
+        """
+        if namespace is not None:
+            return {
+                'docs': self._docs.stats(namespace),
+                'objects': self._objects.stats(namespace),
+            }
+        docs = self._docs.stats()
+        docs['revalidatedHits'] = self.revalidatedHits
+        docs['refetches'] = self.refetches
+        return {
+            'docs': docs,
+            'objects': self._objects.stats(),
+        }
+
+    def store(self, key, value, operation='post', namespace=None):
+        key = (namespace, key)
+        if key in self._stale:
+            self._stale.discard(key)
+            self.refetches += 1
+        return defer.succeed(self._docs.store(key, value, self._now(),
+            self._etag(value)))
+
+    def refresh(self, key, value, namespace=None):
+        key = (namespace, key)
+        # objects mapped from the old doc are outdated
+        self._objects.delete(key)
+        self._stale.discard(key)
+        return defer.succeed(self._docs.replace(key, value, self._now(),
+            self._etag(value)))
+
+    def get(self, key, namespace=None):
+        self.lookups += 1
+        entry = self._docs.get((namespace, key))
+        if not self._isFresh(entry):
+            if entry.etag is None:
+                self._docs.misses += 1
+                raise KeyError(key)
+            self._stale.add((namespace, key))
+            raise StaleEntry(key, entry.value, entry.etag)
+        self._docs.hits += 1
+        return defer.succeed(entry.value)
+
+    def revalidated(self, key, value, namespace=None):
+        self._stale.discard((namespace, key))
+        self.revalidatedHits += 1
+        if (namespace, key) in self._docs:
+            entry = self._docs.get((namespace, key))
+            entry.stored = self._now()
+        else:
+            # evicted meanwhile
+            self.store(key, value, namespace=namespace)
+        return defer.succeed(value)
+
+    def getObject(self, key, namespace=None):
+        self.lookups += 1
+        entry = self._objects.get((namespace, key))
+        if not self._isFresh(entry):
+            self._objects.misses += 1
+            raise KeyError(key)
+        self._objects.hits += 1
+        return defer.succeed(entry.value)
+
+    def mapped(self, key, obj, namespace=None):
+        assert type(obj) is not defer.Deferred
+        self._objects.store((namespace, key), obj, self._now())
+
+    def delete(self, key, namespace=None):
+        self._stale.discard((namespace, key))
+        deleted = self._docs.delete((namespace, key))
+        deleted = self._objects.delete((namespace, key)) or deleted
+        return defer.succeed(deleted)
+
+    def flush(self, namespace):
+        self._stale = set(key for key in self._stale
+            if key[0] != namespace)
+        flushed = self._docs.flush(namespace)
+        flushed += self._objects.flush(namespace)
+        return defer.succeed(flushed)
+
+    def _etag(self, value):
+        if isinstance(value, dict) and '_rev' in value:
+            return '"%s"' % (value['_rev'], )
+        return None
+
+    def _now(self):
+        if self.freshness is None:
+            return None
+        return self._clock.seconds()
+
+    def _isFresh(self, entry):
+        return self.freshness is None or \
+            self._clock.seconds() - entry.stored < self.freshness
+
+
+class ViewCache(object):
+    """
+    I cache the results of view queries, keyed by the view and its query
+    arguments, along with the update_seq of the database they were
+    computed at.
+
+    A result is fresh as long as the database is known to be at that
+    update_seq.  I learn of newer ones through L{advance}: from
+    L{startPolling}, from a L{paisley.changes.ChangeNotifier} I was added
+    to, or from L{paisley.client.CouchDB.infoDB}.  Until I know the
+    update_seq of a database, I do not serve results of its views.
+
+    Results of all databases share the limits.  Stale results are kept to
+    be served while they are refreshed, with C{staleWhileRefresh}, until
+    they are evicted or replaced.
+
+    @ivar hits:         the number of lookups that found a fresh result.
+    @type hits:         C{int}
+    @ivar staleHits:    the number of lookups that found a stale result.
+    @type staleHits:    C{int}
+    @ivar misses:       the number of lookups that found none.
+    @type misses:       C{int}
+    """
+
+    def __init__(self, maxEntries=1000, maxBytes=None, sizeOf=estimateSize,
+                 staleWhileRefresh=False, clock=None):
+        """
+        @param maxEntries:        the maximum number of results.
+        @type  maxEntries:        C{int}
+        @param maxBytes:          the maximum estimated size of the results.
+        @type  maxBytes:          C{int}
+        @param sizeOf:            estimates the size of a result.
+        @type  sizeOf:            callable
+        @param staleWhileRefresh: whether to serve a stale result while it
+                                  is refreshed in the background, instead
+                                  of waiting for the refreshed one.
+        @type  staleWhileRefresh: C{bool}
+        @param clock:             the clock to poll with.
+        @type  clock:             L{twisted.internet.interfaces.IReactorTime}
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+        self.staleWhileRefresh = staleWhileRefresh
+
+        self._results = _Segment(maxEntries, maxBytes, sizeOf)
+        self._seqs = {} # namespace -> latest known update_seq
+        self._polls = {} # namespace -> LoopingCall
+
+        self.staleHits = 0
+
+    @property
+    def hits(self):
+        return self._results.hits
+
+    @property
+    def misses(self):
+        return self._results.misses
+
+    def advance(self, namespace, seq):
+        """
+        Record that a database is at least at an update_seq; results
+        computed before it become stale.
+
+        @type namespace: C{str}
+        @type seq:       C{int} or C{str}
+        """
+        if seq is None:
+            return
+        current = self._seqs.get(namespace)
+        if current is None or _seqNewer(seq, current):
+            self._seqs[namespace] = seq
+
+    def seq(self, namespace):
+        """
+        @rtype:   C{int} or C{str}
+        @returns: the latest known update_seq of a database, or None.
+        """
+        return self._seqs.get(namespace)
+
+    def get(self, namespace, key):
+        """
+        Look up the result of a view query.
+
+        @param key: the normalized view and query arguments.
+        @type  key: C{tuple}
+
+        @rtype:   C{tuple} of (C{dict}, C{bool})
+        @returns: the result, and whether it is fresh.
+        @raises KeyError: if there is no result, or the update_seq of the
+                          database is not known.
+        """
+        current = self._seqs.get(namespace)
+        if current is None:
+            self._results.misses += 1
+            raise KeyError(key)
+        entry = self._results.get((namespace, key))
+        if entry.etag is not None and not _seqNewer(current, entry.etag):
+            self._results.hits += 1
+            return entry.value, True
+        self.staleHits += 1
+        return entry.value, False
+
+    def store(self, namespace, key, result, seq):
+        """
+        Store the result of a view query, computed at an update_seq.
+        """
+        # the seq is kept where documents keep their ETag
+        self._results.store((namespace, key), result, etag=seq)
+
+    def flush(self, namespace):
+        """
+        Remove the results of the views of a database.
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing the number of results removed.
+        """
+        return defer.succeed(self._results.flush(namespace))
+
+    def stats(self, namespace=None):
+        """
+        Return the counters and resident size of the results.
+
+        @param namespace: if specified, only return the number of results
+                          and their estimated size for this database.
+        @type  namespace: C{str}
+
+        @rtype:   C{dict} of C{str} -> C{int}
+        @returns: the number of results, their estimated size in bytes
+                  (None without a byte limit), and the number of fresh
+                  hits, stale hits, misses and evictions.
+        """
+        stats = self._results.stats(namespace)
+        if namespace is None:
+            stats['staleHits'] = self.staleHits
+        return stats
+
+    # polling
+
+    def startPolling(self, couch, dbName, interval):
+        """
+        Get the update_seq of a database every C{interval} seconds.
+
+        @type couch: L{paisley.client.CouchDB}
+        """
+        namespace = couch.cacheNamespace(dbName)
+        self.stopPolling(couch, dbName)
+
+        def poll():
+            d = couch.infoDB(dbName)
+            d.addCallback(lambda info:
+                self.advance(namespace, info['update_seq']))
+            # keep polling through errors; results just stay stale
+            d.addErrback(lambda _: None)
+            return d
+        lc = task.LoopingCall(poll)
+        lc.clock = self._clock
+        self._polls[namespace] = lc
+        lc.start(interval, now=True)
+
+    def stopPolling(self, couch, dbName):
+        lc = self._polls.pop(couch.cacheNamespace(dbName), None)
+        if lc is not None and lc.running:
+            lc.stop()
+
+
+class SQLiteCache(Cache):
+    """
+    I cache parsed docs in an sqlite database on disk, so that a restarted
+    process does not have to fetch them all again.
+
+    Along with the docs, I keep the last update_seq of each database whose
+    changes were applied to them.  On startup, L{catchUp} fetches the
+    changes since then and evicts, or refetches, the changed documents,
+    instead of starting from an empty cache.  Afterwards, a
+    L{paisley.changes.ChangeNotifier} the cache was added to keeps both
+    the docs and the update_seq current.
+
+    The database is local, so it is queried synchronously, like a cache
+    in memory.  Mapped objects cannot be stored, and are only kept in
+    memory.
+
+    @ivar lookups: the number of lookups of docs and objects.
+    @type lookups: C{int}
+    @ivar hits:    the number of lookups that found an entry.
+    @type hits:    C{int}
+    """
+
+    def __init__(self, path):
+        """
+        @param path: the file of the sqlite database; created if needed.
+        @type  path: C{str}
+        """
+        self._db = sqlite3.connect(path, isolation_level=None)
+        # write-ahead logging only syncs at checkpoints, and a lost write
+        # at worst loses a cached document
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS docs ('
+            'namespace TEXT NOT NULL, id TEXT NOT NULL, rev TEXT, '
+            'doc TEXT NOT NULL, PRIMARY KEY (namespace, id))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS seqs ('
+            'namespace TEXT PRIMARY KEY, seq TEXT NOT NULL)')
+        self._objects = {} # dict of namespace to dict of id to object
+
+        self.lookups = 0
+        self.hits = 0
+
+    def close(self):
+        self._db.close()
+
+    @property
+    def cached(self):
+        count, = self._db.execute('SELECT COUNT(*) FROM docs').fetchone()
+        return count + sum(len(objects)
+            for objects in self._objects.values())
+
+    def store(self, key, value, operation='post', namespace=None):
+        self._db.execute('INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?)',
+            (namespace or '', key, value.get('_rev'), json.dumps(value)))
+        return defer.succeed(True)
+
+    def get(self, key, namespace=None):
+        self.lookups += 1
+        row = self._db.execute(
+            'SELECT doc FROM docs WHERE namespace = ? AND id = ?',
+            (namespace or '', key)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        self.hits += 1
+        return defer.succeed(json.loads(row[0]))
+
+    def getObject(self, key, namespace=None):
+        self.lookups += 1
+        ret = self._objects.get(namespace, {})[key]
+        self.hits += 1
+        return defer.succeed(ret)
+
+    def mapped(self, key, obj, namespace=None):
+        assert type(obj) is not defer.Deferred
+        self._objects.setdefault(namespace, {})[key] = obj
+
+    def delete(self, key, namespace=None):
+        self._objects.get(namespace, {}).pop(key, None)
+        self._db.execute('DELETE FROM docs WHERE namespace = ? AND id = ?',
+            (namespace or '', key))
+        return defer.succeed(True)
+
+    def refresh(self, key, value, namespace=None):
+        self._objects.get(namespace, {}).pop(key, None)
+        cursor = self._db.execute('UPDATE docs SET rev = ?, doc = ? '
+            'WHERE namespace = ? AND id = ?',
+            (value.get('_rev'), json.dumps(value), namespace or '', key))
+        return defer.succeed(cursor.rowcount > 0)
+
+    def flush(self, namespace):
+        flushed = len(self._objects.pop(namespace, {}))
+        flushed += self._db.execute('DELETE FROM docs WHERE namespace = ?',
+            (namespace or '', )).rowcount
+        self._db.execute('DELETE FROM seqs WHERE namespace = ?',
+            (namespace or '', ))
+        return defer.succeed(flushed)
+
+    def stats(self, namespace=None):
+        """
+        Return the cache counters and the size of the docs on disk.
+
+        @param namespace: if specified, only count the entries of this
+                          namespace.
+        @type  namespace: C{str}
+
+        @rtype: C{dict} of C{str} -> C{int}
+        """
+        if namespace is None:
+            count, size = self._db.execute(
+                'SELECT COUNT(*), SUM(LENGTH(doc)) FROM docs').fetchone()
+            return {
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'cached': self.cached,
+                'bytes': size or 0,
+            }
+        count, size = self._db.execute('SELECT COUNT(*), SUM(LENGTH(doc)) '
+            'FROM docs WHERE namespace = ?', (namespace, )).fetchone()
+        return {
+            'cached': count + len(self._objects.get(namespace, {})),
+            'bytes': size or 0,
+        }
+
+    # update seqs
+
+    def getSeq(self, namespace):
+        """
+        @rtype:   C{int} or C{str}
+        @returns: the last update_seq of a database applied to the cache,
+                  or None.
+        """
+        row = self._db.execute('SELECT seq FROM seqs WHERE namespace = ?',
+            (namespace or '', )).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def saveSeq(self, namespace, seq):
+        """
+        Record that the changes of a database up to an update_seq were
+        applied to the cache.
+        """
+        self._db.execute('INSERT OR REPLACE INTO seqs VALUES (?, ?)',
+            (namespace or '', json.dumps(seq)))
+
+    def catchUp(self, couch, dbName, refresh=False):
+        """
+        Apply the changes of a database since the last saved update_seq.
+
+        Without a saved update_seq, the docs of the database cannot be
+        trusted; they are flushed, and the current update_seq is saved.
+
+        @type  couch:   L{paisley.client.CouchDB}
+        @param refresh: whether to fetch changed documents again, instead
+                        of only evicting them.
+        @type  refresh: C{bool}
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing the number of documents evicted or
+                  refreshed.
+        """
+        namespace = couch.cacheNamespace(dbName)
+        since = self.getSeq(namespace)
+
+        if since is None:
+            d = couch.infoDB(dbName)
+
+            def infoCb(info):
+                d = self.flush(namespace)
+                self.saveSeq(namespace, info['update_seq'])
+                return d
+            return d.addCallback(infoCb)
+
+        d = couch.get('/%s/_changes?%s' % (_namequote(dbName),
+            urlencode({'since': since})), descr='catchUp')
+        d.addCallback(couch.parseResult)
+
+        def changesCb(result):
+            present = set(change['id'] for change in result['results']
+                if not change.get('deleted'))
+            evicted = []
+            for change in result['results']:
+                resident = self._db.execute(
+                    'SELECT 1 FROM docs WHERE namespace = ? AND id = ?',
+                    (namespace, change['id'])).fetchone()
+                if resident:
+                    self.delete(change['id'], namespace)
+                    evicted.append(change['id'])
+
+            refetch = [docId for docId in evicted if docId in present]
+            d = defer.succeed([])
+            if refresh and refetch:
+                d = couch.openDocs(dbName, refetch)
+
+            def saveCb(found):
+                for row in found:
+                    if 'doc' in row:
+                        self.store(row['id'], row['doc'],
+                            namespace=namespace)
+                self.saveSeq(namespace, result['last_seq'])
+                return len(evicted)
+            return d.addCallback(saveCb)
+        return d.addCallback(changesCb)
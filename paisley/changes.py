@@ -4,18 +4,20 @@
 # Copyright (c) 2011
 # See LICENSE for details.
 
-from urllib import urlencode
+from urllib.parse import urlencode
 
 from twisted.internet import error, defer
 from twisted.protocols import basic
 
-from paisley.client import json
+from paisley.client import AuthenticationError, Cache, json
 
 
 class ChangeReceiver(basic.LineReceiver):
     # figured out by checking the last two characters on actually received
     # lines
-    delimiter = '\n'
+    delimiter = b'\n'
+    # with include_docs, a line carries a whole document
+    MAX_LENGTH = 2 ** 24
 
     def __init__(self, notifier):
         self._notifier = notifier
@@ -64,11 +66,20 @@ class ChangeListener:
 
 class ChangeNotifier(object):
 
-    def __init__(self, db, dbName, since=None):
+    def __init__(self, db, dbName, since=None, refresh=False):
+        """
+        @param refresh: whether to get changes with their documents, and
+                        write those into the caches that already hold
+                        them, instead of only deleting them; deleted
+                        documents are deleted from the caches.
+        @type  refresh: C{bool}
+        """
         self._db = db
         self._dbName = dbName
+        self._refresh = refresh
 
         self._caches = []
+        self._viewCaches = []
         self._listeners = []
         self._prot = None
 
@@ -79,6 +90,15 @@ class ChangeNotifier(object):
     def addCache(self, cache):
         self._caches.append(cache)
 
+    def addViewCache(self, viewCache):
+        """
+        Keep the update_seq of the database in a view cache up to date, so
+        that it stops serving results computed before a change.
+
+        @type viewCache: L{paisley.cache.ViewCache}
+        """
+        self._viewCaches.append(viewCache)
+
     def addListener(self, listener):
         self._listeners.append(listener)
 
@@ -104,18 +124,42 @@ class ChangeNotifier(object):
             d.addCallback(lambda _: self._db.infoDB(self._dbName))
             d.addCallback(setSince)
 
-        def requestChanges():
+        def requestChanges(loggedIn=False):
+            db = self._db
+            # authenticated like the other requests of the client
+            cookie = None
+            if db.username and db._cookieAuth:
+                manager = db._getSessionManager()
+                cookie = manager.getCookie()
+                if cookie is None:
+                    if loggedIn:
+                        raise AuthenticationError(
+                            'Session expired right after logging in')
+                    return manager.login().addCallback(
+                        lambda _: requestChanges(True))
+
             kwargs['feed'] = 'continuous'
+            if self._refresh:
+                kwargs['include_docs'] = 'true'
             kwargs['since'] = self._since
-            # FIXME: str should probably be unicode, as dbName can be
-            url = str(self._db.url_template %
+            url = (db.url_template %
                 '/%s/_changes?%s' % (self._dbName, urlencode(kwargs)))
-            return self._db.client.request('GET', url)
+            prepared = db._prepareHeaders(None, True, cookie)
+            return db.client.request(b'GET', url.encode('utf-8'),
+                prepared.raw)
         d.addCallback(lambda _: requestChanges())
 
         def requestCb(response):
+            # the database is at least at the seq the feed starts from
+            for viewCache in self._viewCaches:
+                viewCache.advance(self._db.cacheNamespace(self._dbName),
+                    self._since)
             self._prot = ChangeReceiver(self)
-            response.deliverBody(self._prot)
+            protocol = self._prot
+            if self._db.compressionPolicy is not None:
+                protocol = self._db.compressionPolicy.decoder(response,
+                    protocol)
+            response.deliverBody(protocol)
             self._running = True
         d.addCallback(requestCb)
 
@@ -140,8 +184,25 @@ class ChangeNotifier(object):
         if seq:
             self._since = seq
 
-        for cache in self._caches:
-            cache.delete(change['id'])
+        if self._caches or self._viewCaches:
+            namespace = self._db.cacheNamespace(self._dbName)
+            doc = change.get('doc')
+            if change.get('deleted') or not self._refresh:
+                doc = None
+            for cache in self._caches:
+                # only resident documents are refreshed, to bound memory;
+                # caches not implementing refresh only get to delete
+                refreshes = getattr(type(cache), 'refresh',
+                    Cache.refresh) is not Cache.refresh
+                if doc is not None and refreshes:
+                    cache.refresh(change['id'], doc, namespace)
+                else:
+                    cache.delete(change['id'], namespace)
+                # persistent caches remember how far they are
+                if seq and hasattr(cache, 'saveSeq'):
+                    cache.saveSeq(namespace, seq)
+            for viewCache in self._viewCaches:
+                viewCache.advance(namespace, seq)
 
         for listener in self._listeners:
             listener.changed(change)
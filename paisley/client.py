@@ -10,7 +10,6 @@ CouchDB client.
 
 import json
 
-from encodings import utf_8
 import logging
 import types
 import http.cookiejar
@@ -18,12 +17,12 @@ import http.cookiejar
 from urllib.parse import urlencode, quote
 
 from twisted.internet import defer
-from twisted.internet import defer, task
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
 
 from twisted.internet.defer import Deferred, maybeDeferred
 from twisted.internet.protocol import Protocol
+from twisted.python import failure
 
 from zope.interface.declarations import implementer
 
@@ -72,14 +71,129 @@ except ImportError:
 
 SOCK_TIMEOUT = 300
 
+# defaults for splitting up _bulk_docs requests
+BULK_CHUNK_SIZE = 1000
+BULK_CHUNK_BYTES = 4 * 1024 * 1024
+BULK_CONCURRENCY = 2
+
+
+def _firstError(failure):
+    """
+    Errback unwrapping the failure of the first failed deferred from
+    a gatherResults.
+    """
+    failure.trap(defer.FirstError)
+    return failure.value.subFailure
+
+
+def _chunkDocs(encoded, chunkSize, chunkBytes):
+    """
+    Split a list of JSON-encoded documents into chunks of at most chunkSize
+    documents and approximately at most chunkBytes bytes.
+    """
+    chunk = []
+    size = 0
+    for doc in encoded:
+        # account for the separator too
+        length = len(doc) + 2
+        if chunk and (len(chunk) >= chunkSize or size + length > chunkBytes):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(doc)
+        size += length
+
+    if chunk:
+        yield chunk
+
+
+def _chunkFailed(failure, chunk):
+    """
+    Errback turning the failure of a _bulk_docs request into an error result
+    for each document of its chunk.
+    """
+    # twisted.web.error imports reactor
+    from twisted.web import error as tw_error
+
+    error, reason = 'request_failed', failure.getErrorMessage()
+    if failure.check(tw_error.Error):
+        try:
+            body = json.loads(failure.value.message)
+            error, reason = body['error'], body.get('reason', reason)
+        except Exception:
+            pass
+
+    results = []
+    for doc in chunk:
+        try:
+            docId = json.loads(doc).get('_id')
+        except Exception:
+            docId = None
+        results.append({'id': docId, 'error': error, 'reason': reason})
+    return results
+
+
+class _ShortPrint(object):
+    """
+    Formats C{value} with L{short_print} only when it gets logged.
+    """
+    __slots__ = ('value', 'useRepr')
+
+    def __init__(self, value, useRepr=False):
+        self.value = value
+        self.useRepr = useRepr
+
+    def __str__(self):
+        if self.useRepr:
+            return short_print(repr(self.value))
+        return short_print(self.value)
+
+
+class _PreparedHeaders(object):
+    """
+    The headers of a request, as a dict and as L{Headers} ready to send.
+
+    Treat as read only: the headers common to all requests of a client are
+    prepared once and shared by those requests.
+    """
+    __slots__ = ('headers', 'raw', '_key')
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.raw = Headers(headers)
+        self._key = None
+
+    def key(self):
+        """
+        Return the headers as a hashable value, for coalescing requests.
+        """
+        if self._key is None:
+            self._key = tuple(sorted((name, tuple(values))
+                for name, values in self.headers.items()))
+        return self._key
+
+    def added(self, headers):
+        """
+        Return a copy with C{headers} added.
+
+        @rtype: L{_PreparedHeaders}
+        """
+        merged = dict(self.headers)
+        merged.update(headers)
+        return _PreparedHeaders(merged)
+
 
 @implementer(IBodyProducer)
 class StringProducer(object):
     """
     Body producer for t.w.c.Agent
+
+    Takes C{bytes}, or C{str} which gets encoded as UTF-8.
     """
 
     def __init__(self, body):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
         self.body = body
         self.length = len(body)
 
@@ -96,26 +210,33 @@ class StringProducer(object):
 class ResponseReceiver(Protocol):
     """
     Assembles HTTP response from return stream.
+
+    The response is assembled as bytes.  If decode_utf8 is set, it is
+    decoded in one go once complete.
     """
 
     def __init__(self, deferred, decode_utf8):
         self.recv_chunks = []
-        self.decoder = utf_8.IncrementalDecoder() if decode_utf8 else None
+        self.decode_utf8 = decode_utf8
         self.deferred = deferred
 
-    def dataReceived(self, bytes, final=False):
-        if self.decoder:
-            bytes = self.decoder.decode(bytes, final)
-        self.recv_chunks.append(bytes)
+    def dataReceived(self, data):
+        self.recv_chunks.append(data)
 
     def connectionLost(self, reason):
         # _newclient and http import reactor
         from twisted.web._newclient import ResponseDone
         from twisted.web.http import PotentialDataLoss
 
+        if self.deferred.called:
+            # cancelled
+            return
+
         if reason.check(ResponseDone) or reason.check(PotentialDataLoss):
-            self.dataReceived('', final=True)
-            self.deferred.callback(''.join(self.recv_chunks))
+            body = b''.join(self.recv_chunks)
+            if self.decode_utf8:
+                body = body.decode('utf-8')
+            self.deferred.callback(body)
         else:
             self.deferred.errback(reason)
 
@@ -128,7 +249,14 @@ class CouchDB(object):
     def __init__(self, host, port=5984, dbName=None,
                  username=None, password=None, protocol='http',
                  disable_log=False,
-                 version=(1, 0, 1), cache=None):
+                 version=(1, 0, 1), cache=None,
+                 pool=None, persistent=True, maxPersistentPerHost=2,
+                 cachedConnectionTimeout=240, retryAutomatically=True,
+                 coalesce=False, scheduler=None, maxInFlight=None,
+                 maxPerHost=None, maxQueued=None, overflow='reject',
+                 retryPolicy=None, hedgePolicy=None,
+                 compressionPolicy=None, cookieAuth=True, sessionManager=None,
+                 timeout=SOCK_TIMEOUT, viewCache=None):
         """
         Initialize the client for given host.
 
@@ -146,11 +274,82 @@ class CouchDB(object):
         @type  username: C{unicode}
         @param password: the password
         @type  password: C{unicode}
+        @param pool:     if specified, the connection pool to use; allows
+                         sharing connections between clients.
+                         The other connection parameters are then ignored.
+        @type  pool:     L{paisley.pool.ConnectionPool}
+        @param persistent:              whether to keep connections open
+                                        between requests.
+        @type  persistent:              C{bool}
+        @param maxPersistentPerHost:    the maximum number of idle connections
+                                        kept open to the server.
+        @type  maxPersistentPerHost:    C{int}
+        @param cachedConnectionTimeout: the number of seconds an idle
+                                        connection is kept open.
+        @type  cachedConnectionTimeout: C{int}
+        @param retryAutomatically:      whether to retry idempotent requests
+                                        once on a stale idle connection.
+        @type  retryAutomatically:      C{bool}
+        @param coalesce: whether a GET identical to one in flight waits for
+                         and shares the response of that one instead of
+                         doing its own request.  Note that the shared
+                         response may predate writes done in the meantime.
+        @type  coalesce: C{bool}
+        @param scheduler:   the scheduler to run requests through; share
+                            it between clients to limit them together.  If
+                            not specified, one is created with the following
+                            options.
+        @type  scheduler:   L{paisley.scheduler.Scheduler}
+        @param maxInFlight: the maximum number of requests in flight over all
+                            hosts; unlimited if None.
+        @type  maxInFlight: C{int}
+        @param maxPerHost:  the maximum number of requests in flight per
+                            host; unlimited if None.
+        @type  maxPerHost:  C{int}
+        @param maxQueued:   the maximum number of requests waiting for one of
+                            those to finish; unlimited if None.
+        @type  maxQueued:   C{int}
+        @param overflow:    what to do with a request when the queue is full;
+                            see L{paisley.scheduler.Scheduler}.
+        @type  overflow:    C{str}
+        @param retryPolicy: the policy to retry failed requests with;
+                            defaults to a L{paisley.retry.RetryPolicy} with
+                            default settings.
+        @type  retryPolicy: L{paisley.retry.RetryPolicy}
+        @param hedgePolicy: if specified, the policy to send a second copy of
+                            slow reads with.
+        @type  hedgePolicy: L{paisley.hedge.HedgePolicy}
+        @param compressionPolicy: if specified, the policy to ask for
+                                  compressed responses and to compress
+                                  large request bodies with.
+        @type  compressionPolicy: L{paisley.compress.CompressionPolicy}
+        @param cookieAuth:     whether to log in with the username and
+                               password and send the session cookie,
+                               instead of sending the password with every
+                               request.
+        @type  cookieAuth:     C{bool}
+        @param sessionManager: the session manager to log in with; by
+                               default, the one shared by all clients of
+                               the server with the same credentials.
+        @type  sessionManager: L{paisley.session.SessionManager}
+        @param timeout:        the default number of seconds after which a
+                               request is cancelled and fails with
+                               L{RequestTimeout}; None for no timeout.
+                               Methods doing requests take a timeout
+                               argument overriding it, where 0 means no
+                               timeout.  Streamed views and attachments
+                               only time out when passed one.
+        @type  timeout:        C{float}
+        @param viewCache:      if specified, the cache to serve the results
+                               of view queries from, while the update_seq
+                               of their database did not advance.
+        @type  viewCache:      L{paisley.cache.ViewCache}
         """
         if disable_log:
             # since this is the db layer, and we generate a lot of logs,
             # let people disable them completely if they want to.
-            levels = ['trace', 'debug', 'info', 'warn', 'error', 'exception']
+            levels = ['trace', 'debug', 'info', 'warn', 'warning', 'error',
+                'exception']
 
             class FakeLog(object):
                 pass
@@ -159,7 +358,7 @@ class CouchDB(object):
                 pass
             self.log = FakeLog()
             for level in levels:
-                self.log.__dict__[level] = types.Methodtype(nullfn, self.log)
+                self.log.__dict__[level] = types.MethodType(nullfn, self.log)
         else:
             self.log = logging.getLogger('paisley')
 
@@ -173,18 +372,55 @@ class CouchDB(object):
             from paisley.tcompat import CookieAgent
             self.log.debug('using paisley.tcompat.CookieAgent')
 
-        agent = Agent(reactor)
+        if pool is None:
+            from paisley.pool import ConnectionPool
+            pool = ConnectionPool(reactor, persistent=persistent,
+                maxPersistentPerHost=maxPersistentPerHost,
+                cachedConnectionTimeout=cachedConnectionTimeout,
+                retryAutomatically=retryAutomatically)
+        self.pool = pool
+
+        if scheduler is None:
+            from paisley.scheduler import Scheduler
+            scheduler = Scheduler(maxInFlight=maxInFlight,
+                maxPerHost=maxPerHost, maxQueued=maxQueued,
+                overflow=overflow, clock=reactor)
+        self.scheduler = scheduler
+
+        if retryPolicy is None:
+            from paisley.retry import RetryPolicy
+            retryPolicy = RetryPolicy(clock=reactor)
+        self.retryPolicy = retryPolicy
+        self.hedgePolicy = hedgePolicy
+        self.compressionPolicy = compressionPolicy
+
+        agent = Agent(reactor, pool=self.pool)
         self.client = CookieAgent(agent, http.cookiejar.CookieJar())
         self.host = host
         self.port = int(port)
         self.username = username
         self.password = password
         self._cache = cache
+        self._viewCache = viewCache
+        self._viewRefreshes = set() # (namespace, key) refreshed in background
         self._authenticator = None
-        self._authLC = None # looping call to keep us authenticated
+        self._cookieAuth = cookieAuth
+        self._sessionManager = sessionManager
         self._session = {}
+        self._authorization = None # ((username, password), header value)
+        self._preparedHeaders = {} # (isJson, ...) -> _PreparedHeaders
+
+        self.timeout = timeout
+        self.timeouts = {} # descr -> number of requests timed out
+        self._clock = reactor
+        self._expiring = 0 # number of deadlines cancelling their request
+
+        self._coalesce = coalesce
+        self._inFlight = {} # (url, headers) -> (request, waiting deferreds)
+        self.coalesced = 0
 
         self.url_template = "%s://%s:%s%%s" % (protocol, self.host, self.port)
+        self.url_prefix = self.url_template[:-2].encode('utf-8')
 
         if dbName is not None:
             self.bindToDB(dbName)
@@ -197,9 +433,108 @@ class CouchDB(object):
                        dbName if dbName else '')
         self.version = version
 
+    def getPoolStats(self):
+        """
+        Return usage statistics of the connection pool.
+
+        @rtype:   C{dict} of C{str} -> C{int}
+        @returns: a dict with inUse, idle, created and reused counts.
+        """
+        return self.pool.stats()
+
+    def getSchedulerStats(self):
+        """
+        Return queueing statistics of the request scheduler.
+
+        @rtype: C{dict}
+        @see:   L{paisley.scheduler.Scheduler.stats}
+        """
+        return self.scheduler.stats()
+
+    def getRetryStats(self):
+        """
+        Return the counters of the retry policy.
+
+        @rtype: C{dict} of C{str} -> C{int}
+        @see:   L{paisley.retry.RetryPolicy.stats}
+        """
+        return self.retryPolicy.stats()
+
+    def getCompressionStats(self):
+        """
+        Return the counters of the compression policy, including the bytes
+        saved; empty without a compression policy.
+
+        @rtype: C{dict} of C{str} -> C{int}
+        @see:   L{paisley.compress.CompressionPolicy.stats}
+        """
+        if self.compressionPolicy is None:
+            return {}
+        return self.compressionPolicy.stats()
+
+    def getTimeoutStats(self):
+        """
+        Return the number of requests that timed out, per descr.
+
+        @rtype: C{dict} of C{str} -> C{int}
+        """
+        return dict(self.timeouts)
+
+    def getCacheStats(self, dbName=None):
+        """
+        Return the counters of the cache; empty without a cache.
+
+        @param dbName: if specified, return only what the cache holds for
+                       this database.
+        @type  dbName: C{str}
+
+        @rtype: C{dict}
+        @see:   L{paisley.cache.LRUCache.stats}
+        """
+        if self._cache is None or not hasattr(self._cache, 'stats'):
+            return {}
+        if dbName is None:
+            return self._cache.stats()
+        return self._cache.stats(self.cacheNamespace(dbName))
+
+    def cacheNamespace(self, dbName):
+        """
+        Return the namespace of the cache entries of a database, so that
+        one cache can serve several databases and servers.
+
+        @type dbName: C{str}
+
+        @rtype:   C{str}
+        @returns: the URL of the database.
+        """
+        return self.url_template % ('/' + _namequote(dbName), )
+
+    def flushCache(self, dbName):
+        """
+        Remove the docs and objects of a database from the cache.
+
+        @type dbName: C{str}
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing the number of entries removed.
+        """
+        if not self._cache:
+            return defer.succeed(0)
+        return self._cache.flush(self.cacheNamespace(dbName))
+
+    def closeCachedConnections(self):
+        """
+        Close all idle connections to the server.
+
+        @rtype: L{defer.Deferred}
+        """
+        return self.pool.closeCachedConnections()
+
     def parseResult(self, result):
         """
         Parse JSON result from the DB.
+
+        @type result: C{bytes} or C{str}
         """
         return json.loads(result)
 
@@ -208,15 +543,16 @@ class CouchDB(object):
         Bind all operations asking for a DB name to the given DB.
         """
         for methname in ["createDB", "deleteDB", "infoDB", "listDoc",
-                         "openDoc", "saveDoc", "deleteDoc", "openView",
-                         "tempView"]:
+                         "openDoc", "openDocs", "saveDoc", "deleteDoc",
+                         "saveDocs", "deleteDocs", "putAttachment",
+                         "getAttachment", "openView", "tempView"]:
             method = getattr(self, methname)
             newMethod = partial(method, dbName)
             setattr(self, methname, newMethod)
 
     # Database operations
 
-    def createDB(self, dbName):
+    def createDB(self, dbName, timeout=None):
         """
         Creates a new database on the server.
 
@@ -228,10 +564,10 @@ class CouchDB(object):
         # characters (a-z), digits (0-9), and any of the characters _, $, (,
         # ), +, -, and / are allowed. Must begin with a letter."}
 
-        return self.put("/%s/" % (_namequote(dbName), ), "", descr='CreateDB'
-            ).addCallback(self.parseResult)
+        return self.put("/%s/" % (_namequote(dbName), ), "", descr='CreateDB',
+            timeout=timeout).addCallback(self.parseResult)
 
-    def cleanDB(self, dbName):
+    def cleanDB(self, dbName, timeout=None):
         """
         Clean old view indexes for the database on the server.
 
@@ -239,10 +575,10 @@ class CouchDB(object):
         """
         # Responses: 200, 404 Object Not Found
         return self.post("/%s/_view_cleanup" % (_namequote(dbName), ), "",
-        descr='cleanDB'
+        descr='cleanDB', timeout=timeout
             ).addCallback(self.parseResult)
 
-    def compactDB(self, dbName):
+    def compactDB(self, dbName, timeout=None):
         """
         Compacts the database on the server.
 
@@ -250,10 +586,10 @@ class CouchDB(object):
         """
         # Responses: 202 Accepted, 404 Object Not Found
         return self.post("/%s/_compact" % (_namequote(dbName), ), "",
-            descr='compactDB'
+            descr='compactDB', timeout=timeout
             ).addCallback(self.parseResult)
 
-    def compactDesignDB(self, dbName, designName):
+    def compactDesignDB(self, dbName, designName, timeout=None):
         """
         Compacts the database on the server.
 
@@ -262,41 +598,79 @@ class CouchDB(object):
         """
         # Responses: 202 Accepted, 404 Object Not Found
         return self.post("/%s/_compact/%s" % (_namequote(dbName), designName),
-            "", descr='compactDesignDB'
+            "", descr='compactDesignDB', timeout=timeout
             ).addCallback(self.parseResult)
 
 
-    def deleteDB(self, dbName):
+    def deleteDB(self, dbName, timeout=None):
         """
         Deletes the database on the server.
 
         @type  dbName: str
         """
         # Responses: {u'ok': True}, 404 Object Not Found
-        return self.delete("/%s/" % (_namequote(dbName), )
-            ).addCallback(self.parseResult)
+        return self.delete("/%s/" % (_namequote(dbName), ), descr='deleteDB',
+            timeout=timeout).addCallback(self.parseResult)
 
-    def listDB(self):
+    def listDB(self, timeout=None):
         """
         List the databases on the server.
         """
         # Responses: list of db names
-        return self.get("/_all_dbs", descr='listDB').addCallback(
-            self.parseResult)
+        return self.get("/_all_dbs", descr='listDB',
+            timeout=timeout).addCallback(self.parseResult)
 
-    def getVersion(self):
+    def getVersion(self, timeout=None):
         """
         Returns the couchDB version.
         """
         # Responses: {u'couchdb': u'Welcome', u'version': u'1.1.0'}
         # Responses: {u'couchdb': u'Welcome', u'version': u'1.1.1a1162549'}
-        d = self.get("/", descr='version').addCallback(self.parseResult)
+        d = self.get("/", descr='version', timeout=timeout).addCallback(
+            self.parseResult)
 
         def cacheVersion(result):
             self.version = self._parseVersion(result['version'])
             return result
         return d.addCallback(cacheVersion)
 
+    def warmup(self, connections=None, timeout=None):
+        """
+        Get ready to serve traffic: open connections to the server ahead of
+        time, and get and cache its version.
+
+        When authenticating with a session cookie, the session is logged in
+        first, so the first requests do not wait for it either.
+
+        @param connections: the number of connections to open; by default,
+                            as many as the pool keeps open per server.
+                            Connections beyond that are closed again.
+        @type  connections: C{int}
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing with the version of the server once all
+                  connections are open.
+        """
+        if connections is None:
+            connections = getattr(self.pool, 'maxPersistentPerHost', 1)
+
+        def warm(_):
+            # requests in flight together each take a connection of their
+            # own, which goes back to the pool afterwards
+            dl = [self.getVersion(timeout=timeout)]
+            for i in range(connections - 1):
+                dl.append(self._getPage("/", method="HEAD", isJson=False,
+                    priority='interactive', timeout=timeout))
+            d = defer.gatherResults(dl, consumeErrors=True)
+            d.addCallbacks(lambda _: self.version, _firstError)
+            return d
+
+        if self.username and self._cookieAuth:
+            d = self.getSession()
+        else:
+            d = defer.succeed(None)
+        return d.addCallback(warm)
+
     def _parseVersion(self, versionString):
 
         def onlyInt(part):
@@ -310,21 +684,43 @@ class CouchDB(object):
         ret = tuple(onlyInt(_) for _ in versionString.split('.'))
         return ret
 
-    def infoDB(self, dbName):
+    def infoDB(self, dbName, timeout=None):
         """
         Returns info about the couchDB.
         """
         # Responses: {u'update_seq': 0, u'db_name': u'mydb', u'doc_count': 0}
         # 404 Object Not Found
-        return self.get("/%s/" % (_namequote(dbName), ), descr='infoDB'
-            ).addCallback(self.parseResult)
+        d = self.get("/%s/" % (_namequote(dbName), ), descr='infoDB',
+            timeout=timeout).addCallback(self.parseResult)
+        if self._viewCache is not None:
+
+            def advance(info):
+                self._viewCache.advance(self.cacheNamespace(dbName),
+                    info.get('update_seq'))
+                return info
+            d.addCallback(advance)
+        return d
 
     # Document operations
 
     def listDoc(self, dbName, reverse=False, startkey=None, endkey=None,
-                include_docs=False, limit=-1, **obsolete):
+                include_docs=False, limit=-1, rowCallback=None,
+                headerCallback=None, timeout=None, priority='default',
+                **obsolete):
         """
         List all documents in a given database.
+
+        @param rowCallback:    if specified, stream the response: every row is
+                               passed to this callable as soon as it arrives,
+                               and the deferred fires with the response
+                               without its rows.
+        @type  rowCallback:    callable
+        @param headerCallback: if streaming, called with the total_rows,
+                               offset and update_seq received before the
+                               first row.
+        @type  headerCallback: callable
+        @param priority:       the priority to schedule the request with.
+        @type  priority:       C{str}
         """
         # Responses: {u'rows': [{u'_rev': -1825937535, u'_id': u'mydoc'}],
         # u'view': u'_all_docs'}, 404 Object Not Found
@@ -351,9 +747,16 @@ class CouchDB(object):
             args["limit"] = int(limit)
         if args:
             uri += "?%s" % (urlencode(args), )
-        return self.get(uri, descr='listDoc').addCallback(self.parseResult)
+        if rowCallback:
+            return self.get(uri, descr='listDoc',
+                receiverFactory=self._rowReceiverFactory(
+                    rowCallback, headerCallback), priority=priority,
+                timeout=timeout)
+        return self.get(uri, descr='listDoc', priority=priority,
+            timeout=timeout).addCallback(self.parseResult)
 
-    def openDoc(self, dbName, docId, revision=None, full=False, attachment=""):
+    def openDoc(self, dbName, docId, revision=None, full=False, attachment="",
+                timeout=None, priority='default'):
         """
         Open a document in a given database.
 
@@ -369,11 +772,14 @@ class CouchDB(object):
         @param attachment: if specified, return the named attachment from the
             document.
         @type attachment: C{str}
+
+        @param priority: the priority to schedule the request with.
+        @type priority: C{str}
         """
         # Responses: {u'_rev': -1825937535, u'_id': u'mydoc', ...}
         # 404 Object Not Found
 
-        docIdUri = docId.encode('utf-8')
+        docIdUri = docId
         # on special url's like _design and _local no slash encoding is needed,
         # and doing so would hit a 301 redirect
         if not docIdUri.startswith('_'):
@@ -387,22 +793,140 @@ class CouchDB(object):
         elif attachment:
             uri += "/%s" % quote(attachment)
             # No parsing
-            return self.get(uri, descr='openDoc', isJson=False)
+            return self.get(uri, descr='openDoc', isJson=False,
+                priority=priority, timeout=timeout)
 
         # just the document
         if self._cache:
+            namespace = self.cacheNamespace(dbName)
             try:
-                return self._cache.get(docId)
+                return self._cache.get(docId, namespace)
+            except StaleEntry as e:
+                return self._revalidate(uri, dbName, docId, e, timeout,
+                    priority)
             except:
                 pass
 
-        return self.get(uri, descr='openDoc').addCallback(
-            self.parseResult).addCallback(
-            self._cacheResult, docId)
+        return self.get(uri, descr='openDoc', priority=priority,
+            timeout=timeout).addCallback(self.parseResult).addCallback(
+            self._cacheResult, dbName, docId)
+
+    def _revalidate(self, uri, dbName, docId, stale, timeout, priority):
+        """
+        Get a document again unless it is still at the cached revision,
+        with a conditional C{GET}.
+
+        @type stale: L{StaleEntry}
+        """
+        # twisted.web.error imports reactor
+        from twisted.web import error as tw_error
+
+        self.log.debug("[%s:%s%s] GET %s if not %s",
+                       self.host, self.port, _ShortPrint(uri), 'openDoc',
+                       stale.etag)
+        d = self._getPage(uri, method="GET",
+            headers={'If-None-Match': [stale.etag]}, descr='openDoc',
+            priority=priority, timeout=timeout)
+        d.addCallback(self.parseResult)
+        d.addCallback(self._cacheResult, dbName, docId)
+
+        def notModified(failure):
+            failure.trap(tw_error.PageRedirect)
+            if failure.value.status != b'304':
+                return failure
+            return self._cache.revalidated(docId, stale.value,
+                self.cacheNamespace(dbName))
+        d.addErrback(notModified)
+        return d
+
+    def openDocs(self, dbName, docIds, timeout=None, priority='default'):
+        """
+        Open documents in a given database.
+
+        Documents in the cache are served from it; all other documents are
+        fetched in one request and stored in the cache.
 
-    def _cacheResult(self, value, docId):
+        @type docIds: C{list} of C{unicode}
+        @param priority: the priority to schedule the request with.
+        @type priority: C{str}
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing a list with a result per document id,
+                  in the order of C{docIds}; either
+                  {'id': ..., 'rev': ..., 'doc': ...}, or
+                  {'id': ..., 'error': 'not_found'} for missing documents, or
+                  {'id': ..., 'rev': ..., 'error': 'deleted'} for deleted ones.
+        """
+        # Responses: {'total_rows': 2, 'offset': 0, 'rows': [
+        #   {'id': 'a', 'key': 'a', 'value': {'rev': '1-...'},
+        #    'doc': {'_id': 'a', '_rev': '1-...'}},
+        #   {'id': 'b', 'key': 'b', 'value': {'rev': '2-...', 'deleted': True},
+        #    'doc': None},
+        #   {'key': 'c', 'error': 'not_found'}]}
+        hits = {}
+        misses = []
+        seen = set()
+        namespace = self.cacheNamespace(dbName)
+        for docId in docIds:
+            if docId in seen:
+                continue
+            seen.add(docId)
+            if self._cache:
+                try:
+                    hits[docId] = self._cache.get(docId, namespace)
+                    continue
+                except KeyError:
+                    pass
+            misses.append(docId)
+
+        def fetchCb(result):
+            fetched = {}
+            for row in result['rows']:
+                if 'error' in row:
+                    fetched[row['key']] = {
+                        'id': row['key'], 'error': row['error']}
+                elif row['value'].get('deleted', False):
+                    fetched[row['key']] = {
+                        'id': row['id'], 'rev': row['value']['rev'],
+                        'error': 'deleted'}
+                else:
+                    self._cacheResult(row['doc'], dbName, row['id'])
+                    fetched[row['key']] = {
+                        'id': row['id'], 'rev': row['value']['rev'],
+                        'doc': row['doc']}
+                    continue
+                # a stale cached copy is not served anymore
+                if self._cache:
+                    self._cache.delete(row['key'], namespace)
+            return fetched
+
+        if misses:
+            d = self.post("/%s/_all_docs?include_docs=true" % (
+                _namequote(dbName), ), json.dumps({'keys': misses}),
+                descr='openDocs', priority=priority, idempotent=True,
+                timeout=timeout)
+            d.addCallback(self.parseResult)
+            d.addCallback(fetchCb)
+        else:
+            d = defer.succeed({})
+
+        hitIds = list(hits.keys())
+        d = defer.gatherResults([d] + [hits[docId] for docId in hitIds],
+            consumeErrors=True)
+
+        def gatherCb(results):
+            found = results[0]
+            for docId, doc in zip(hitIds, results[1:]):
+                found[docId] = {
+                    'id': docId, 'rev': doc.get('_rev'), 'doc': doc}
+            return [found[docId] for docId in docIds]
+        d.addCallbacks(gatherCb, _firstError)
+        return d
+
+    def _cacheResult(self, value, dbName, docId):
         if self._cache:
-            self._cache.store(docId, value)
+            self._cache.store(docId, value,
+                namespace=self.cacheNamespace(dbName))
 
         return value
 
@@ -421,7 +945,101 @@ class CouchDB(object):
             data = b64encode(data)
             document["_attachments"][name] = {"type": "base64", "data": data}
 
-    def saveDoc(self, dbName, body, docId=None):
+    def putAttachment(self, dbName, docId, name, data, revision=None,
+                      contentType='application/octet-stream', length=None,
+                      timeout=None):
+        """
+        Upload an attachment to a document, streaming it from a file.
+
+        @param docId:       the document to attach to; created if it does
+                            not exist.
+        @type  docId:       C{unicode}
+        @param name:        the name of the attachment.
+        @type  name:        C{str}
+        @param data:        the file-like object to read the attachment from.
+        @type  data:        C{file}
+        @param revision:    the current revision of the document, if it
+                            exists.
+        @type  revision:    C{unicode}
+        @param contentType: the content type of the attachment.
+        @type  contentType: C{str}
+        @param length:      the length of the attachment, if the length of
+                            the file cannot be determined by seeking in it.
+        @type  length:      C{int}
+        """
+        # Responses: {'ok': True, 'id': 'mydoc', 'rev': '2-...'}
+        # 409 Conflict (wrong revision)
+        from twisted.web.client import FileBodyProducer
+
+        uri = self._attachmentUri(dbName, docId, name)
+        if revision is not None:
+            uri += "?%s" % (urlencode({"rev": revision}), )
+
+        producer = FileBodyProducer(data)
+        if length is not None:
+            producer.length = length
+
+        self.log.debug("[%s:%s%s] PUT %s",
+                       self.host, self.port, _ShortPrint(uri), 'putAttachment')
+        return self._getPage(uri, method="PUT", postdata=producer,
+            isJson=False, headers={
+                'Content-Type': [contentType],
+                'Accept': ['application/json'],
+            }, timeout=timeout).addCallback(self.parseResult)
+
+    def getAttachment(self, dbName, docId, name, consumer, offset=None,
+                      length=None, timeout=None):
+        """
+        Download an attachment of a document, streaming it to a consumer.
+
+        @param name:     the name of the attachment.
+        @type  name:     C{str}
+        @param consumer: where to write the attachment to, as it arrives.
+        @type  consumer: C{file} or L{twisted.internet.interfaces.IConsumer}
+        @param offset:   if specified, the position to start reading from.
+        @type  offset:   C{int}
+        @param length:   if specified, the number of bytes to read.
+        @type  length:   C{int}
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing the number of bytes written, or failing
+                  with L{paisley.stream.RangeMismatch} if the server did not
+                  send the part of the attachment asked for.
+        """
+        # Responses: 200, 206 Partial Content for ranges
+        # 404 Object Not Found, 416 Requested Range Not Satisfiable
+        from paisley.stream import BodyReceiver
+
+        headers = {'Accept': ['*/*']}
+        contentRange = None
+        if offset is not None or length is not None:
+            offset = offset or 0
+            end = None
+            if length is not None:
+                end = offset + length - 1
+            contentRange = (offset, end)
+            headers['Range'] = ['bytes=%d-%s' % (
+                offset, end if end is not None else '')]
+
+        uri = self._attachmentUri(dbName, docId, name)
+        self.log.debug("[%s:%s%s] GET %s",
+                       self.host, self.port, _ShortPrint(uri), 'getAttachment')
+        return self._getPage(uri, method="GET", isJson=False,
+            headers=headers,
+            receiverFactory=partial(BodyReceiver, consumer=consumer,
+                contentRange=contentRange),
+            timeout=timeout)
+
+    def _attachmentUri(self, dbName, docId, name):
+        # on special url's like _design and _local no slash encoding is needed,
+        # and doing so would hit a 301 redirect
+        docIdUri = docId
+        if not docIdUri.startswith('_'):
+            docIdUri = _namequote(docIdUri)
+        return "/%s/%s/%s" % (_namequote(dbName), docIdUri, quote(name))
+
+    def saveDoc(self, dbName, body, docId=None, timeout=None,
+                priority='default'):
         """
         Save/create a document to/in a given database.
 
@@ -429,10 +1047,13 @@ class CouchDB(object):
         @type dbName: C{str}
 
         @param body: content of the document.
-        @type body: C{str} or any structured object
+        @type body: C{str}, C{bytes} of encoded JSON, or any structured object
 
         @param docId: if specified, the identifier to be used in the database.
         @type docId: C{unicode}
+
+        @param priority: the priority to schedule the request with.
+        @type priority: C{str}
         """
         # Responses: {'rev': '1-9dd776365618752ddfaf79d9079edf84',
         #             'ok': True, 'id': '198abfee8852816bc112992564000295'}
@@ -440,18 +1061,24 @@ class CouchDB(object):
         # 404 Object not found (if database does not exist)
         # 409 Conflict, 500 Internal Server Error
 
-        if not isinstance(body, str):
+        # updating a given revision can be retried: if the first attempt
+        # went through, the retry gets a conflict instead of a second update
+        idempotent = False
+        if not isinstance(body, (str, bytes)):
+            idempotent = '_rev' in body
             body = json.dumps(body)
         if docId is not None:
             d = self.put("/%s/%s" % (_namequote(dbName),
                 _namequote(docId.encode('utf-8'))),
-                body, descr='saveDoc')
+                body, descr='saveDoc', priority=priority,
+                idempotent=idempotent, timeout=timeout)
         else:
             d = self.post("/%s/" % (_namequote(dbName), ), body,
-                descr='saveDoc')
+                descr='saveDoc', priority=priority, timeout=timeout)
         return d.addCallback(self.parseResult)
 
-    def deleteDoc(self, dbName, docId, revision):
+    def deleteDoc(self, dbName, docId, revision, timeout=None,
+                  priority='default'):
         """
         Delete a document on given database.
 
@@ -464,6 +1091,8 @@ class CouchDB(object):
         @param revision: the revision of the document to delete.
         @type  revision: C{unicode}
 
+        @param priority: the priority to schedule the request with.
+        @type  priority: C{str}
         """
         # Responses: {u'_rev': 1469561101, u'ok': True}
         # 500 Internal Server Error
@@ -471,14 +1100,127 @@ class CouchDB(object):
         return self.delete("/%s/%s?%s" % (
                 _namequote(dbName),
                 _namequote(docId.encode('utf-8')),
-                urlencode({'rev': revision.encode('utf-8')}))).addCallback(
-                    self.parseResult)
+                urlencode({'rev': revision.encode('utf-8')})),
+                descr='deleteDoc', priority=priority,
+                timeout=timeout).addCallback(self.parseResult)
+
+    # Bulk document operations
+
+    def saveDocs(self, dbName, docs, chunkSize=BULK_CHUNK_SIZE,
+                 chunkBytes=BULK_CHUNK_BYTES, concurrency=BULK_CONCURRENCY,
+                 priority='bulk', timeout=None):
+        """
+        Save/create documents to/in a given database using _bulk_docs.
+
+        The documents are sent in chunks of at most C{chunkSize} documents
+        and approximately C{chunkBytes} bytes of JSON; a single document
+        larger than C{chunkBytes} is sent in a chunk of its own.
+
+        @param dbName:      identifier of the database.
+        @type  dbName:      C{str}
+        @param docs:        the documents to save; documents without an _id
+                            get one assigned by the server.
+        @type  docs:        C{list} of C{str}, C{bytes} or structured objects
+        @param chunkSize:   the maximum number of documents per request.
+        @type  chunkSize:   C{int}
+        @param chunkBytes:  the approximate maximum request body size.
+        @type  chunkBytes:  C{int}
+        @param concurrency: the maximum number of requests in flight.
+        @type  concurrency: C{int}
+        @param priority:    the priority to schedule the requests with.
+        @type  priority:    C{str}
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing a list with a result per document,
+                  in the order of C{docs}; either {'id': ..., 'rev': ...}
+                  or {'id': ..., 'error': ..., 'reason': ...}.  When the
+                  request of a chunk fails, each of its documents gets the
+                  error of the response, or 'request_failed'; such
+                  documents may or may not have been saved.
+        """
+        # Responses: [{'id': '1', 'rev': '1-967a00dff5e02add41819138abb3284d'},
+        #             {'id': '2', 'error': 'conflict',
+        #              'reason': 'Document update conflict.'}]
+        # 400 Bad Request, 417 Expectation Failed (all_or_nothing)
+        encoded = []
+        for doc in docs:
+            if not isinstance(doc, (str, bytes)):
+                doc = json.dumps(doc)
+            if isinstance(doc, str):
+                doc = doc.encode('utf-8')
+            encoded.append(doc)
+
+        uri = "/%s/_bulk_docs" % (_namequote(dbName), )
+        semaphore = defer.DeferredSemaphore(concurrency)
+
+        def postChunk(chunk):
+            body = b'{"docs": [' + b', '.join(chunk) + b']}'
+            d = self.post(uri, body, descr='saveDocs', priority=priority,
+                timeout=timeout).addCallback(self.parseResult)
+            # the results of the other chunks are not lost
+            return d.addErrback(_chunkFailed, chunk)
+
+        dl = [semaphore.run(postChunk, chunk)
+              for chunk in _chunkDocs(encoded, chunkSize, chunkBytes)]
+
+        d = defer.gatherResults(dl, consumeErrors=True)
+
+        def gatherCb(results):
+            ret = []
+            for result in results:
+                ret.extend(result)
+            return ret
+        d.addCallbacks(gatherCb, _firstError)
+        return d
+
+    def deleteDocs(self, dbName, docs, **kwargs):
+        """
+        Delete documents on given database using _bulk_docs.
+
+        Takes the same keyword arguments as L{saveDocs}.
+
+        @param dbName: identifier of the database.
+        @type  dbName: C{str}
+        @param docs:   the documents to delete, as dicts with _id and _rev, or
+                       as (docId, revision) tuples.
+        @type  docs:   C{list}
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing a list with a result per document,
+                  in the order of C{docs}.
+        """
+        deleted = []
+        for doc in docs:
+            if isinstance(doc, tuple):
+                docId, revision = doc
+            else:
+                docId, revision = doc['_id'], doc['_rev']
+            deleted.append({'_id': docId, '_rev': revision, '_deleted': True})
+
+        return self.saveDocs(dbName, deleted, **kwargs)
 
     # View operations
 
-    def openView(self, dbName, docId, viewId, **kwargs):
+    def openView(self, dbName, docId, viewId, rowCallback=None,
+                 headerCallback=None, timeout=None, priority='default',
+                 **kwargs):
         """
         Open a view of a document in a given database.
+
+        @param rowCallback:    if specified, stream the response: every row is
+                               passed to this callable as soon as it arrives,
+                               and the deferred fires with the response
+                               without its rows.
+        @type  rowCallback:    callable
+        @param headerCallback: if streaming, called with the total_rows,
+                               offset and update_seq received before the
+                               first row.
+        @type  headerCallback: callable
+        @param priority:       the priority to schedule the request with.
+        @type  priority:       C{str}
+
+        Unless streamed, results are served from the view cache of the
+        client if it has a fresh one.
         """
         # Responses:
         # 500 Internal Server Error (illegal database name)
@@ -499,23 +1241,80 @@ class CouchDB(object):
         for k, v in kwargs.items():
             if k == 'keys': # we do this below, for the full body
                 pass
+            elif k in ('startkey_docid', 'endkey_docid'):
+                # couchdb takes document id's as they are
+                pass
             else:
                 kwargs[k] = json.dumps(v)
         # we keep the paisley API, but couchdb uses limit now
         if 'count' in kwargs:
             kwargs['limit'] = kwargs.pop('count')
 
-        # If there's a list of keys to send, POST the
-        # query so that we can upload the keys as the body of
-        # the POST request, otherwise use a GET request
-        if body:
-            return self.post(
-                buildUri(), body=body, descr='openView').addCallback(
-                    self.parseResult)
-        else:
-            return self.get(
-                buildUri(), descr='openView').addCallback(
-                    self.parseResult)
+        def fetch(receiverFactory=None):
+            # If there's a list of keys to send, POST the
+            # query so that we can upload the keys as the body of
+            # the POST request, otherwise use a GET request
+            if body:
+                return self.post(buildUri(), body=body, descr='openView',
+                    receiverFactory=receiverFactory, priority=priority,
+                    idempotent=True, timeout=timeout)
+            return self.get(buildUri(), descr='openView',
+                receiverFactory=receiverFactory, priority=priority,
+                timeout=timeout)
+
+        if rowCallback:
+            return fetch(self._rowReceiverFactory(
+                rowCallback, headerCallback))
+
+        if self._viewCache is not None:
+            key = (docId, viewId, tuple(sorted(kwargs.items())), body)
+            # results are stored with the update_seq they were computed at
+            withSeq = 'update_seq' in kwargs
+            kwargs['update_seq'] = 'true'
+            return self._openCachedView(dbName, key, fetch, withSeq)
+
+        return fetch().addCallback(self.parseResult)
+
+    def _openCachedView(self, dbName, key, fetch, withSeq):
+        namespace = self.cacheNamespace(dbName)
+        try:
+            result, fresh = self._viewCache.get(namespace, key)
+        except KeyError:
+            return self._refreshView(namespace, key, fetch, withSeq)
+
+        if fresh:
+            return defer.succeed(result)
+        if not self._viewCache.staleWhileRefresh:
+            return self._refreshView(namespace, key, fetch, withSeq)
+
+        if (namespace, key) not in self._viewRefreshes:
+            self._viewRefreshes.add((namespace, key))
+            d = self._refreshView(namespace, key, fetch, withSeq)
+
+            def refreshed(result):
+                self._viewRefreshes.discard((namespace, key))
+                if isinstance(result, failure.Failure):
+                    self.log.warning("[%s] refreshing view %s/%s failed: %s",
+                        namespace, key[0], key[1], result.getErrorMessage())
+            d.addBoth(refreshed)
+        return defer.succeed(result)
+
+    def _refreshView(self, namespace, key, fetch, withSeq):
+        d = fetch().addCallback(self.parseResult)
+
+        def store(result):
+            seq = result.get('update_seq')
+            if not withSeq:
+                result.pop('update_seq', None)
+            self._viewCache.store(namespace, key, result, seq)
+            return result
+        return d.addCallback(store)
+
+    def _rowReceiverFactory(self, rowCallback, headerCallback=None):
+        # the stream module imports the protocol module, which imports reactor
+        from paisley.stream import RowReceiver
+        return partial(RowReceiver, rowCallback=rowCallback,
+            headerCallback=headerCallback)
 
     def addViews(self, document, views):
         """
@@ -531,35 +1330,27 @@ class CouchDB(object):
         for name, data in views.items():
             document["views"][name] = data
 
-    def tempView(self, dbName, view):
+    def tempView(self, dbName, view, timeout=None):
         """
         Make a temporary view on the server.
         """
-        if not isinstance(view, str):
+        if not isinstance(view, (str, bytes)):
             view = json.dumps(view)
         d = self.post("/%s/_temp_view" % (_namequote(dbName), ), view,
-            descr='tempView')
+            descr='tempView', idempotent=True, timeout=timeout)
         return d.addCallback(self.parseResult)
 
     def getSession(self):
         """
         Get a session from the server using the supplied credentials.
+
+        The session is shared with the other clients of the server with the
+        same credentials, and renewed before it expires as long as it is
+        used.
         """
         self.log.debug("[%s:%s%s] POST %s",
                        self.host, self.port, '_session', 'getSession')
-        postdata = "name=%s&password=%s" % (
-                self.username.encode('utf-8'),
-                self.password.encode('utf-8'))
-        self.log.debug("[%s:%s%s] POST data %s",
-                       self.host, self.port, '_session', 'getSession')
-        d = self._getPage("/_session", method="POST",
-            postdata=postdata,
-            isJson=False,
-            headers={
-                'Content-Type': ['application/x-www-form-urlencodeddata', ],
-                'Accept': ['*/*', ],
-            })
-        d.addCallback(self.parseResult)
+        d = self._getSessionManager().login()
 
         def getSessionCb(result):
             # save the response of getSession, including roles
@@ -572,10 +1363,31 @@ class CouchDB(object):
 
         return d
 
+    def getSessionStats(self):
+        """
+        Return the counters of the session manager; empty without one.
+
+        @rtype: C{dict}
+        @see:   L{paisley.session.SessionManager.stats}
+        """
+        if self._sessionManager is None:
+            return {}
+        return self._sessionManager.stats()
+
+    def _getSessionManager(self):
+        if self._sessionManager is None:
+            from twisted.internet import reactor
+            from paisley.session import getSessionManager
+            self._sessionManager = getSessionManager(self, clock=reactor,
+                timeout=self.timeout)
+        return self._sessionManager
+
     def getSessionRoles(self):
         """
         @rtype: C{list} of C{unicode}
         """
+        if self._sessionManager is not None and self._sessionManager.info:
+            return self._sessionManager.info.get('roles', [])
         if self._session:
             return self._session['roles']
 
@@ -584,25 +1396,102 @@ class CouchDB(object):
     # Basic http methods
 
     def _getPage(self, uri, method="GET", postdata=None, headers=None,
-            isJson=True):
+            isJson=True, receiverFactory=None, priority='default',
+            idempotent=False, reauthenticated=False, descr='',
+            timeout=None):
         """
         C{getPage}-like.
-        """
+
+        Requests that failed in a retryable way are retried by the retry
+        policy if they can safely be done twice: C{GET} and C{HEAD}, C{PUT}
+        and C{DELETE} with a revision in the uri, and any request passing
+        C{idempotent}.  Bodies of L{IBodyProducer}s are never sent twice.
+
+        @param postdata: the body to send.
+        @type  postdata: C{bytes}, C{str} or L{IBodyProducer}
+
+        @param receiverFactory: if specified, called with a deferred to create
+                                the protocol receiving a successful response;
+                                the deferred fires with what the protocol
+                                fires it with.  A C{checkResponse} method
+                                of the protocol is called with the response
+                                before the body is delivered.
+        @param priority:        the priority to schedule the request with.
+        @type  priority:        C{str}
+        @param idempotent:      whether the request can be done twice
+                                without changing its outcome.
+        @type  idempotent:      C{bool}
+        @param reauthenticated: whether this is the request done again after
+                                logging in; it is not done a third time.
+        @type  reauthenticated: C{bool}
+        @param descr:           what the request is for; timeouts are
+                                counted per descr.
+        @type  descr:           C{str}
+        @param timeout:         the number of seconds after which the
+                                request is cancelled and fails with
+                                L{RequestTimeout}, including retries and
+                                logging in; None for the timeout of the
+                                client, 0 for no timeout.  Streamed
+                                requests, with a receiverFactory or an
+                                L{IBodyProducer}, take as long as their
+                                body does, so they only get a timeout
+                                passed explicitly.
+        @type  timeout:         C{float}
+        """
+        if timeout is None and not receiverFactory and \
+                not IBodyProducer.providedBy(postdata):
+            timeout = self.timeout
+        if timeout:
+            d = self._getPage(uri, method, postdata, headers, isJson,
+                receiverFactory, priority, idempotent, reauthenticated,
+                descr, 0)
+            return self._deadline(d, timeout, descr or method)
 
         def cb_recv_resp(response):
-            d_resp_recvd = Deferred()
+            receivers = []
+
+            def cancel(d):
+                # stop the delivery of the body
+                if receivers and receivers[0].transport is not None:
+                    receivers[0].transport.stopProducing()
+
+            def deliver(protocol):
+                receivers.append(protocol)
+                check = getattr(protocol, 'checkResponse', None)
+                if check is not None:
+                    check(response)
+                if self.compressionPolicy is not None:
+                    protocol = self.compressionPolicy.decoder(response,
+                        protocol)
+                response.deliverBody(protocol)
+
+            d_resp_recvd = Deferred(cancel)
+            if receiverFactory and response.code < 300:
+                deliver(receiverFactory(d_resp_recvd))
+                # the protocol may have handed out part of the body already,
+                # so its failures are passed on instead of retried
+                return d_resp_recvd.addCallbacks(lambda result: (result, None),
+                    lambda f: (f, None))
+
+            # JSON gets parsed straight from the bytes
             content_type = response.headers.getRawHeaders('Content-Type',
                     [''])[0].lower().strip()
-            decode_utf8 = 'charset=utf-8' in content_type or \
-                    content_type == 'application/json'
-            response.deliverBody(ResponseReceiver(d_resp_recvd,
+            decode_utf8 = not isJson and (
+                'charset=utf-8' in content_type or \
+                content_type == 'application/json')
+            deliver(ResponseReceiver(d_resp_recvd,
                 decode_utf8=decode_utf8))
-            return d_resp_recvd.addCallback(cb_process_resp, response)
+            return d_resp_recvd.addCallback(lambda body: (body, response))
 
-        def cb_process_resp(body, response):
+        def cb_process_resp(result):
             # twisted.web.error imports reactor
             from twisted.web import error as tw_error
 
+            body, response = result
+            if response is None:
+                # received by the receiverFactory protocol
+                return body
+
             # Emulate HTTPClientFactory and raise t.w.e.Error
             # and PageRedirect if we have errors.
             if response.code > 299 and response.code < 400:
@@ -619,13 +1508,27 @@ class CouchDB(object):
                     except:
                         pass
 
-                if response.code == 401 or error == 'unauthorized':
-                    if self._authenticator:
+                if (response.code == 401 or error == 'unauthorized') and \
+                        not reauthenticated:
+                    d = None
+                    if cookie is not None:
+                        # requests rejected together wait for one login
+                        self.log.debug("401, renewing session")
+                        d = self._sessionManager.renew(cookie)
+                    elif self._authenticator:
                         self.log.debug("401, authenticating")
                         d = self._authenticator.authenticate(self)
-                        d.addCallback(lambda _: self._startLC())
+                    if d is not None and IBodyProducer.providedBy(postdata):
+                        # the body has been read already, so it cannot be
+                        # sent again; later requests use the new login
+                        error = tw_error.Error(response.code, body)
+                        d.addCallback(lambda _: failure.Failure(error))
+                        return d
+                    if d is not None:
                         d.addCallback(lambda _: self._getPage(
-                            uri, method, postdata, headers, isJson))
+                            uri, method, postdata, headers, isJson,
+                            receiverFactory, priority, idempotent, True,
+                            descr, 0))
                         return d
 
             if response.code > 399:
@@ -633,79 +1536,298 @@ class CouchDB(object):
 
             return body
 
-        url = uri.encode('utf-8')
+        cookie = None
+        if self.username and self._cookieAuth:
+            manager = self._getSessionManager()
+            cookie = manager.getCookie()
+            if cookie is None:
+                if reauthenticated:
+                    # logged in, but the session is over already
+                    return defer.fail(AuthenticationError(
+                        'Session expired right after logging in'))
+                # requests arriving meanwhile wait for the same login
+                d = manager.login()
+                d.addCallback(lambda _: self._getPage(uri, method, postdata,
+                    headers, isJson, receiverFactory, priority, idempotent,
+                    True, descr, 0))
+                return d
+
+        prepared = self._prepareHeaders(headers, isJson, cookie)
+
+        key = None
+        if self._coalesce and method == "GET" and not receiverFactory:
+            key = (uri, prepared.key())
+            if key in self._inFlight:
+                self.coalesced += 1
+                return self._joinInFlight(key)
+
+        if IBodyProducer.providedBy(postdata):
+            body = postdata
+            idempotent = False
+        else:
+            body = None
+            if postdata:
+                if isinstance(postdata, str):
+                    postdata = postdata.encode('utf-8')
+                sent = postdata
+                if self.compressionPolicy is not None and \
+                        'Content-Encoding' not in prepared.headers:
+                    encoding = {}
+                    sent = self.compressionPolicy.compress(postdata,
+                        encoding)
+                    if encoding:
+                        prepared = prepared.added(encoding)
+                body = StringProducer(sent)
+            if method in ("GET", "HEAD"):
+                idempotent = True
+            elif method in ("PUT", "DELETE") and \
+                    'rev=' in uri.partition('?')[2]:
+                idempotent = True
+
+        read = method in ("GET", "HEAD") or (method == "POST" and idempotent)
+        # agents take the method as bytes
+        rawMethod = method.encode('ascii')
+
+        def attempt():
+            # every attempt is routed anew, so a retry can go elsewhere
+            prefix, route = self._route(read)
+            url = prefix + uri.encode('utf-8')
+
+            def request():
+                d = self.client.request(rawMethod, url, prepared.raw, body)
+                d.addCallback(cb_recv_resp)
+                return self._track(route, d)
+
+            # the slot is held until the body is received, and given back
+            # before waiting to retry or authenticating
+            return self.scheduler.submit(request, route, priority)
+
+        if read and self.hedgePolicy is not None and not receiverFactory:
+            # streamed rows of both copies would be handed out
+            unhedged = attempt
+            attempt = lambda: self.hedgePolicy.call(unhedged)
+
+        if idempotent:
+            d = self.retryPolicy.call(attempt)
+        else:
+            d = attempt()
+        d.addCallback(cb_process_resp)
+
+        if key:
+            # the first caller waits like the others, so the deadline of
+            # any of them only cancels the request when none is left
+            waiters = []
+            self._inFlight[key] = (d, waiters)
+            waiter = self._joinInFlight(key)
+            d.addBoth(self._leaveInFlight, key, waiters)
+            return waiter
 
-        if not headers:
-            headers = {}
+        return d
+
+    def _route(self, read):
+        """
+        Choose where to send a request to.
+
+        @param read: whether the request only reads.
+        @type  read: C{bool}
+
+        @rtype:   C{tuple}
+        @returns: the encoded url prefix to build the url with, and the key
+                  to schedule the request under.
+        """
+        return self.url_prefix, (self.host, self.port)
+
+    def _prepareHeaders(self, headers, isJson, cookie=None):
+        """
+        Return the headers to send a request with.
+
+        The headers every request gets are prepared once; requests that
+        add none of their own share them as they are.
 
+        @param headers: the headers of this request, if any.
+        @type  headers: C{dict} of C{str} -> C{list}
+        @param cookie:  the session cookie to send.
+        @type  cookie:  C{str}
+
+        @rtype: L{_PreparedHeaders}
+        """
+        authorization = self._getAuthorization()
+        cacheKey = (isJson, authorization, cookie, self.compressionPolicy)
+        if not headers:
+            prepared = self._preparedHeaders.get(cacheKey)
+            if prepared is None:
+                if len(self._preparedHeaders) > 8:
+                    # sessions were renewed
+                    self._preparedHeaders.clear()
+                prepared = _PreparedHeaders(self._buildHeaders({}, isJson,
+                    authorization, cookie))
+                self._preparedHeaders[cacheKey] = prepared
+            return prepared
+
+        return _PreparedHeaders(self._buildHeaders(dict(headers), isJson,
+            authorization, cookie))
+
+    def _buildHeaders(self, headers, isJson, authorization, cookie):
         if isJson:
             headers["Accept"] = ["application/json"]
             headers["Content-Type"] = ["application/json"]
 
         headers["User-Agent"] = ["paisley"]
 
-        url = (self.url_template % (uri,)).encode('utf-8')
+        if self.compressionPolicy is not None:
+            self.compressionPolicy.requestHeaders(headers)
 
-        if self.username:
-            headers["Authorization"] = ["Basic %s" % b64encode(
-                "%s:%s" % (self.username, self.password))]
+        if authorization:
+            headers["Authorization"] = [authorization]
+        if cookie:
+            headers["Cookie"] = [cookie]
+        return headers
 
-        body = StringProducer(postdata) if postdata else None
+    def _getAuthorization(self):
+        """
+        Return the Basic Authorization header for the credentials, or None
+        when authenticating with a session cookie.
 
-        d = self.client.request(method, url, Headers(headers), body)
+        Computed again only when the credentials change.
+        """
+        if not self.username or self._cookieAuth:
+            return None
+
+        credentials = (self.username, self.password)
+        if self._authorization is None or \
+                self._authorization[0] != credentials:
+            encoded = ("%s:%s" % credentials).encode('utf-8')
+            self._authorization = (credentials,
+                "Basic %s" % (b64encode(encoded).decode('ascii'), ))
+        return self._authorization[1]
+
+    def _deadline(self, d, timeout, descr):
+        """
+        Cancel the request of C{d} if it did not complete within C{timeout}
+        seconds.
 
-        d.addCallback(cb_recv_resp)
+        Cancelling stops the request wherever it is: waiting in the
+        scheduler or for a retry, being sent, or receiving its body, in
+        which case the connection is closed.  While it is cancelled,
+        C{_expiring} is set, so that L{_track} can tell requests that
+        timed out from requests cancelled for other reasons.
 
+        @rtype: L{defer.Deferred}
+        """
+
+        def expire():
+            self._expiring += 1
+            try:
+                d.cancel()
+            finally:
+                self._expiring -= 1
+        call = self._clock.callLater(timeout, expire)
+
+        def done(result):
+            if call.active():
+                call.cancel()
+            elif isinstance(result, failure.Failure) and \
+                    result.check(defer.CancelledError):
+                self.timeouts[descr] = self.timeouts.get(descr, 0) + 1
+                self.log.debug("[%s:%s] %s timed out after %s seconds",
+                               self.host, self.port, descr, timeout)
+                raise RequestTimeout(descr, timeout)
+            return result
+        return d.addBoth(done)
+
+    def _track(self, route, d):
+        """
+        Follow a request sent to C{route}, until its body is received.
+
+        @param d: the deferred firing with the received response.
+
+        @rtype: L{defer.Deferred}
+        """
         return d
 
-    def _startLC(self):
-        self.log.debug("startLC")
-        # start a looping call to keep us authenticated with cookies
-        if self._authLC:
-            self._authLC.stop()
+    def _joinInFlight(self, key):
+        """
+        Return a deferred firing with the body of the identical request
+        in flight.
+
+        Cancelling the deferred only stops waiting; the request itself is
+        cancelled once nobody waits for it anymore.
+        """
+        request, waiters = self._inFlight[key]
+
+        def cancel(d):
+            waiters.remove(d)
+            if not waiters:
+                if self._inFlight.get(key, (None, None))[1] is waiters:
+                    del self._inFlight[key]
+                request.cancel()
 
-        def loop():
-            self.log.debug('looping authentication')
-            self.get('')
+        d = Deferred(cancel)
+        waiters.append(d)
+        return d
 
-        # FIXME: can we query this value instead ?
-        AUTH_WINDOW = 300 # half of default
-        self._authLC = task.LoopingCall(loop)
-        self._authLC.start(AUTH_WINDOW)
+    def _leaveInFlight(self, result, key, waiters):
+        if self._inFlight.get(key, (None, None))[1] is waiters:
+            del self._inFlight[key]
+        while waiters:
+            waiter = waiters.pop(0)
+            if isinstance(result, failure.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+        # the waiters handled the failure, if any
+        return None
 
-    def get(self, uri, descr='', isJson=True):
+    def get(self, uri, descr='', isJson=True, receiverFactory=None,
+            priority='default', timeout=None):
         """
         Execute a C{GET} at C{uri}.
         """
         self.log.debug("[%s:%s%s] GET %s",
-                       self.host, self.port, short_print(uri), descr)
-        return self._getPage(uri, method="GET", isJson=isJson)
+                       self.host, self.port, _ShortPrint(uri), descr)
+        return self._getPage(uri, method="GET", isJson=isJson,
+            receiverFactory=receiverFactory, priority=priority, descr=descr,
+            timeout=timeout)
 
-    def post(self, uri, body, descr=''):
+    def post(self, uri, body, descr='', receiverFactory=None,
+             priority='default', idempotent=False, timeout=None):
         """
         Execute a C{POST} of C{body} at C{uri}.
+
+        @type body: C{bytes}, or C{str} to be sent encoded as UTF-8.
+        @param idempotent: whether the C{POST} only reads, and can be retried.
         """
         self.log.debug("[%s:%s%s] POST %s: %s",
-                      self.host, self.port, short_print(uri), descr,
-                      short_print(repr(body)))
-        return self._getPage(uri, method="POST", postdata=body)
+                      self.host, self.port, _ShortPrint(uri), descr,
+                      _ShortPrint(body, useRepr=True))
+        return self._getPage(uri, method="POST", postdata=body,
+            receiverFactory=receiverFactory, priority=priority,
+            idempotent=idempotent, descr=descr, timeout=timeout)
 
-    def put(self, uri, body, descr=''):
+    def put(self, uri, body, descr='', priority='default', idempotent=False,
+            timeout=None):
         """
         Execute a C{PUT} of C{body} at C{uri}.
+
+        @type body: C{bytes}, or C{str} to be sent encoded as UTF-8.
+        @param idempotent: whether the body carries the revision it updates,
+                           and can be retried.
         """
         self.log.debug("[%s:%s%s] PUT %s: %s",
-                       self.host, self.port, short_print(uri), descr,
-                       short_print(repr(body)))
-        return self._getPage(uri, method="PUT", postdata=body)
+                       self.host, self.port, _ShortPrint(uri), descr,
+                       _ShortPrint(body, useRepr=True))
+        return self._getPage(uri, method="PUT", postdata=body,
+            priority=priority, idempotent=idempotent, descr=descr,
+            timeout=timeout)
 
-    def delete(self, uri, descr=''):
+    def delete(self, uri, descr='', priority='default', timeout=None):
         """
         Execute a C{DELETE} at C{uri}.
         """
         self.log.debug("[%s:%s%s] DELETE %s",
-                       self.host, self.port, short_print(uri), descr)
-        return self._getPage(uri, method="DELETE")
+                       self.host, self.port, _ShortPrint(uri), descr)
+        return self._getPage(uri, method="DELETE", priority=priority,
+            descr=descr, timeout=timeout)
 
     # map to an object
 
@@ -716,7 +1838,7 @@ class CouchDB(object):
         # return cached version if in cache
 
         try:
-            return self._cache.getObject(docId)
+            return self._cache.getObject(docId, self.cacheNamespace(dbName))
         except (KeyError, AttributeError):
             # KeyError when docId does not exist
             # AttributeError when we don't have a cache
@@ -725,19 +1847,35 @@ class CouchDB(object):
             def cb(doc):
                 obj = objectFactory(*args, **kwargs)
                 obj.fromDict(doc)
-                self.mapped(docId, obj)
+                self.mapped(docId, obj, dbName)
                 return obj
             d.addCallback(cb)
             return d
 
-    def mapped(self, key, obj):
+    def mapped(self, key, obj, dbName=None):
+        """
+        Cache C{obj} as mapped from the document C{key} of C{dbName}.
+
+        @param dbName: the database of the document; if not specified, the
+                       object is cached without a namespace, like
+                       L{Cache.mapped} does.
+        @type  dbName: C{str}
+        """
         if self._cache:
-            self._cache.mapped(key, obj)
+            namespace = None
+            if dbName is not None:
+                namespace = self.cacheNamespace(dbName)
+            self._cache.mapped(key, obj, namespace)
 
 
 class Cache(object):
+    """
+    Keys are document ids, which are only unique within a database; so
+    entries are kept in a namespace, which clients set to
+    L{CouchDB.cacheNamespace} of the database.
+    """
 
-    def store(key, value, operation='post'):
+    def store(key, value, operation='post', namespace=None):
         """
         Store a key/value pair in the cache.
 
@@ -745,66 +1883,141 @@ class Cache(object):
         @type  key:   C{unicode}
         @param value: the value to be stored
         @type  value: C{object}
+        @param namespace: the namespace of the key
+        @type  namespace: C{str}
 
         @rtype:   L{defer.Deferred}
         @returns: a deferred firing the value on success.
         """
         raise NotImplementedError
 
-    def get(key):
+    def get(key, namespace=None):
         """
         Retrieve a key/value pair from the cache.
 
         @param key:   key to retrieve value with
         @type  key:   C{unicode}
+        @param namespace: the namespace of the key
+        @type  namespace: C{str}
 
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing the value.
+        @raises KeyError:   if the key is not in the cache.
+        @raises StaleEntry: if the value has to be revalidated with the
+                            server before it is used.
+        """
+        raise NotImplementedError
+
+    def revalidated(self, key, value, namespace=None):
+        """
+        Mark the stale value of a key as valid again, after the server
+        answered that it did not change.  Only called by clients after
+        L{get} raised L{StaleEntry}.
+
+        @param key:   key of the value
+        @type  key:   C{unicode}
+        @param value: the stale value, to store again if it is no longer
+                      in the cache.
+        @type  value: C{object}
+        @param namespace: the namespace of the key
+        @type  namespace: C{str}
 
         @rtype:   L{defer.Deferred}
         @returns: a deferred firing the value.
         """
         raise NotImplementedError
 
-    def getObject(key):
+    def getObject(key, namespace=None):
         """
         Retrieve a key/object pair from the cache.
 
         @param key:   key to retrieve value with
         @type  key:   C{unicode}
+        @param namespace: the namespace of the key
+        @type  namespace: C{str}
 
         @rtype:   L{defer.Deferred}
         @returns: a deferred firing the value.
         """
         raise NotImplementedError
 
-    def delete(key):
+    def delete(key, namespace=None):
         """
         Remove a key/value pair from the cache.
 
         @param key:   key to delete value for
         @type  key:   C{unicode}
+        @param namespace: the namespace of the key
+        @type  namespace: C{str}
 
         @rtype:   L{defer.Deferred}
         @returns: a deferred firing True on sucess.
         """
         raise NotImplementedError
 
+    def refresh(self, key, value, namespace=None):
+        """
+        Replace the value of a key with a newer one, if the key is in the
+        cache.  Objects mapped from the old value are removed.
+
+        @param key:   key to replace the value of
+        @type  key:   C{unicode}
+        @param value: the new value
+        @type  value: C{object}
+        @param namespace: the namespace of the key
+        @type  namespace: C{str}
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing whether the value was replaced.
+        """
+        raise NotImplementedError
+
+    def flush(self, namespace):
+        """
+        Remove all values and objects of a namespace from the cache.
+
+        @param namespace: the namespace to flush
+        @type  namespace: C{str}
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing the number of entries removed.
+        """
+        raise NotImplementedError
+
     # FIXME: can I rewrite this so that whether or not we map is pluggable ?
 
-    def mapped(self, key, obj):
+    def mapped(self, key, obj, namespace=None):
         raise NotImplementedError
 
     def getMapped(self, key):
         raise NotImplementedError
 
 
+class StaleEntry(KeyError):
+    """
+    Raised by L{Cache.get} for a value that has to be revalidated: the
+    server is asked for it with the ETag, and answers with the new value,
+    or that it did not change.
+
+    @ivar value: the cached value.
+    @ivar etag:  the ETag of the value.
+    @type etag:  C{str}
+    """
+
+    def __init__(self, key, value, etag):
+        KeyError.__init__(self, key)
+        self.value = value
+        self.etag = etag
+
+
 class MemoryCache(Cache):
     """
     I cache parsed docs in memory.
     """
 
     def __init__(self, docs=True, objects=True):
-        self._docCache = {} # dict of dbName to dict of id to doc
-        self._objCache = {} # dict of dbName to dict of id to doc
+        self._docCache = {} # dict of namespace to dict of id to doc
+        self._objCache = {} # dict of namespace to dict of id to object
 
         self.lookups = 0
         self.hits = 0
@@ -813,50 +2026,110 @@ class MemoryCache(Cache):
         self._docs = True
         self._objects = True
 
-    def mapped(self, key, obj):
+    def mapped(self, key, obj, namespace=None):
         assert type(key) is str, 'key %r is not str' % key
         assert type(obj) is not defer.Deferred
         if not self._objects:
             return
 
-        if not key in self._objCache:
-            self._objCache[key] = obj
+        objects = self._objCache.setdefault(namespace, {})
+        if not key in objects:
+            objects[key] = obj
             self.cached += 1
 
-    def store(self, key, value, operation='post'):
+    def store(self, key, value, operation='post', namespace=None):
         assert type(key) is str, 'key %r is not str' % key
-        self._docCache[key] = value
-        self.cached += 1
+        docs = self._docCache.setdefault(namespace, {})
+        if not key in docs:
+            self.cached += 1
+        docs[key] = value
         return defer.succeed(True)
 
-    def get(self, key):
+    def get(self, key, namespace=None):
         self.lookups += 1
-        ret = self._docCache[key]
+        ret = self._docCache.get(namespace, {})[key]
         self.hits += 1
         return defer.succeed(ret)
 
-    def getObject(self, key):
+    def getObject(self, key, namespace=None):
         self.lookups += 1
-        ret = self._objCache[key]
+        ret = self._objCache.get(namespace, {})[key]
         self.hits += 1
         return defer.succeed(ret)
 
-    def delete(self, key):
-        deleted = False
+    def delete(self, key, namespace=None):
+        # cached counts the entries of both
         for d in [self._docCache, self._objCache]:
             try:
-                del d[key]
-                deleted = True
-            except:
+                del d.get(namespace, {})[key]
+                self.cached -= 1
+            except KeyError:
                 pass
-        if deleted:
+        return defer.succeed(True)
+
+    def refresh(self, key, value, namespace=None):
+        # objects mapped from the old doc are outdated
+        try:
+            del self._objCache.get(namespace, {})[key]
             self.cached -= 1
+        except KeyError:
+            pass
+        docs = self._docCache.get(namespace, {})
+        if key not in docs:
+            return defer.succeed(False)
+        docs[key] = value
         return defer.succeed(True)
 
+    def flush(self, namespace):
+        flushed = 0
+        for d in [self._docCache, self._objCache]:
+            flushed += len(d.pop(namespace, {}))
+        self.cached -= flushed
+        return defer.succeed(flushed)
+
+    def stats(self, namespace=None):
+        """
+        Return the cache counters.
+
+        @param namespace: if specified, only count the entries of this
+                          namespace.
+        @type  namespace: C{str}
+
+        @rtype: C{dict} of C{str} -> C{int}
+        """
+        if namespace is not None:
+            return {
+                'cached': sum(len(d.get(namespace, {}))
+                    for d in [self._docCache, self._objCache]),
+            }
+        return {
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'cached': self.cached,
+        }
+
 
 class AuthenticationError(Exception):
     pass
 
+
+class RequestTimeout(defer.TimeoutError):
+    """
+    A request did not complete in time, and was cancelled.
+
+    @ivar descr:   what the request was for.
+    @ivar timeout: the number of seconds it was given.
+    """
+
+    def __init__(self, descr, timeout):
+        defer.TimeoutError.__init__(self, descr, timeout)
+        self.descr = descr
+        self.timeout = timeout
+
+    def __str__(self):
+        return '%s timed out after %s seconds' % (self.descr, self.timeout)
+
+
 class Authenticator(object):
     def authenticate(self, client):
         """
@@ -0,0 +1,308 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_cluster -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+CouchDB client for a cluster of nodes without a load balancer in front.
+"""
+
+from twisted.internet import defer, task
+from twisted.python import failure
+
+from paisley.client import CouchDB
+
+# routing policies
+LATENCY = 'latency'
+LEAST_IN_FLIGHT = 'leastInFlight'
+
+
+def _isCancelled(result):
+    """
+    Whether a request failed because it was cancelled.
+
+    Agents fail cancelled requests with a L{ResponseFailed} wrapping the
+    L{defer.CancelledError}.
+    """
+    # _newclient imports reactor
+    from twisted.web._newclient import ResponseFailed
+
+    if result.check(defer.CancelledError):
+        return True
+    if result.check(ResponseFailed):
+        return any(reason.check(defer.CancelledError)
+            for reason in result.value.reasons)
+    return False
+
+
+class Node(object):
+    """
+    A node of the cluster, with its recent behaviour.
+
+    @ivar latency:  the moving average of the response time, in seconds;
+                    None before the first response.
+    @type latency:  C{float}
+    @ivar inFlight: the number of requests in flight to the node.
+    @type inFlight: C{int}
+    @ivar healthy:  whether the node is in rotation.
+    @type healthy:  C{bool}
+    @ivar failures: the number of requests failed in a row.
+    @type failures: C{int}
+    """
+
+    def __init__(self, host, port, protocol='http'):
+        self.host = host
+        self.port = int(port)
+        self.url_template = "%s://%s:%s%%s" % (protocol, host, self.port)
+        self.url_prefix = self.url_template[:-2].encode('utf-8')
+
+        self.latency = None
+        self.inFlight = 0
+        self.healthy = True
+        self.failures = 0
+
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+
+    def __repr__(self):
+        return '<Node %s:%d>' % (self.host, self.port)
+
+    def stats(self):
+        """
+        @rtype: C{dict}
+        """
+        return {
+            'host': self.host,
+            'port': self.port,
+            'healthy': self.healthy,
+            'latency': self.latency,
+            'inFlight': self.inFlight,
+            'requests': self.requests,
+            'errors': self.errors,
+            'ejections': self.ejections,
+        }
+
+
+class CouchCluster(CouchDB):
+    """
+    I am a L{CouchDB} client that spreads requests over the nodes of a
+    cluster.
+
+    Every request goes to the node that is expected to answer first, using
+    a routing policy:
+      - LATENCY picks the node with the lowest moving average of response
+        times, weighed by the number of requests in flight to it.  Nodes
+        that did not answer yet are taken to be as fast as the average of
+        the others.
+      - LEAST_IN_FLIGHT picks the node with the fewest requests in flight,
+        taking turns between nodes that have equally few.
+
+    Reads (GET, HEAD and reads done with POST) and writes use separate
+    policies.
+
+    A node is taken out of rotation after C{maxFailures} requests to it
+    failed in a row, or when a health check fails, and is put back when a
+    health check succeeds again.  Requests that time out count as failed.
+    Health checks call L{getVersion} on every node every C{healthInterval}
+    seconds, and fail if a node does not answer within that time.  When no
+    node is healthy, all of them are used.
+
+    Retries are routed anew, so they usually go to another node.
+    """
+
+    def __init__(self, nodes, readPolicy=LATENCY,
+                 writePolicy=LEAST_IN_FLIGHT, healthInterval=10,
+                 maxFailures=3, alpha=0.3, clock=None, **kwargs):
+        """
+        @param nodes:          the nodes of the cluster.
+        @type  nodes:          C{list} of (host, port) C{tuple}s
+        @param readPolicy:     the routing policy for reads.
+        @type  readPolicy:     C{str}
+        @param writePolicy:    the routing policy for writes.
+        @type  writePolicy:    C{str}
+        @param healthInterval: the number of seconds between health checks;
+                               no health checks are done if None.
+        @type  healthInterval: C{int}
+        @param maxFailures:    the number of failed requests in a row that
+                               take a node out of rotation.
+        @type  maxFailures:    C{int}
+        @param alpha:          the weight of a new response time in the
+                               moving average.
+        @type  alpha:          C{float}
+        @param kwargs:         passed to L{CouchDB}.
+        """
+        for policy in (readPolicy, writePolicy):
+            assert policy in (LATENCY, LEAST_IN_FLIGHT), \
+                "Unknown routing policy %r" % (policy, )
+        assert nodes, "A cluster needs at least one node."
+
+        protocol = kwargs.get('protocol', 'http')
+        self.nodes = [Node(host, port, protocol) for host, port in nodes]
+        host, port = nodes[0]
+        CouchDB.__init__(self, host, port, **kwargs)
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
+        self.readPolicy = readPolicy
+        self.writePolicy = writePolicy
+        self.maxFailures = maxFailures
+        self.alpha = alpha
+        self._turn = 0
+
+        self._checkers = None
+        self._healthLC = None
+        self.healthInterval = healthInterval
+        if healthInterval:
+            self.startHealthChecks(healthInterval)
+
+    def getNodeStats(self):
+        """
+        Return the state of every node.
+
+        @rtype: C{list} of C{dict}
+        """
+        return [node.stats() for node in self.nodes]
+
+    # routing
+
+    def _route(self, read):
+        node = self.pickNode(read)
+        return node.url_prefix, node
+
+    def pickNode(self, read=True):
+        """
+        Return the node to send a request to.
+
+        @param read: whether the request only reads.
+        @type  read: C{bool}
+
+        @rtype: L{Node}
+        """
+        nodes = [node for node in self.nodes if node.healthy] or self.nodes
+
+        # start at another node every time, so equal nodes take turns
+        self._turn = (self._turn + 1) % len(nodes)
+        nodes = nodes[self._turn:] + nodes[:self._turn]
+
+        policy = read and self.readPolicy or self.writePolicy
+        if policy == LATENCY:
+            measured = [node.latency for node in nodes
+                if node.latency is not None]
+            average = measured and sum(measured) / len(measured) or 1.0
+
+            def expected(node):
+                latency = node.latency
+                if latency is None:
+                    latency = average
+                return latency * (node.inFlight + 1)
+            return min(nodes, key=expected)
+        return min(nodes, key=lambda node: node.inFlight)
+
+    def _track(self, node, d):
+        node.inFlight += 1
+        node.requests += 1
+        started = self._clock.seconds()
+
+        def done(result):
+            node.inFlight -= 1
+            if isinstance(result, failure.Failure):
+                # cancelled requests only failed if they timed out, not if
+                # they lost a hedge or nobody waits for them anymore
+                if not _isCancelled(result) or self._expiring:
+                    self._failed(node)
+                return result
+
+            body, response = result
+            if response is not None and response.code >= 500:
+                self._failed(node)
+                return result
+
+            node.failures = 0
+            elapsed = self._clock.seconds() - started
+            if node.latency is None:
+                node.latency = elapsed
+            else:
+                node.latency += self.alpha * (elapsed - node.latency)
+            return result
+        return d.addBoth(done)
+
+    def _failed(self, node):
+        node.errors += 1
+        node.failures += 1
+        if node.failures >= self.maxFailures:
+            self._eject(node)
+
+    def _eject(self, node):
+        if node.healthy:
+            self.log.warning("[%s:%s] taking node out of rotation",
+                node.host, node.port)
+            node.healthy = False
+            node.ejections += 1
+
+    def _recover(self, node):
+        node.failures = 0
+        if not node.healthy:
+            self.log.info("[%s:%s] putting node back in rotation",
+                node.host, node.port)
+            node.healthy = True
+            # old measurements say nothing about the recovered node
+            node.latency = None
+
+    # health checks
+
+    def startHealthChecks(self, interval):
+        """
+        Check the health of all nodes every C{interval} seconds.
+        """
+        self.stopHealthChecks()
+        self.healthInterval = interval
+        self._healthLC = task.LoopingCall(self.checkHealth)
+        self._healthLC.clock = self._clock
+        self._healthLC.start(interval, now=False)
+
+    def stopHealthChecks(self):
+        if self._healthLC is not None and self._healthLC.running:
+            self._healthLC.stop()
+        self._healthLC = None
+
+    def checkHealth(self):
+        """
+        Check the health of all nodes, by getting their version.
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing when all nodes have been checked.
+        """
+        if self._checkers is None:
+            from paisley.retry import RetryPolicy
+            # a client per node; checks are not retried, failing is what
+            # they are meant to find out
+            self._checkers = []
+            sessionManager = None
+            if self.username and self._cookieAuth:
+                # one session for the whole cluster
+                sessionManager = self._getSessionManager()
+            for node in self.nodes:
+                checker = CouchDB(node.host, node.port,
+                    protocol=node.url_template.split(':')[0],
+                    username=self.username, password=self.password,
+                    pool=self.pool, retryPolicy=RetryPolicy(maxAttempts=1,
+                        clock=self._clock), sessionManager=sessionManager,
+                    cookieAuth=self._cookieAuth,
+                    compressionPolicy=self.compressionPolicy)
+                # share our connections and cookies
+                checker.client = self.client
+                checker._clock = self._clock
+                self._checkers.append(checker)
+
+        dl = []
+        for node, checker in zip(self.nodes, self._checkers):
+            # a hung node does not hold up the next checks
+            d = checker.getVersion(timeout=self.healthInterval)
+            d.addCallbacks(lambda _, node=node: self._recover(node),
+                lambda _, node=node: self._eject(node))
+            dl.append(d)
+        return defer.DeferredList(dl)
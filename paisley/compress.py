@@ -0,0 +1,220 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_compress -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Compressed transfer of request and response bodies.
+"""
+
+import zlib
+
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+
+# content codings we can decode, in order of preference
+ENCODINGS = ('gzip', 'deflate')
+
+
+def contentEncoding(response):
+    """
+    Return the content coding of the body of C{response}, or an empty string.
+    """
+    encoding = response.headers.getRawHeaders('Content-Encoding', [''])
+    return encoding[0].lower().strip()
+
+
+class CompressionPolicy(object):
+    """
+    I negotiate compressed responses, and compress large request bodies.
+
+    Responses are decompressed as they arrive, in front of whatever protocol
+    receives them, so streamed rows and attachments stay streamed.
+
+    Note that CouchDB itself only compresses responses when configured to,
+    or through a proxy in front of it; it does accept gzipped request bodies.
+
+    @ivar responses:          number of compressed responses received.
+    @type responses:          C{int}
+    @ivar responseWireBytes:  bytes of compressed responses received.
+    @type responseWireBytes:  C{int}
+    @ivar responseBytes:      bytes those decompressed to.
+    @type responseBytes:      C{int}
+    @ivar requests:           number of request bodies compressed.
+    @type requests:           C{int}
+    @ivar requestBytes:       bytes of those bodies before compressing.
+    @type requestBytes:       C{int}
+    @ivar requestWireBytes:   bytes of those bodies as sent.
+    @type requestWireBytes:   C{int}
+    """
+
+    def __init__(self, acceptEncoding=True, compressRequests=False,
+                 threshold=16 * 1024, level=6):
+        """
+        @param acceptEncoding:   whether to ask for compressed responses.
+        @type  acceptEncoding:   C{bool}
+        @param compressRequests: whether to gzip large request bodies.
+        @type  compressRequests: C{bool}
+        @param threshold:        the size from which request bodies are
+                                 compressed, in bytes.
+        @type  threshold:        C{int}
+        @param level:            the zlib compression level.
+        @type  level:            C{int}
+        """
+        self.acceptEncoding = acceptEncoding
+        self.compressRequests = compressRequests
+        self.threshold = threshold
+        self.level = level
+
+        self.responses = 0
+        self.responseWireBytes = 0
+        self.responseBytes = 0
+        self.requests = 0
+        self.requestBytes = 0
+        self.requestWireBytes = 0
+
+    def stats(self):
+        """
+        Return the compression counters, and the bytes saved in each
+        direction.
+
+        @rtype: C{dict} of C{str} -> C{int}
+        """
+        return {
+            'responses': self.responses,
+            'responseWireBytes': self.responseWireBytes,
+            'responseBytes': self.responseBytes,
+            'responseBytesSaved': self.responseBytes - self.responseWireBytes,
+            'requests': self.requests,
+            'requestBytes': self.requestBytes,
+            'requestWireBytes': self.requestWireBytes,
+            'requestBytesSaved': self.requestBytes - self.requestWireBytes,
+        }
+
+    def requestHeaders(self, headers):
+        """
+        Add the headers asking for a compressed response.
+
+        Ranges would apply to the compressed body, so ranged requests are
+        left alone.
+
+        @type headers: C{dict} of C{str} -> C{list}
+        """
+        if self.acceptEncoding and 'Range' not in headers:
+            headers.setdefault('Accept-Encoding', [', '.join(ENCODINGS)])
+
+    def compress(self, body, headers):
+        """
+        Compress a request body if it is large enough.
+
+        @param body:    the body to send.
+        @type  body:    C{bytes}
+        @param headers: the headers of the request, to add Content-Encoding
+                        to.
+        @type  headers: C{dict} of C{str} -> C{list}
+
+        @rtype:   C{bytes}
+        @returns: the body to send.
+        """
+        if not self.compressRequests or len(body) < self.threshold:
+            return body
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+            16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(body) + compressor.flush()
+        if len(compressed) >= len(body):
+            return body
+
+        self.requests += 1
+        self.requestBytes += len(body)
+        self.requestWireBytes += len(compressed)
+        headers['Content-Encoding'] = ['gzip']
+        return compressed
+
+    def decoder(self, response, protocol):
+        """
+        Return the protocol to deliver the body of C{response} to.
+
+        @param protocol: the protocol receiving the decoded body.
+        @type  protocol: L{Protocol}
+
+        @returns: C{protocol} itself if the body is not compressed.
+        """
+        encoding = contentEncoding(response)
+        if encoding not in ENCODINGS:
+            return protocol
+        self.responses += 1
+        return DecodingProtocol(protocol, encoding, self)
+
+
+class DecodingProtocol(Protocol):
+    """
+    I decompress a response body on its way to another protocol.
+
+    The transport is handed to that protocol, so it can pause and stop it.
+    """
+
+    def __init__(self, protocol, encoding, policy):
+        self.protocol = protocol
+        self._policy = policy
+        self._encoding = encoding
+        if encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = zlib.decompressobj()
+        self._started = False
+        self._failed = False
+
+    def makeConnection(self, transport):
+        Protocol.makeConnection(self, transport)
+        self.protocol.makeConnection(transport)
+
+    def dataReceived(self, data):
+        if self._failed:
+            return
+
+        self._policy.responseWireBytes += len(data)
+        try:
+            decoded = self._decompress(data)
+        except zlib.error:
+            self._failed = True
+            if self.transport is not None:
+                self.transport.stopProducing()
+            self.protocol.connectionLost(Failure())
+            return
+
+        if decoded:
+            self._policy.responseBytes += len(decoded)
+            self.protocol.dataReceived(decoded)
+
+    def _decompress(self, data):
+        if not self._started and self._encoding == 'deflate':
+            self._started = True
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                # some servers send deflate without the zlib header
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def connectionLost(self, reason):
+        # _newclient imports reactor
+        from twisted.web._newclient import ResponseDone
+
+        if self._failed:
+            return
+
+        try:
+            rest = self._decompressor.flush()
+        except zlib.error:
+            self.protocol.connectionLost(Failure())
+            return
+
+        if rest:
+            self._policy.responseBytes += len(rest)
+            self.protocol.dataReceived(rest)
+
+        if not self._decompressor.eof and reason.check(ResponseDone):
+            reason = Failure(zlib.error('Compressed response ended early'))
+        self.protocol.connectionLost(reason)
@@ -0,0 +1,196 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_hedge -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Hedging of slow reads.
+"""
+
+from collections import deque
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+
+class HedgePolicy(object):
+    """
+    I send a second copy of a read that is slower than most, and use
+    whichever answer arrives first.
+
+    The delay before hedging is a percentile of the recent response times,
+    so only the slowest requests get a copy.  The copy is routed like any
+    request, so it uses another connection, or another node of a cluster.
+    The request that loses is cancelled.
+
+    Hedges are limited by a budget: every request saves up C{budgetRatio} of
+    a hedge, up to C{budget} hedges, and every hedge takes one.  With the
+    default ratio hedging adds at most 5% to the number of requests.
+
+    Only call me for requests that can safely be done twice.
+
+    @ivar calls:           number of requests done through me.
+    @type calls:           C{int}
+    @ivar hedges:          number of copies sent.
+    @type hedges:          C{int}
+    @ivar hedgeWins:       number of copies that answered first.
+    @type hedgeWins:       C{int}
+    @ivar budgetExhausted: number of copies not sent because of an empty
+                           budget.
+    @type budgetExhausted: C{int}
+    """
+
+    def __init__(self, percentile=0.95, minDelay=0.005, maxDelay=1.0,
+                 window=1000, minSamples=20, budget=10, budgetRatio=0.05,
+                 clock=None):
+        """
+        @param percentile: the percentile of the recent response times to
+                           wait before hedging.
+        @type  percentile: C{float}
+        @param minDelay:   the minimum delay before hedging, in seconds.
+        @type  minDelay:   C{float}
+        @param maxDelay:   the maximum delay before hedging, in seconds;
+                           also used until C{minSamples} response times have
+                           been measured.
+        @type  maxDelay:   C{float}
+        @param window:     the number of recent response times to keep.
+        @type  window:     C{int}
+        @param minSamples: the number of response times needed to compute
+                           the percentile.
+        @type  minSamples: C{int}
+        @param budget:     the maximum number of hedges saved up.
+        @type  budget:     C{int}
+        @param budgetRatio: the number of hedges every request saves up.
+        @type  budgetRatio: C{float}
+        @param clock:      the clock to wait with.
+        @type  clock:      L{twisted.internet.interfaces.IReactorTime}
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
+        self.percentile = percentile
+        self.minDelay = minDelay
+        self.maxDelay = maxDelay
+        self.minSamples = minSamples
+        self.budget = budget
+        self.budgetRatio = budgetRatio
+
+        self._samples = deque(maxlen=window)
+        # the percentile is computed again after this many new samples
+        self._stale = max(1, window // 20)
+        self._newSamples = 0
+        self._delay = maxDelay
+        self._tokens = float(budget)
+
+        self.calls = 0
+        self.hedges = 0
+        self.hedgeWins = 0
+        self.budgetExhausted = 0
+
+    def stats(self):
+        """
+        Return the hedging counters and the current hedging delay.
+
+        @rtype: C{dict}
+        """
+        return {
+            'calls': self.calls,
+            'hedges': self.hedges,
+            'hedgeWins': self.hedgeWins,
+            'budgetExhausted': self.budgetExhausted,
+            'delay': self.delay(),
+        }
+
+    def delay(self):
+        """
+        Return the number of seconds to wait before hedging.
+        """
+        if self._newSamples >= self._stale and \
+                len(self._samples) >= self.minSamples:
+            self._newSamples = 0
+            samples = sorted(self._samples)
+            index = min(len(samples) - 1,
+                int(self.percentile * len(samples)))
+            self._delay = min(self.maxDelay,
+                max(self.minDelay, samples[index]))
+        return self._delay
+
+    def record(self, seconds):
+        """
+        Record the response time of a request.
+        """
+        self._samples.append(seconds)
+        self._newSamples += 1
+
+    def call(self, f):
+        """
+        Call f, and call it again if it did not answer in time.
+
+        @param f: called without arguments to do a request; returns a
+                  deferred that can be cancelled.
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing with the first answer, or with the last
+                  failure if all requests failed.
+        """
+        self.calls += 1
+        self._tokens = min(float(self.budget),
+            self._tokens + self.budgetRatio)
+
+        started = self._clock.seconds()
+        pending = []
+        state = {'delayed': None, 'answered': False}
+
+        def cancel(_):
+            stopHedging()
+            for d in pending[:]:
+                d.cancel()
+
+        result = defer.Deferred(cancel)
+
+        def stopHedging():
+            if state['delayed'] is not None:
+                if state['delayed'].active():
+                    state['delayed'].cancel()
+                state['delayed'] = None
+
+        def send(hedge):
+            d = defer.maybeDeferred(f)
+            pending.append(d)
+            d.addBoth(done, d, hedge)
+
+        def hedge():
+            state['delayed'] = None
+            if self._tokens < 1:
+                self.budgetExhausted += 1
+                return
+            self._tokens -= 1
+            self.hedges += 1
+            send(True)
+
+        def done(outcome, d, hedge):
+            pending.remove(d)
+            if state['answered'] or result.called:
+                # the loser, cancelled
+                return
+
+            if isinstance(outcome, Failure) and pending:
+                # the other request may still answer
+                return
+
+            state['answered'] = True
+            stopHedging()
+            for loser in pending[:]:
+                loser.cancel()
+
+            if not isinstance(outcome, Failure):
+                self.record(self._clock.seconds() - started)
+                if hedge:
+                    self.hedgeWins += 1
+            result.callback(outcome)
+
+        state['delayed'] = self._clock.callLater(self.delay(), hedge)
+        send(False)
+        return result
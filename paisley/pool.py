@@ -0,0 +1,100 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_pool -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Persistent HTTP connection pool.
+
+This module imports t.w.c, which imports the reactor; only import it
+after the reactor has been chosen.
+"""
+
+from twisted.web.client import HTTPConnectionPool
+
+
+class ConnectionPool(HTTPConnectionPool):
+    """
+    I am an L{HTTPConnectionPool} that keeps statistics about the connections
+    I hand out.
+
+    @ivar created: number of TCP connections opened
+    @type created: C{int}
+    @ivar reused:  number of requests served by an already open connection
+    @type reused:  C{int}
+    """
+
+    def __init__(self, reactor, persistent=True, maxPersistentPerHost=2,
+                 cachedConnectionTimeout=240, retryAutomatically=True):
+        """
+        @param persistent:              whether to keep connections open
+                                        between requests.
+        @type  persistent:              C{bool}
+        @param maxPersistentPerHost:    the maximum number of idle connections
+                                        kept open per host and port.
+        @type  maxPersistentPerHost:    C{int}
+        @param cachedConnectionTimeout: the number of seconds an idle
+                                        connection is kept open.
+        @type  cachedConnectionTimeout: C{int}
+        @param retryAutomatically:      whether to retry idempotent requests
+                                        once when an idle connection turns
+                                        out to be closed by the server.
+        @type  retryAutomatically:      C{bool}
+        """
+        HTTPConnectionPool.__init__(self, reactor, persistent=persistent)
+        self.maxPersistentPerHost = maxPersistentPerHost
+        self.cachedConnectionTimeout = cachedConnectionTimeout
+        self.retryAutomatically = retryAutomatically
+
+        self.created = 0
+        self.reused = 0
+        self._inUse = set()
+
+    def getConnection(self, key, endpoint):
+        cached = set(self._connections.get(key, []))
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+
+        def gotConnection(connection):
+            # retrying connections wrap the cached protocol
+            protocol = getattr(connection, '_clientProtocol', connection)
+            if protocol in cached:
+                self.reused += 1
+            self._inUse.add(protocol)
+            return connection
+        d.addCallback(gotConnection)
+        return d
+
+    def _newConnection(self, key, endpoint):
+        d = HTTPConnectionPool._newConnection(self, key, endpoint)
+
+        def connected(protocol):
+            self.created += 1
+            return protocol
+        d.addCallback(connected)
+        return d
+
+    def _putConnection(self, key, connection):
+        self._inUse.discard(connection)
+        HTTPConnectionPool._putConnection(self, key, connection)
+
+    def stats(self):
+        """
+        Return a snapshot of the pool usage.
+
+        @rtype:   C{dict} of C{str} -> C{int}
+        @returns: the number of connections currently carrying a request
+                  (inUse), waiting for one (idle), opened in total (created)
+                  and the number of requests that used an idle connection
+                  (reused).
+        """
+        # connections closed while carrying a request never come back
+        self._inUse = set(c for c in self._inUse
+            if c.state != 'CONNECTION_LOST')
+
+        return {
+            'inUse': len(self._inUse),
+            'idle': sum([len(c) for c in self._connections.values()]),
+            'created': self.created,
+            'reused': self.reused,
+        }
@@ -0,0 +1,252 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_retry -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Retrying of failed requests with exponential backoff.
+"""
+
+import calendar
+import random
+import time
+
+from email.utils import parsedate
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+# busy or restarting servers, and proxies in front of them
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+def _retryableErrors():
+    # _newclient imports reactor
+    from twisted.internet import error
+    from twisted.web._newclient import RequestTransmissionFailed, \
+        ResponseFailed, ResponseNeverReceived
+
+    return (error.ConnectError, error.ConnectionLost, error.TimeoutError,
+        RequestTransmissionFailed, ResponseFailed, ResponseNeverReceived)
+
+
+def parseRetryAfter(value, now=None):
+    """
+    Parse the value of a Retry-After header.
+
+    @param value: a number of seconds or an HTTP date.
+    @type  value: C{str}
+    @param now:   the current time in seconds since the epoch.
+    @type  now:   C{float}
+
+    @rtype:   C{float}
+    @returns: the number of seconds to wait, or None if not parseable.
+    """
+    value = value.strip()
+    try:
+        return max(0.0, float(int(value)))
+    except ValueError:
+        pass
+
+    date = parsedate(value)
+    if date is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(0.0, calendar.timegm(date) - now)
+
+
+class RetryPolicy(object):
+    """
+    I retry requests that failed because of a connection problem or a
+    response status meaning the server is busy, waiting exponentially
+    longer between attempts.
+
+    The wait is chosen at random up to the backoff delay ("full jitter"), so
+    clients that failed together do not retry together.  A Retry-After
+    header sent by the server is honored as the minimum wait; if it asks to
+    wait longer than C{maxDelay}, I give up instead.
+
+    Retries are limited by a budget shared by all requests: every request
+    adds C{budgetRatio} of a retry to it, up to C{budget} retries, and every
+    retry takes one.  When a server is in trouble and most requests fail,
+    the budget runs out and the retries stop adding to its load.
+
+    Only call me for requests that can safely be done twice.
+
+    @ivar calls:    number of requests done through me.
+    @type calls:    C{int}
+    @ivar attempts: number of attempts, including first attempts.
+    @type attempts: C{int}
+    @ivar retries:  number of attempts that were retries.
+    @type retries:  C{int}
+    @ivar giveUps:  number of requests that failed a retryable way, but were
+                    not retried any more.
+    @type giveUps:  C{int}
+    @ivar budgetExhausted: number of give ups because of an empty budget.
+    @type budgetExhausted: C{int}
+    """
+
+    def __init__(self, maxAttempts=4, initialDelay=0.1, maxDelay=10.0,
+                 multiplier=2.0, jitter=True, budget=10, budgetRatio=0.2,
+                 statuses=RETRY_STATUSES, clock=None):
+        """
+        @param maxAttempts:  the maximum number of attempts per request,
+                             including the first one; 1 disables retrying.
+        @type  maxAttempts:  C{int}
+        @param initialDelay: the backoff delay before the first retry, in
+                             seconds.
+        @type  initialDelay: C{float}
+        @param maxDelay:     the maximum delay before a retry, in seconds.
+        @type  maxDelay:     C{float}
+        @param multiplier:   the factor the delay grows with on every retry.
+        @type  multiplier:   C{float}
+        @param jitter:       whether to wait a random time up to the delay.
+        @type  jitter:       C{bool}
+        @param budget:       the maximum number of retries saved up.
+        @type  budget:       C{int}
+        @param budgetRatio:  the number of retries every request saves up.
+        @type  budgetRatio:  C{float}
+        @param statuses:     the response statuses to retry.
+        @type  statuses:     C{tuple} of C{int}
+        @param clock:        the clock to wait with.
+        @type  clock:        L{twisted.internet.interfaces.IReactorTime}
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
+        self.maxAttempts = maxAttempts
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.budget = budget
+        self.budgetRatio = budgetRatio
+        self.statuses = statuses
+
+        self._tokens = float(budget)
+        self._errors = None
+
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.giveUps = 0
+        self.budgetExhausted = 0
+
+    def stats(self):
+        """
+        Return the retry counters.
+
+        @rtype: C{dict} of C{str} -> C{int}
+        """
+        return {
+            'calls': self.calls,
+            'attempts': self.attempts,
+            'retries': self.retries,
+            'giveUps': self.giveUps,
+            'budgetExhausted': self.budgetExhausted,
+        }
+
+    def backoff(self, retry):
+        """
+        Return the number of seconds to wait before a retry.
+
+        @param retry: the number of the retry, starting at 1.
+        @type  retry: C{int}
+        """
+        delay = min(self.maxDelay,
+            self.initialDelay * self.multiplier ** (retry - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def call(self, f):
+        """
+        Call f, and call it again as long as it fails in a retryable way.
+
+        @param f: called without arguments to do an attempt; returns a
+                  deferred firing a (body, response) tuple, where the
+                  response is None if it need not be checked.
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing with the result of the last attempt.
+        """
+        self.calls += 1
+        self._tokens = min(float(self.budget),
+            self._tokens + self.budgetRatio)
+
+        state = {'attempt': None, 'delayed': None, 'cancelled': False}
+
+        def cancel(_):
+            # the cancelled attempt may fail with a retryable error, like
+            # ResponseNeverReceived; it must not be retried
+            state['cancelled'] = True
+            if state['delayed'] is not None:
+                state['delayed'].cancel()
+                state['delayed'] = None
+            if state['attempt'] is not None:
+                state['attempt'].cancel()
+
+        result = defer.Deferred(cancel)
+
+        def attempt(number):
+            state['delayed'] = None
+            self.attempts += 1
+            state['attempt'] = defer.maybeDeferred(f)
+            state['attempt'].addBoth(done, number)
+
+        def done(outcome, number):
+            state['attempt'] = None
+            if result.called or state['cancelled']:
+                return
+
+            delay = self._retryDelay(outcome, number)
+            if delay is None:
+                result.callback(outcome)
+                return
+
+            self.retries += 1
+            self._tokens -= 1
+            state['delayed'] = self._clock.callLater(delay, attempt,
+                number + 1)
+
+        attempt(1)
+        return result
+
+    def _retryDelay(self, outcome, number):
+        """
+        Return how long to wait before retrying after an attempt, or None if
+        it should not be retried.
+        """
+        retryAfter = None
+        if isinstance(outcome, Failure):
+            if self._errors is None:
+                self._errors = _retryableErrors()
+            if not outcome.check(*self._errors):
+                return None
+        else:
+            body, response = outcome
+            if response is None or response.code not in self.statuses:
+                return None
+            header = response.headers.getRawHeaders('Retry-After')
+            if header:
+                retryAfter = parseRetryAfter(header[0],
+                    self._clock.seconds())
+
+        if number >= self.maxAttempts:
+            self.giveUps += 1
+            return None
+        if retryAfter is not None and retryAfter > self.maxDelay:
+            self.giveUps += 1
+            return None
+        if self._tokens < 1:
+            self.giveUps += 1
+            self.budgetExhausted += 1
+            return None
+
+        delay = self.backoff(number)
+        if retryAfter is not None:
+            delay = max(delay, retryAfter)
+        return delay
@@ -0,0 +1,181 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_scanner -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Paginated scanning of views and _all_docs.
+"""
+
+import base64
+import json
+
+from twisted.internet import defer
+
+
+def encodeCursor(key, docId):
+    """
+    Encode the position of a row as an opaque cursor string.
+
+    @rtype: C{str}
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps([key, docId]).encode('utf-8')).decode('ascii')
+
+
+def decodeCursor(cursor):
+    """
+    Decode a cursor string.
+
+    @rtype:   C{tuple}
+    @returns: the key and document id of the row the cursor points to.
+    """
+    key, docId = json.loads(base64.urlsafe_b64decode(
+        cursor.encode('ascii')).decode('utf-8'))
+    return key, docId
+
+
+class Scanner(object):
+    """
+    I walk all rows of a view, or of _all_docs, one page at a time.
+
+    Every page is requested with a limit of one row more than the page size;
+    that extra row is where the next page starts, with startkey and
+    startkey_docid, so rows with duplicate keys are neither skipped nor
+    repeated.  The next page is requested as soon as the current one has
+    been handed out, so only two pages are ever held in memory.
+
+    The cursor points to the first row of the page last handed out, until
+    the next page is asked for; scan asks for it once the last row of the
+    page has been processed.  Pass a saved cursor to a new scanner to
+    continue a scan from there, without skipping rows of a page that was
+    not done yet.
+
+    @ivar cursor: the position of the current page, or None at the end.
+    @type cursor: C{str}
+    @ivar rows:   the number of rows handed out so far.
+    @type rows:   C{int}
+    """
+
+    def __init__(self, couch, dbName, docId=None, viewId=None,
+                 pageSize=1000, cursor=None, **options):
+        """
+        @param couch:    the client to scan with.
+        @type  couch:    L{paisley.client.CouchDB}
+        @param docId:    the design document of the view; scan _all_docs if
+                         not specified.
+        @type  docId:    C{unicode}
+        @param viewId:   the name of the view.
+        @type  viewId:   C{str}
+        @param pageSize: the number of rows per page.
+        @type  pageSize: C{int}
+        @param cursor:   if specified, resume the scan from this cursor.
+        @type  cursor:   C{str}
+        @param options:  other query options, like include_docs or endkey.
+        """
+        assert 'limit' not in options and 'startkey' not in options, \
+            "Scanner sets limit and startkey itself."
+
+        self._couch = couch
+        self._dbName = dbName
+        self._docId = docId
+        self._viewId = viewId
+        self._pageSize = pageSize
+        self._options = options
+
+        self.cursor = cursor
+        self.rows = 0
+
+        # where the page after the current one starts
+        self._nextCursor = cursor
+
+        self._next = None
+        if cursor:
+            self._next = decodeCursor(cursor)
+        self._prefetch = None
+        self._done = False
+
+    def _fetch(self, start):
+        kwargs = dict(self._options)
+        kwargs['limit'] = self._pageSize + 1
+        if start:
+            key, docId = start
+            kwargs['startkey'] = key
+            if self._viewId and docId is not None:
+                kwargs['startkey_docid'] = docId
+
+        if self._viewId:
+            d = self._couch.openView(self._dbName, self._docId, self._viewId,
+                **kwargs)
+        else:
+            d = self._couch.listDoc(self._dbName, **kwargs)
+        d.addCallback(lambda result: result['rows'])
+        return d
+
+    def nextPage(self):
+        """
+        Get the next page of rows.
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing a list of at most pageSize rows;
+                  an empty list once all rows have been handed out.
+        """
+        # done with the current page
+        self.cursor = self._nextCursor
+        if self._done:
+            return defer.succeed([])
+
+        if self._prefetch:
+            d, self._prefetch = self._prefetch, None
+        else:
+            d = self._fetch(self._next)
+        d.addCallback(self._pageCb)
+        return d
+
+    def _pageCb(self, rows):
+        if len(rows) > self._pageSize:
+            first = rows.pop()
+            self._next = (first['key'], first.get('id', None))
+            self._nextCursor = encodeCursor(*self._next)
+            self._prefetch = self._fetch(self._next)
+        else:
+            self._done = True
+            self._nextCursor = None
+
+        self.rows += len(rows)
+        return rows
+
+    def scan(self, rowCallback):
+        """
+        Call rowCallback for all remaining rows.
+
+        If the callback returns a deferred, the next row is handed out when
+        it fires.
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing the number of rows scanned in total.
+        """
+
+        def pageCb(rows):
+            if not rows:
+                return self.rows
+
+            d = defer.succeed(None)
+            for row in rows:
+                d.addCallback(lambda _, row=row: rowCallback(row))
+            d.addCallback(lambda _: self.nextPage())
+            d.addCallback(pageCb)
+            return d
+
+        return self.nextPage().addCallback(pageCb)
+
+    def stop(self):
+        """
+        Stop scanning, cancelling the request for the next page.
+        """
+        self._done = True
+        if self._prefetch:
+            d, self._prefetch = self._prefetch, None
+            d.addErrback(lambda f: f.trap(defer.CancelledError))
+            d.cancel()
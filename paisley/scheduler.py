@@ -0,0 +1,314 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_scheduler -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Scheduling of requests with concurrency limits and priorities.
+"""
+
+from collections import deque, OrderedDict
+
+from twisted.internet import defer
+
+# from most to least urgent
+PRIORITIES = ('interactive', 'default', 'bulk')
+
+# share of the freed slots every priority gets when all of them are waiting
+WEIGHTS = {'interactive': 8, 'default': 4, 'bulk': 1}
+
+OVERFLOW_REJECT = 'reject'
+OVERFLOW_SHED = 'shed'
+
+
+class QueueFull(Exception):
+    """
+    Raised when a request does not fit in the queue of the scheduler, or was
+    pushed out of it by a more urgent one.
+    """
+
+
+class _Request(object):
+
+    __slots__ = ('f', 'host', 'priority', 'deferred', 'queued', 'running')
+
+    def __init__(self, f, host, priority, queued):
+        self.f = f
+        self.host = host
+        self.priority = priority
+        self.queued = queued
+        self.deferred = None
+        self.running = None
+
+
+class Scheduler(object):
+    """
+    I run requests while fewer than a maximum number are in flight, overall
+    and per host, and queue them otherwise.
+
+    Queued requests wait in a lane per priority.  When a slot frees up, the
+    lanes are served by smooth weighted round robin, so urgent requests go
+    first without starving the bulk lane, and the hosts within a lane take
+    turns.  Requests are only held back when a limit is reached; with no
+    limits, they run right away.
+
+    Share one scheduler between clients to limit them together.
+
+    @ivar submitted: number of requests submitted.
+    @type submitted: C{int}
+    @ivar rejected:  number of requests refused because the queue was full.
+    @type rejected:  C{int}
+    @ivar shed:      number of queued requests pushed out of a full queue by
+                     a request of the same or a higher priority.
+    @type shed:      C{int}
+    """
+
+    def __init__(self, maxInFlight=None, maxPerHost=None, maxQueued=None,
+                 overflow=OVERFLOW_REJECT, weights=None, clock=None):
+        """
+        @param maxInFlight: the maximum number of requests in flight over all
+                            hosts; unlimited if None.
+        @type  maxInFlight: C{int}
+        @param maxPerHost:  the maximum number of requests in flight per
+                            host; unlimited if None.
+        @type  maxPerHost:  C{int}
+        @param maxQueued:   the maximum number of queued requests; unlimited
+                            if None.
+        @type  maxQueued:   C{int}
+        @param overflow:    what to do with a request when the queue is full:
+                            OVERFLOW_REJECT fails it with L{QueueFull};
+                            OVERFLOW_SHED fails the oldest request of the
+                            least urgent lane instead, if that lane is not
+                            more urgent than the new request.
+        @type  overflow:    C{str}
+        @param weights:     the weight of every priority, defaulting to
+                            L{WEIGHTS}; the higher the weight the more urgent.
+        @type  weights:     C{dict} of C{str} -> C{int}
+        @param clock:       the clock to measure waiting times with.
+        @type  clock:       L{twisted.internet.interfaces.IReactorTime}
+        """
+        assert overflow in (OVERFLOW_REJECT, OVERFLOW_SHED), \
+            "Unknown overflow policy %r" % (overflow, )
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
+        self.maxInFlight = maxInFlight
+        self.maxPerHost = maxPerHost
+        self.maxQueued = maxQueued
+        self.overflow = overflow
+
+        self._weights = dict(weights or WEIGHTS)
+        self._priorities = sorted(self._weights,
+            key=lambda p: -self._weights[p])
+
+        self._lanes = dict((p, OrderedDict()) for p in self._priorities)
+        self._current = dict((p, 0) for p in self._priorities)
+        self._depth = dict((p, 0) for p in self._priorities)
+        self._queued = 0
+        self._hostQueued = {}
+
+        self._inFlight = 0
+        self._hostInFlight = {}
+
+        self.submitted = 0
+        self.rejected = 0
+        self.shed = 0
+        self._started = dict((p, 0) for p in self._priorities)
+        self._waitTotal = dict((p, 0.0) for p in self._priorities)
+        self._waitMax = dict((p, 0.0) for p in self._priorities)
+
+    def submit(self, f, host=None, priority='default'):
+        """
+        Run a request as soon as the limits allow.
+
+        @param f:        called without arguments to do the request; its
+                         slot is held until the deferred it returns fires.
+        @type  f:        callable
+        @param host:     the host the request goes to.
+        @param priority: the priority of the request.
+        @type  priority: C{str}
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing with the result of the request.
+                  Cancelling it takes a queued request out of the queue, and
+                  cancels the deferred of a running one.
+        """
+        if priority not in self._weights:
+            raise ValueError("Unknown priority %r" % (priority, ))
+
+        self.submitted += 1
+        request = _Request(f, host, priority, self._clock.seconds())
+        request.deferred = defer.Deferred(
+            lambda d: self._cancel(request))
+
+        if not self._hostQueued.get(host) and self._hasRoom(host):
+            self._run(request)
+            return request.deferred
+
+        if self.maxQueued is not None and self._queued >= self.maxQueued:
+            if not (self.overflow == OVERFLOW_SHED and self._shed(priority)):
+                self.rejected += 1
+                request.deferred.errback(QueueFull(
+                    "%d requests queued" % (self._queued, )))
+                return request.deferred
+
+        self._enqueue(request)
+        return request.deferred
+
+    def stats(self):
+        """
+        Return a snapshot of the scheduler state.
+
+        @rtype:   C{dict}
+        @returns: the number of requests in flight overall (inFlight) and
+                  per host (hosts), the number queued (queued), the
+                  submitted, rejected and shed counters, and per priority
+                  (lanes) the number queued, the number started and the
+                  total, average and maximum seconds waited before starting.
+        """
+        lanes = {}
+        for p in self._priorities:
+            started = self._started[p]
+            lanes[p] = {
+                'queued': self._depth[p],
+                'started': started,
+                'waitTotal': self._waitTotal[p],
+                'waitAverage': started and self._waitTotal[p] / started,
+                'waitMax': self._waitMax[p],
+            }
+        return {
+            'inFlight': self._inFlight,
+            'hosts': dict(self._hostInFlight),
+            'queued': self._queued,
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+            'shed': self.shed,
+            'lanes': lanes,
+        }
+
+    def _hasRoom(self, host):
+        if self.maxInFlight is not None and \
+                self._inFlight >= self.maxInFlight:
+            return False
+        if self.maxPerHost is not None and \
+                self._hostInFlight.get(host, 0) >= self.maxPerHost:
+            return False
+        return True
+
+    def _enqueue(self, request):
+        lane = self._lanes[request.priority]
+        if request.host not in lane:
+            lane[request.host] = deque()
+        lane[request.host].append(request)
+        self._depth[request.priority] += 1
+        self._queued += 1
+        self._hostQueued[request.host] = \
+            self._hostQueued.get(request.host, 0) + 1
+
+    def _unqueue(self, request):
+        lane = self._lanes[request.priority]
+        queue = lane[request.host]
+        queue.remove(request)
+        if not queue:
+            del lane[request.host]
+
+        self._depth[request.priority] -= 1
+        if not self._depth[request.priority]:
+            # no credit is kept while not waiting
+            self._current[request.priority] = 0
+        self._queued -= 1
+        self._hostQueued[request.host] -= 1
+        if not self._hostQueued[request.host]:
+            del self._hostQueued[request.host]
+
+    def _shed(self, priority):
+        """
+        Fail the oldest request of the least urgent lane that is not more
+        urgent than C{priority}, to make room.
+
+        @returns: whether a request was shed.
+        """
+        weight = self._weights[priority]
+        for p in reversed(self._priorities):
+            if self._weights[p] > weight:
+                break
+            if not self._depth[p]:
+                continue
+            oldest = min([queue[0] for queue in self._lanes[p].values()],
+                key=lambda request: request.queued)
+            self._unqueue(oldest)
+            self.shed += 1
+            oldest.deferred.errback(QueueFull(
+                "Shed for a request of priority %s" % (priority, )))
+            return True
+        return False
+
+    def _next(self, lane):
+        """
+        Return the first request of the first host in the lane with room.
+        """
+        for host, queue in lane.items():
+            if self._hasRoom(host):
+                # let the other hosts go first next time
+                lane.move_to_end(host)
+                return queue[0]
+        return None
+
+    def _pump(self):
+        while self._queued and (self.maxInFlight is None
+                or self._inFlight < self.maxInFlight):
+            candidates = []
+            total = 0
+            for p in self._priorities:
+                if self._depth[p]:
+                    request = self._next(self._lanes[p])
+                    if request is not None:
+                        candidates.append((p, request))
+                        total += self._weights[p]
+            if not candidates:
+                return
+
+            # smooth weighted round robin over the lanes with work
+            for p, request in candidates:
+                self._current[p] += self._weights[p]
+            p, request = max(candidates, key=lambda c: self._current[c[0]])
+            self._current[p] -= total
+
+            self._unqueue(request)
+            self._run(request)
+
+    def _run(self, request):
+        waited = self._clock.seconds() - request.queued
+        p = request.priority
+        self._started[p] += 1
+        self._waitTotal[p] += waited
+        self._waitMax[p] = max(self._waitMax[p], waited)
+
+        self._inFlight += 1
+        self._hostInFlight[request.host] = \
+            self._hostInFlight.get(request.host, 0) + 1
+
+        request.running = defer.maybeDeferred(request.f)
+        request.running.addBoth(self._done, request)
+
+    def _done(self, result, request):
+        request.running = None
+        self._inFlight -= 1
+        self._hostInFlight[request.host] -= 1
+        if not self._hostInFlight[request.host]:
+            del self._hostInFlight[request.host]
+
+        self._pump()
+
+        # a cancelled request has fired already
+        if not request.deferred.called:
+            request.deferred.callback(result)
+
+    def _cancel(self, request):
+        if request.running is not None:
+            request.running.cancel()
+        elif not request.deferred.called:
+            self._unqueue(request)
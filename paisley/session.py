@@ -0,0 +1,309 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_session -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Cookie authentication with CouchDB sessions.
+"""
+
+import calendar
+import json
+import weakref
+
+from email.utils import parsedate
+from http.cookies import CookieError, SimpleCookie
+from urllib.parse import urlencode
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web.http_headers import Headers
+
+from paisley.client import AuthenticationError, RequestTimeout, \
+    ResponseReceiver, SOCK_TIMEOUT, StringProducer
+
+# the session timeout of CouchDB, for cookies that do not tell
+DEFAULT_LIFETIME = 600
+
+# managers in use, by (url prefix, username, password)
+_managers = weakref.WeakValueDictionary()
+
+
+def getSessionManager(client, **kwargs):
+    """
+    Return the session manager for the server and credentials of C{client},
+    creating it if there is none yet.
+
+    Clients for the same server and credentials share a manager, and so a
+    session.  Takes the same keyword arguments as L{SessionManager}, used
+    when creating it.
+
+    @type client: L{paisley.client.CouchDB}
+
+    @rtype: L{SessionManager}
+    """
+    key = (client.url_prefix, client.username, client.password)
+    manager = _managers.get(key)
+    if manager is None:
+        manager = SessionManager(client.client, client.url_prefix,
+            client.username, client.password, **kwargs)
+        _managers[key] = manager
+    return manager
+
+
+def parseExpiry(cookie, now, date=None):
+    """
+    Return the number of seconds a session cookie is valid for.
+
+    @param cookie: the morsel of the cookie.
+    @type  cookie: L{http.cookies.Morsel}
+    @param now:    the current time in seconds since the epoch.
+    @type  now:    C{float}
+    @param date:   the Date header of the response, to measure Expires
+                   against the clock of the server.
+    @type  date:   C{str}
+
+    @rtype: C{float}
+    @returns: the lifetime, or None if the cookie does not tell.
+    """
+    if cookie['max-age']:
+        try:
+            return max(0.0, float(int(cookie['max-age'])))
+        except ValueError:
+            pass
+
+    if cookie['expires']:
+        expires = parsedate(cookie['expires'])
+        if expires is not None:
+            sent = date and parsedate(date)
+            if sent:
+                now = calendar.timegm(sent)
+            return max(0.0, calendar.timegm(expires) - now)
+    return None
+
+
+class SessionManager(object):
+    """
+    I log in to CouchDB with a name and password, and hand out the session
+    cookie to send instead of the password.
+
+    The session is renewed before its cookie expires, as long as it was used
+    since the previous login; an unused session is left to lapse and
+    renewed on its next use.  When requests get a 401 because the session
+    ended anyway, they all wait for the same renewal.
+
+    @ivar info:   the response of the last login, with name and roles.
+    @type info:   C{dict}
+    @ivar logins: number of logins, including renewals.
+    @type logins: C{int}
+    @ivar renewals: number of logins done ahead of the cookie expiring.
+    @type renewals: C{int}
+    @ivar rejected: number of requests that got a 401 and waited for a
+                    login.
+    @type rejected: C{int}
+    @ivar failures: number of failed logins.
+    @type failures: C{int}
+    """
+
+    def __init__(self, agent, prefix, username, password, renewBefore=60,
+                 lifetime=DEFAULT_LIFETIME, timeout=SOCK_TIMEOUT,
+                 clock=None):
+        """
+        @param agent:       the agent to log in with.
+        @type  agent:       L{twisted.web.iweb.IAgent}
+        @param prefix:      the url of the server.
+        @type  prefix:      C{bytes}
+        @param renewBefore: how many seconds before the cookie expires to
+                            renew the session.
+        @type  renewBefore: C{float}
+        @param lifetime:    the lifetime of cookies that do not tell their
+                            expiry, in seconds.
+        @type  lifetime:    C{float}
+        @param timeout:     the number of seconds after which a login is
+                            cancelled and fails with L{RequestTimeout}, so
+                            that the next request logs in again; 0 or None
+                            for no timeout.
+        @type  timeout:     C{float}
+        @param clock:       the clock to renew with.
+        @type  clock:       L{twisted.internet.interfaces.IReactorTime}
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+        self._agent = agent
+        self._url = prefix + b'/_session'
+        self._username = username
+        self._password = password
+
+        self.renewBefore = renewBefore
+        self.lifetime = lifetime
+        self.timeout = timeout
+
+        self.info = {}
+        self._cookie = None
+        self._expires = None
+        self._used = False
+        self._renewal = None
+        self._login = None # the login in flight
+        self._waiting = []
+
+        self.logins = 0
+        self.renewals = 0
+        self.rejected = 0
+        self.failures = 0
+
+    def stats(self):
+        """
+        Return the session counters, and the seconds left before the cookie
+        expires.
+
+        @rtype: C{dict}
+        """
+        expiresIn = None
+        if self._expires is not None:
+            expiresIn = max(0.0, self._expires - self._clock.seconds())
+        return {
+            'logins': self.logins,
+            'renewals': self.renewals,
+            'rejected': self.rejected,
+            'failures': self.failures,
+            'expiresIn': expiresIn,
+        }
+
+    def getCookie(self):
+        """
+        Return the Cookie header value to send, or None if there is no
+        valid session; then call L{login} first.
+
+        @rtype: C{str}
+        """
+        if self._cookie is None or self._clock.seconds() >= self._expires:
+            return None
+        self._used = True
+        return self._cookie
+
+    def login(self):
+        """
+        Log in, unless a login is in flight already.
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing with the response of the login, or
+                  failing with L{AuthenticationError} if the credentials were
+                  refused.
+        """
+        d = defer.Deferred(lambda d: self._waiting.remove(d))
+        self._waiting.append(d)
+        if self._login is None:
+            self._login = self._doLogin()
+            self._login.addBoth(self._loggedIn)
+        return d
+
+    def renew(self, cookie):
+        """
+        Renew the session after a request sent with C{cookie} got a 401.
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing when a new session can be tried.
+        """
+        self.rejected += 1
+        if cookie != self._cookie and self._cookie is not None:
+            # renewed since the request was sent
+            return defer.succeed(self.info)
+        self._cookie = None
+        return self.login()
+
+    def stop(self):
+        """
+        Stop renewing the session.
+        """
+        if self._renewal is not None and self._renewal.active():
+            self._renewal.cancel()
+        self._renewal = None
+
+    def _doLogin(self):
+        self.logins += 1
+        body = urlencode({'name': self._username, 'password': self._password})
+        headers = Headers({
+            'Content-Type': ['application/x-www-form-urlencoded'],
+            'Accept': ['application/json'],
+            'User-Agent': ['paisley'],
+        })
+        d = self._agent.request(b'POST', self._url, headers,
+            StringProducer(body))
+
+        def cb(response):
+            received = defer.Deferred()
+            response.deliverBody(ResponseReceiver(received, decode_utf8=False))
+            return received.addCallback(lambda body: (response, body))
+        d.addCallback(cb)
+
+        if self.timeout:
+
+            def timedOut(result, timeout):
+                raise RequestTimeout('login', timeout)
+            d.addTimeout(self.timeout, self._clock, onTimeoutCancel=timedOut)
+        return d
+
+    def _loggedIn(self, result):
+        self._login = None
+        waiting, self._waiting = self._waiting, []
+
+        if not isinstance(result, Failure):
+            response, body = result
+            try:
+                result = self._start(response, body)
+            except Exception:
+                result = Failure()
+
+        if isinstance(result, Failure):
+            self.failures += 1
+            self._cookie = None
+            for d in waiting:
+                d.errback(result)
+        else:
+            for d in waiting:
+                d.callback(result)
+
+    def _start(self, response, body):
+        """
+        Take the session from the response of a login.
+        """
+        if response.code != 200:
+            raise AuthenticationError(response.code, body)
+
+        cookie = None
+        for header in response.headers.getRawHeaders('Set-Cookie', []):
+            try:
+                cookies = SimpleCookie(header)
+            except CookieError:
+                continue
+            if 'AuthSession' in cookies:
+                cookie = cookies['AuthSession']
+        if cookie is None:
+            raise AuthenticationError(response.code,
+                'No session cookie in response')
+
+        now = self._clock.seconds()
+        date = response.headers.getRawHeaders('Date', [None])[0]
+        lifetime = parseExpiry(cookie, now, date)
+        if lifetime is None:
+            lifetime = self.lifetime
+
+        self.info = json.loads(body)
+        self._cookie = 'AuthSession=%s' % (cookie.coded_value, )
+        self._expires = now + lifetime
+        self._used = False
+
+        self.stop()
+        self._renewal = self._clock.callLater(
+            max(lifetime - self.renewBefore, lifetime / 2.0), self._renew)
+        return self.info
+
+    def _renew(self):
+        self._renewal = None
+        if not self._used or self._login is not None:
+            return
+        self.renewals += 1
+        # failures are seen by the requests that find no session
+        self.login().addErrback(lambda _: None)
@@ -0,0 +1,387 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_stream -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Incremental receiving of responses.
+
+Rows of view and _all_docs responses are handed out as soon as they are
+complete, and attachments are written out as they arrive, so responses
+never need to be kept in memory as a whole.
+"""
+
+import codecs
+import json
+import re
+
+from twisted.internet.defer import Deferred
+from twisted.internet.interfaces import IConsumer
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+
+_WHITESPACE = re.compile(r'[ \t\r\n]*')
+_CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/')
+
+
+class RowParser(object):
+    """
+    I parse a JSON object with a 'rows' array incrementally.
+
+    Each row is passed to the row callback as soon as it is complete.
+    All other members of the object are collected in L{header}.
+
+    @ivar header: the members of the response other than rows, such as
+                  total_rows, offset and update_seq, as they are seen.
+    @type header: C{dict}
+    @ivar rows:   the number of rows parsed so far
+    @type rows:   C{int}
+    """
+
+    def __init__(self, rowCallback, headerCallback=None):
+        """
+        @param rowCallback:    called with every row as it is parsed.
+        @type  rowCallback:    callable
+        @param headerCallback: called with L{header} when the rows start.
+        @type  headerCallback: callable
+        """
+        self.header = {}
+        self.rows = 0
+
+        self._rowCallback = rowCallback
+        self._headerCallback = headerCallback
+
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._state = 'start'
+        self._key = None
+        # how much unparsed data to wait for before decoding the next value;
+        # doubles on every incomplete value so huge rows are decoded in
+        # linear time
+        self._wait = 0
+
+    def isDone(self):
+        """
+        Whether the complete object has been parsed.
+        """
+        return self._state == 'done'
+
+    def feed(self, data):
+        """
+        Parse the next chunk of the response.
+
+        @type data: C{bytes}
+
+        @raises ValueError: when the data is not a JSON object.
+        """
+        self._buffer += self._decoder.decode(data)
+        if len(self._buffer) - self._pos >= self._wait:
+            self._parse()
+
+    def finish(self):
+        """
+        Parse what is left at the end of the response.
+
+        @raises ValueError: when the data is not a complete JSON object.
+        """
+        self._buffer += self._decoder.decode(b'', True)
+        self._parse(final=True)
+        if not self.isDone():
+            raise ValueError('Response ended after %d rows' % (self.rows, ))
+
+    def _parse(self, final=False):
+        try:
+            while self._state != 'done':
+                self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+                if self._pos == len(self._buffer):
+                    return
+                c = self._buffer[self._pos]
+
+                if self._state in ('keyname', 'value', 'row'):
+                    if not self._decodeValue(final):
+                        return
+                elif self._state == 'start':
+                    self._expect(c, '{')
+                    self._state = 'key'
+                elif self._state == 'key':
+                    if c == ',':
+                        self._pos += 1
+                    elif c == '}':
+                        self._pos += 1
+                        self._state = 'done'
+                    else:
+                        self._expect(c, '"', advance=False)
+                        self._state = 'keyname'
+                elif self._state == 'colon':
+                    self._expect(c, ':')
+                    if self._key == 'rows':
+                        self._state = 'rowsStart'
+                    else:
+                        self._state = 'value'
+                elif self._state == 'rowsStart':
+                    self._expect(c, '[')
+                    self._state = 'rows'
+                    if self._headerCallback:
+                        self._headerCallback(self.header)
+                elif self._state == 'rows':
+                    if c == ',':
+                        self._pos += 1
+                    elif c == ']':
+                        self._pos += 1
+                        self._state = 'key'
+                    else:
+                        self._state = 'row'
+        finally:
+            # drop what we have parsed already
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+
+    def _decodeValue(self, final):
+        """
+        Decode the JSON value at the current position.
+
+        @rtype:   C{bool}
+        @returns: whether the value was complete.
+        """
+        try:
+            value, end = self._json.raw_decode(self._buffer, self._pos)
+        except ValueError:
+            if final:
+                raise
+            self._wait = 2 * (len(self._buffer) - self._pos)
+            return False
+
+        # a number could continue in the next chunk
+        if end == len(self._buffer) and not final:
+            self._wait = 2 * (len(self._buffer) - self._pos)
+            return False
+
+        self._wait = 0
+        self._pos = end
+
+        if self._state == 'keyname':
+            self._key = value
+            self._state = 'colon'
+        elif self._state == 'value':
+            self.header[self._key] = value
+            self._state = 'key'
+        else:
+            self.rows += 1
+            self._state = 'rows'
+            self._rowCallback(value)
+        return True
+
+    def _expect(self, c, expected, advance=True):
+        if c != expected:
+            raise ValueError('Expected %r but got %r' % (expected, c))
+        if advance:
+            self._pos += 1
+
+
+class RowReceiver(Protocol):
+    """
+    Parses a view response from the return stream, handing out rows as they
+    arrive.
+
+    The deferred fires with the header of the response once all rows have
+    been handed out.
+
+    If the row callback returns a deferred that has not fired yet, receiving
+    is paused until it fires, so a slow consumer of rows holds back the
+    server instead of having rows pile up.
+    """
+
+    def __init__(self, deferred, rowCallback, headerCallback=None):
+        self.deferred = deferred
+        self.parser = RowParser(self._rowReceived, headerCallback)
+        self._rowCallback = rowCallback
+        self._waiting = 0
+        self._received = None # how the response ended, once it did
+
+    def _rowReceived(self, row):
+        result = self._rowCallback(row)
+        if isinstance(result, Deferred) and not result.called:
+            if not self._waiting:
+                self.transport.pauseProducing()
+            self._waiting += 1
+            result.addBoth(self._rowHandled)
+
+    def _rowHandled(self, result):
+        self._waiting -= 1
+        if self.deferred is None or self.deferred.called:
+            return None
+
+        if isinstance(result, Failure):
+            d, self.deferred = self.deferred, None
+            if self._received is None:
+                self.transport.stopProducing()
+            d.errback(result)
+            return None
+
+        if not self._waiting:
+            if self._received is None:
+                self.transport.resumeProducing()
+            else:
+                self._fire()
+
+    def _fire(self):
+        d, self.deferred = self.deferred, None
+        if isinstance(self._received, Failure):
+            d.errback(self._received)
+        else:
+            d.callback(self._received)
+
+    def dataReceived(self, bytes):
+        if self.deferred is None or self.deferred.called:
+            # done, or cancelled
+            return
+
+        try:
+            self.parser.feed(bytes)
+        except Exception:
+            d, self.deferred = self.deferred, None
+            self.transport.stopProducing()
+            d.errback()
+
+    def connectionLost(self, reason):
+        # _newclient and http import reactor
+        from twisted.web._newclient import ResponseDone
+        from twisted.web.http import PotentialDataLoss
+
+        if self.deferred is None or self.deferred.called:
+            # done, or cancelled
+            return
+
+        if reason.check(ResponseDone) or reason.check(PotentialDataLoss):
+            try:
+                self.parser.finish()
+            except Exception:
+                self._received = Failure()
+            else:
+                self._received = self.parser.header
+        else:
+            self._received = reason
+
+        # fire once the consumer has handled all rows
+        if not self._waiting:
+            self._fire()
+
+
+class RangeMismatch(Exception):
+    """
+    The response to a request for part of a body is not that part.
+
+    CouchDB ignores the Range header for attachments it stores compressed,
+    and sends the whole body instead.
+    """
+
+
+class BodyReceiver(Protocol):
+    """
+    Writes the response body to a consumer as it arrives.
+
+    The deferred fires with the number of bytes written.
+
+    An L{IConsumer} gets the transport registered as its producer while the
+    body arrives, so a slow consumer can pause receiving.
+    """
+
+    def __init__(self, deferred, consumer, contentRange=None):
+        """
+        @param consumer:     a file-like object or an
+                             L{twisted.internet.interfaces.IConsumer}
+        @param contentRange: the first and last position of the part of the
+                             body requested; the last one None for the rest
+                             of the body.
+        @type  contentRange: C{tuple} of C{int}
+        """
+        self.deferred = deferred
+        self.consumer = consumer
+        self.contentRange = contentRange
+        self.written = 0
+        self._refused = None
+        self._registered = False
+
+    def checkResponse(self, response):
+        """
+        Refuse a response that is not the part of the body requested.
+        """
+        if self.contentRange is None:
+            return
+
+        first, last = self.contentRange
+        header = response.headers.getRawHeaders('Content-Range', [''])[0]
+        match = _CONTENT_RANGE.match(header)
+        if response.code != 206 or not match:
+            self._refused = RangeMismatch(
+                'Requested bytes %d-%s, got %d %r' % (
+                    first, last if last is not None else '', response.code,
+                    header))
+            return
+
+        start, end = int(match.group(1)), int(match.group(2))
+        # the server stops at the end of the body
+        if start != first or (last is not None and end > last):
+            self._refused = RangeMismatch(
+                'Requested bytes %d-%s, got %r' % (
+                    first, last if last is not None else '', header))
+
+    def connectionMade(self):
+        if self._refused is not None:
+            self._refuse()
+            return
+
+        if IConsumer.providedBy(self.consumer):
+            self.consumer.registerProducer(self.transport, True)
+            self._registered = True
+
+    def _refuse(self):
+        d, self.deferred = self.deferred, None
+        if self.transport is not None:
+            self.transport.stopProducing()
+        d.errback(self._refused)
+
+    def _unregister(self):
+        if self._registered:
+            self._registered = False
+            self.consumer.unregisterProducer()
+
+    def dataReceived(self, bytes):
+        if self.deferred is None or self.deferred.called:
+            # done, or cancelled
+            return
+
+        if self._refused is not None:
+            self._refuse()
+            return
+
+        try:
+            self.consumer.write(bytes)
+        except Exception:
+            d, self.deferred = self.deferred, None
+            self._unregister()
+            self.transport.stopProducing()
+            d.errback()
+            return
+        self.written += len(bytes)
+
+    def connectionLost(self, reason):
+        # _newclient and http import reactor
+        from twisted.web._newclient import ResponseDone
+        from twisted.web.http import PotentialDataLoss
+
+        self._unregister()
+        if self.deferred is None or self.deferred.called:
+            # done, or cancelled
+            return
+        d, self.deferred = self.deferred, None
+
+        if self._refused is not None:
+            d.errback(self._refused)
+        elif reason.check(ResponseDone) or reason.check(PotentialDataLoss):
+            d.callback(self.written)
+        else:
+            d.errback(reason)
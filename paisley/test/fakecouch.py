@@ -0,0 +1,894 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_fakecouch -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+An in-memory CouchDB stand-in, served with twisted.web.
+
+It implements the parts of the CouchDB API the client uses, so the client
+can be tested and benchmarked without a CouchDB server:
+
+ - the server: welcome, _all_dbs and _session
+ - databases: create, delete, info, _compact and _view_cleanup
+ - documents: create, read (also at a revision, or if its ETag does not
+   match), update and delete, including design and local documents
+ - _all_docs, also with keys, and _bulk_docs
+ - _changes, normal, longpoll and continuous
+ - _view queries of simple map functions, with _count and _sum reduces
+
+Map functions are not run as javascript; see L{parseMapFunction} for the
+ones understood.  Python map functions can be added with
+L{FakeCouchDB.addView}.  Strings collate by code point instead of by the
+Unicode collation algorithm.
+"""
+
+import base64
+import collections
+import hashlib
+import json
+import re
+import uuid
+
+from urllib.parse import parse_qs
+
+from twisted.web import resource, server
+
+from paisley import client
+
+VERSION = '1.6.1'
+
+
+class CouchError(Exception):
+    """
+    An error response.
+    """
+
+    def __init__(self, code, error, reason):
+        Exception.__init__(self, code, error, reason)
+        self.code = code
+        self.error = error
+        self.reason = reason
+
+
+def _notFound(reason='missing'):
+    return CouchError(404, 'not_found', reason)
+
+
+def _conflict():
+    return CouchError(409, 'conflict', 'Document update conflict.')
+
+
+def collationKey(value):
+    """
+    Return a key sorting JSON values in the order of CouchDB views: null,
+    false, true, numbers, strings, arrays and objects.
+    """
+    if value is None:
+        return (0, )
+    if value is False:
+        return (1, )
+    if value is True:
+        return (2, )
+    if isinstance(value, (int, float)):
+        return (3, value)
+    if isinstance(value, str):
+        return (4, value)
+    if isinstance(value, list):
+        return (5, [collationKey(v) for v in value])
+    return (6, [(k, collationKey(v)) for k, v in value.items()])
+
+
+# function(doc) { [if (doc.x)] emit(key, value); }
+_MAP = re.compile(r'^\s*function\s*\(\s*doc\s*\)\s*\{\s*'
+    r'(?:if\s*\(\s*(?P<cond>doc(?:\.\w+)+)\s*\)\s*\{?\s*)?'
+    r'emit\s*\(\s*(?P<key>.+?)\s*,\s*(?P<value>.+?)\s*\)\s*;?\s*'
+    r'\}?\s*\}\s*$', re.S)
+
+
+def _expression(text):
+    if text == 'doc':
+        return lambda doc: doc
+    if text.startswith('doc.'):
+        path = text.split('.')[1:]
+
+        def get(doc):
+            for name in path:
+                if not isinstance(doc, dict):
+                    return None
+                doc = doc.get(name)
+            return doc
+        return get
+    try:
+        value = json.loads(text)
+    except ValueError:
+        raise ValueError('unsupported expression %r' % (text, ))
+    return lambda doc: value
+
+
+def parseMapFunction(source):
+    """
+    Turn the source of a simple javascript map function into a python one.
+
+    Understood are functions emitting once, optionally only if a member of
+    the document is set, with as key and value the document, a member of
+    it, or a JSON literal::
+
+        function(doc) { if (doc.type) { emit(doc.type, null); } }
+
+    @rtype:   callable
+    @returns: a function taking a document and returning the list of
+              (key, value) pairs it emits.
+    @raises ValueError: if the function is not understood.
+    """
+    m = _MAP.match(source)
+    if m is None:
+        raise ValueError('unsupported map function %r' % (source, ))
+    key = _expression(m.group('key'))
+    value = _expression(m.group('value'))
+    condition = m.group('cond') and _expression(m.group('cond'))
+
+    def mapFunction(doc):
+        if condition is not None and not condition(doc):
+            return []
+        return [(key(doc), value(doc))]
+    return mapFunction
+
+
+class _Database(object):
+    """
+    The documents and the changes of a database.
+
+    @ivar docs:   the latest revision of every document, by id.
+    @type docs:   C{dict} of C{str} -> C{dict}
+    @ivar bySeq:  the id of every document, by the sequence number of its
+                  latest change, in order.
+    @type bySeq:  C{dict} of C{int} -> C{str}
+    @ivar feeds:  callables called with every change.
+    @type feeds:  C{list}
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.seq = 0
+        self.docs = {}
+        self.revisions = {} # (id, rev) -> body of old revisions
+        self.bySeq = {}
+        self.feeds = []
+        self.views = {} # (ddoc id, view) -> (seq, rev, sorted rows)
+
+    def info(self):
+        deleted = sum(1 for d in self.docs.values() if d['deleted'])
+        local = sum(1 for d in self.docs.values() if d['seq'] is None)
+        return {
+            'db_name': self.name,
+            'doc_count': len(self.docs) - deleted - local,
+            'doc_del_count': deleted,
+            'update_seq': self.seq,
+            'purge_seq': 0,
+            'compact_running': False,
+            'disk_size': 0,
+            'instance_start_time': '0',
+            'disk_format_version': 6,
+            'committed_update_seq': self.seq,
+        }
+
+    def get(self, docId, rev=None):
+        doc = self.docs.get(docId)
+        if rev is not None and doc is not None and doc['rev'] != rev:
+            body = self.revisions.get((docId, rev))
+            if body is None:
+                raise _notFound()
+            return dict(doc, rev=rev, body=body, deleted=False)
+        if doc is None:
+            raise _notFound()
+        if doc['deleted']:
+            raise _notFound('deleted')
+        return doc
+
+    def update(self, docId, body, rev=None, deleted=False):
+        """
+        Store a new revision of a document.
+
+        @param rev: the revision it updates, if any.
+
+        @rtype:   C{str}
+        @returns: the new revision.
+        """
+        current = self.docs.get(docId)
+        if current is not None and not current['deleted']:
+            if rev != current['rev']:
+                raise _conflict()
+        elif rev is not None and (current is None or rev != current['rev']):
+            raise _conflict()
+        elif current is None and deleted:
+            raise _notFound()
+
+        generation = 1
+        previous = b''
+        if current is not None:
+            generation = int(current['rev'].split('-')[0]) + 1
+            previous = current['rev'].encode('ascii')
+            if not current['deleted']:
+                self.revisions[(docId, current['rev'])] = current['body']
+
+        body = dict((k, v) for k, v in body.items()
+            if not k.startswith('_') or k == '_attachments')
+        digest = hashlib.md5(previous + json.dumps(body,
+            sort_keys=True).encode('utf-8')).hexdigest()
+        newRev = '%d-%s' % (generation, digest)
+        body['_id'] = docId
+        body['_rev'] = newRev
+        if deleted:
+            body = {'_id': docId, '_rev': newRev, '_deleted': True}
+
+        if docId.startswith('_local/'):
+            if deleted:
+                del self.docs[docId]
+            else:
+                self.docs[docId] = {'rev': newRev, 'body': body,
+                    'deleted': False, 'seq': None}
+            return newRev
+
+        if current is not None and current['seq'] is not None:
+            del self.bySeq[current['seq']]
+        self.seq += 1
+        doc = {'rev': newRev, 'body': body, 'deleted': deleted,
+            'seq': self.seq}
+        self.docs[docId] = doc
+        self.bySeq[self.seq] = docId
+
+        for feed in self.feeds[:]:
+            feed(self.seq, docId, doc)
+        return newRev
+
+    def change(self, seq, docId, doc, includeDocs=False):
+        change = {'seq': seq, 'id': docId,
+            'changes': [{'rev': doc['rev']}]}
+        if doc['deleted']:
+            change['deleted'] = True
+        if includeDocs:
+            change['doc'] = doc['body']
+        return change
+
+    def changes(self, since, includeDocs=False):
+        # every document once, at its latest change
+        for seq, docId in list(self.bySeq.items()):
+            if seq > since:
+                yield self.change(seq, docId, self.docs[docId], includeDocs)
+
+    def compact(self):
+        self.revisions.clear()
+
+
+class _Response(object):
+    """
+    I write a response with the latency and throughput of the server.
+
+    The response starts after the latency of the server, and is then
+    written in chunks at its throughput.
+    """
+
+    def __init__(self, fake, request):
+        self._request = request
+        self._clock = fake.clock
+        self._throughput = fake.throughput
+        self._chunkSize = fake.chunkSize
+        self._fake = fake
+        self._queue = collections.deque()
+        self._call = None
+        self._onClose = []
+        self.closed = False
+
+        request.notifyFinish().addBoth(self._closed)
+        if fake.latency:
+            self._call = self._clock.callLater(fake.latency, self._resume)
+
+    def onClose(self, f):
+        self._onClose.append(f)
+
+    def write(self, data):
+        self._queue.append(data)
+        self._pump()
+
+    def finish(self):
+        self._queue.append(None)
+        self._pump()
+
+    def _resume(self):
+        self._call = None
+        self._pump()
+
+    def _pump(self):
+        while self._call is None and self._queue and not self.closed:
+            data = self._queue.popleft()
+            if data is None:
+                self._request.finish()
+                return
+            if self._throughput:
+                data, rest = data[:self._chunkSize], data[self._chunkSize:]
+                if rest:
+                    self._queue.appendleft(rest)
+                self._call = self._clock.callLater(
+                    float(len(data)) / self._throughput, self._resume)
+            self._fake.bytesSent += len(data)
+            self._request.write(data)
+
+    def _closed(self, _):
+        self.closed = True
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        for f in self._onClose:
+            f()
+
+
+class FakeCouchDB(resource.Resource):
+    """
+    I serve an in-memory CouchDB.
+
+    @ivar latency:     the number of seconds before a response starts.
+    @type latency:     C{float}
+    @ivar throughput:  the number of bytes per second responses are
+                       written at; unlimited if None.
+    @type throughput:  C{float}
+    @ivar chunkSize:   the size of the chunks responses are written in when
+                       limiting the throughput.
+    @type chunkSize:   C{int}
+    @ivar requests:    the number of requests received.
+    @type requests:    C{int}
+    @ivar bytesSent:   the number of bytes of response bodies sent.
+    @type bytesSent:   C{int}
+    """
+    isLeaf = True
+
+    def __init__(self, latency=0, throughput=None, chunkSize=16 * 1024,
+                 users=None, sessionLifetime=600, version=VERSION,
+                 clock=None):
+        """
+        @param users:           if specified, the names and passwords of the
+                                users; requests then need to authenticate
+                                with Basic auth or a session cookie.
+        @type  users:           C{dict} of C{str} -> C{str}
+        @param sessionLifetime: the number of seconds a session is valid.
+        @type  sessionLifetime: C{float}
+        @param version:         the version the server reports.
+        @type  version:         C{str}
+        @param clock:           the clock to delay responses with.
+        @type  clock:           L{twisted.internet.interfaces.IReactorTime}
+        """
+        resource.Resource.__init__(self)
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.latency = latency
+        self.throughput = throughput
+        self.chunkSize = chunkSize
+        self.users = users
+        self.sessionLifetime = sessionLifetime
+        self.version = version
+
+        self.requests = 0
+        self.bytesSent = 0
+
+        self._databases = {}
+        self._sessions = {} # token -> (name, expires)
+        self._maps = {} # (db name, ddoc id, view) -> (map, reduce)
+
+    def addView(self, dbName, designName, viewName, mapFunction,
+                reduceFunction=None):
+        """
+        Add a view with a python map function, to query like any other.
+
+        @param mapFunction:    called with every document; returns the list
+                               of (key, value) pairs it emits.
+        @type  mapFunction:    callable
+        @param reduceFunction: if specified, _count or _sum.
+        @type  reduceFunction: C{str}
+        """
+        self._maps[(dbName, '_design/' + designName, viewName)] = (
+            mapFunction, reduceFunction)
+
+    def getDatabase(self, dbName):
+        """
+        Return the documents and changes of a database, to inspect them.
+
+        @rtype: L{_Database}
+        """
+        try:
+            return self._databases[dbName]
+        except KeyError:
+            raise _notFound('no_db_file')
+
+    def render(self, request):
+        self.requests += 1
+        response = _Response(self, request)
+        request.setHeader(b'content-type', b'application/json')
+        request.setHeader(b'server', b'paisley fake CouchDB')
+
+        path = [segment.decode('utf-8') for segment in request.postpath]
+        if path and not path[-1]:
+            path.pop()
+        method = request.method.decode('ascii')
+        args = dict((key.decode('utf-8'), values[-1].decode('utf-8'))
+            for key, values in request.args.items())
+
+        try:
+            self._authenticate(request, method, path)
+            result = self._dispatch(request, response, method, path, args)
+        except CouchError as e:
+            request.setResponseCode(e.code)
+            result = {'error': e.error, 'reason': e.reason}
+
+        if result is not server.NOT_DONE_YET:
+            self._send(request, response, result)
+        return server.NOT_DONE_YET
+
+    def _send(self, request, response, result):
+        if isinstance(result, bytes):
+            body = result
+        else:
+            body = json.dumps(result).encode('utf-8') + b'\n'
+        request.setHeader(b'content-length', str(len(body)).encode('ascii'))
+        if request.method != b'HEAD':
+            response.write(body)
+        response.finish()
+
+    # authentication
+
+    def _authenticate(self, request, method, path):
+        if not self.users or path in ([], ['_session']):
+            return
+
+        authorization = request.getHeader(b'authorization')
+        if authorization and authorization.startswith(b'Basic '):
+            try:
+                credentials = base64.b64decode(authorization[6:]).decode(
+                    'utf-8')
+            except ValueError:
+                credentials = ''
+            name, _, password = credentials.partition(':')
+            if self.users.get(name) == password and name:
+                return
+
+        if self._sessionName(request) is not None:
+            return
+        raise CouchError(401, 'unauthorized',
+            'You are not authorized to access this db.')
+
+    def _sessionName(self, request):
+        token = request.getCookie(b'AuthSession')
+        if token is None:
+            return None
+        name, expires = self._sessions.get(token.decode('ascii'),
+            (None, 0))
+        if expires <= self.clock.seconds():
+            return None
+        return name
+
+    def _session(self, request, method):
+        if method == 'GET':
+            name = self._sessionName(request)
+            return {'ok': True,
+                'userCtx': {'name': name, 'roles': []},
+                'info': {'authentication_db': '_users',
+                    'authentication_handlers': ['cookie', 'default']}}
+
+        if method == 'DELETE':
+            token = request.getCookie(b'AuthSession')
+            if token is not None:
+                self._sessions.pop(token.decode('ascii'), None)
+            request.addCookie(b'AuthSession', b'', path=b'/')
+            return {'ok': True}
+
+        if method != 'POST':
+            raise CouchError(405, 'method_not_allowed',
+                'Only GET,HEAD,POST,DELETE allowed')
+
+        body = request.content.read()
+        contentType = request.getHeader(b'content-type') or b''
+        if contentType.startswith(b'application/json'):
+            form = json.loads(body)
+        else:
+            form = dict((key, values[-1]) for key, values in parse_qs(
+                body.decode('utf-8')).items())
+        name = form.get('name')
+        if self.users is not None and \
+                self.users.get(name) != form.get('password'):
+            raise CouchError(401, 'unauthorized',
+                'Name or password is incorrect.')
+
+        token = uuid.uuid4().hex
+        self._sessions[token] = (name,
+            self.clock.seconds() + self.sessionLifetime)
+        request.addCookie(b'AuthSession', token.encode('ascii'), path=b'/',
+            max_age=str(int(self.sessionLifetime)).encode('ascii'),
+            httpOnly=True)
+        return {'ok': True, 'name': name, 'roles': []}
+
+    # requests
+
+    def _dispatch(self, request, response, method, path, args):
+        if not path:
+            return {'couchdb': 'Welcome', 'version': self.version}
+        if path == ['_all_dbs']:
+            return sorted(self._databases)
+        if path == ['_session']:
+            return self._session(request, method)
+        if path[0].startswith('_'):
+            raise _notFound()
+
+        dbName = path[0]
+        if len(path) == 1:
+            return self._database(request, method, dbName)
+
+        db = self.getDatabase(dbName)
+        name = path[1]
+        if name in ('_compact', '_view_cleanup', '_ensure_full_commit'):
+            if method != 'POST':
+                raise CouchError(405, 'method_not_allowed',
+                    'Only POST allowed')
+            if name == '_compact':
+                db.compact()
+            request.setResponseCode(202)
+            return {'ok': True}
+        if name == '_all_docs':
+            return self._allDocs(request, db, args)
+        if name == '_bulk_docs':
+            return self._bulkDocs(request, db)
+        if name == '_changes':
+            return self._changes(request, response, db, args)
+
+        if name in ('_design', '_local'):
+            if len(path) < 3:
+                raise _notFound()
+            docId = '%s/%s' % (name, path[2])
+            rest = path[3:]
+        else:
+            docId = name
+            rest = path[2:]
+
+        if rest and rest[0] == '_view' and name == '_design' and \
+                len(rest) == 2:
+            return self._view(request, db, docId, rest[1], args)
+        if rest:
+            raise _notFound('Attachments are not supported')
+        return self._document(request, method, db, docId, args)
+
+    def _readJSON(self, request):
+        try:
+            return json.loads(request.content.read().decode('utf-8'))
+        except ValueError:
+            raise CouchError(400, 'bad_request', 'invalid UTF-8 JSON')
+
+    def _database(self, request, method, dbName):
+        if method == 'PUT':
+            if dbName in self._databases:
+                raise CouchError(412, 'file_exists',
+                    'The database could not be created, the file already '
+                    'exists.')
+            self._databases[dbName] = _Database(dbName)
+            request.setResponseCode(201)
+            return {'ok': True}
+
+        db = self.getDatabase(dbName)
+        if method == 'DELETE':
+            del self._databases[dbName]
+            for feed in db.feeds[:]:
+                feed(None, None, None)
+            return {'ok': True}
+        if method == 'POST':
+            body = self._readJSON(request)
+            docId = body.get('_id') or uuid.uuid4().hex
+            rev = db.update(docId, body, body.get('_rev'))
+            request.setResponseCode(201)
+            return {'ok': True, 'id': docId, 'rev': rev}
+        return db.info()
+
+    def _document(self, request, method, db, docId, args):
+        if method in ('GET', 'HEAD'):
+            doc = db.get(docId, args.get('rev'))
+            body = doc['body']
+            if args.get('revs') == 'true':
+                generation, digest = doc['rev'].split('-', 1)
+                body = dict(body, _revisions={'start': int(generation),
+                    'ids': [digest]})
+            etag = ('"%s"' % (doc['rev'], )).encode('ascii')
+            request.setHeader(b'etag', etag)
+            if request.getHeader(b'if-none-match') == etag:
+                request.setResponseCode(304)
+                return b''
+            return body
+
+        if method == 'PUT':
+            body = self._readJSON(request)
+            rev = db.update(docId, body, args.get('rev', body.get('_rev')))
+            request.setResponseCode(201)
+            return {'ok': True, 'id': docId, 'rev': rev}
+
+        if method == 'DELETE':
+            rev = db.update(docId, {}, args.get('rev'), deleted=True)
+            return {'ok': True, 'id': docId, 'rev': rev}
+
+        raise CouchError(405, 'method_not_allowed',
+            'Only DELETE,GET,HEAD,PUT allowed')
+
+    def _bulkDocs(self, request, db):
+        results = []
+        for body in self._readJSON(request).get('docs', []):
+            docId = body.get('_id') or uuid.uuid4().hex
+            try:
+                rev = db.update(docId, body, body.get('_rev'),
+                    deleted=body.get('_deleted', False))
+            except CouchError as e:
+                results.append({'id': docId, 'error': e.error,
+                    'reason': e.reason})
+            else:
+                results.append({'ok': True, 'id': docId, 'rev': rev})
+        request.setResponseCode(201)
+        return results
+
+    def _rows(self, header, rows):
+        """
+        Encode a response with rows one per line, as CouchDB does.
+        """
+        encoded = json.dumps(header).encode('utf-8')[:-1]
+        if header:
+            encoded += b','
+        rows = [json.dumps(row).encode('utf-8') for row in rows]
+        return (encoded + b'"rows":[\r\n' + b',\r\n'.join(rows) +
+            b'\r\n]}\n')
+
+    def _range(self, rows, args, keyOf):
+        """
+        Apply the range, order and paging arguments of a query to sorted
+        rows.
+        """
+        descending = 'true' in (args.get('descending'), args.get('reverse'))
+        if descending:
+            rows = rows[::-1]
+        startkey = _jsonArg(args, 'startkey', _jsonArg(args, 'start_key'))
+        endkey = _jsonArg(args, 'endkey', _jsonArg(args, 'end_key'))
+        key = _jsonArg(args, 'key')
+        inclusiveEnd = args.get('inclusive_end') != 'false'
+
+        selected = []
+        for row in rows:
+            k = keyOf(row)
+            if key is not None and k != collationKey(key):
+                continue
+            if startkey is not None:
+                start = collationKey(startkey)
+                if (k < start) if not descending else (k > start):
+                    continue
+            if endkey is not None:
+                end = collationKey(endkey)
+                if descending:
+                    past = k < end or (k == end and not inclusiveEnd)
+                else:
+                    past = k > end or (k == end and not inclusiveEnd)
+                if past:
+                    break
+            selected.append(row)
+
+        skip = int(args.get('skip', 0))
+        offset = len(rows) - len(selected)
+        selected = selected[skip:]
+        if int(args.get('limit', -1)) >= 0:
+            selected = selected[:int(args['limit'])]
+        return offset + skip, selected
+
+    def _allDocs(self, request, db, args):
+        includeDocs = args.get('include_docs', '').lower() == 'true'
+
+        def row(docId, doc):
+            result = {'id': docId, 'key': docId,
+                'value': {'rev': doc['rev']}}
+            if doc['deleted']:
+                result['value']['deleted'] = True
+            if includeDocs:
+                result['doc'] = None if doc['deleted'] else doc['body']
+            return result
+
+        docs = [(docId, doc) for docId, doc in db.docs.items()
+            if not doc['deleted'] and not docId.startswith('_local/')]
+        total = len(docs)
+        if request.method == b'POST':
+            rows = []
+            for key in self._readJSON(request).get('keys', []):
+                doc = db.docs.get(key)
+                if doc is None:
+                    rows.append({'key': key, 'error': 'not_found'})
+                else:
+                    rows.append(row(key, doc))
+            return self._rows({'total_rows': total, 'offset': 0}, rows)
+
+        docs.sort(key=lambda item: collationKey(item[0]))
+        offset, docs = self._range(docs,
+            args, lambda item: collationKey(item[0]))
+        return self._rows({'total_rows': total, 'offset': offset},
+            [row(docId, doc) for docId, doc in docs])
+
+    def _changes(self, request, response, db, args):
+        includeDocs = args.get('include_docs', '').lower() == 'true'
+        since = int(args.get('since') or 0) if args.get('since') != 'now' \
+            else db.seq
+        feed = args.get('feed', 'normal')
+        changes = list(db.changes(since, includeDocs))
+
+        if feed == 'continuous':
+            request.setHeader(b'content-type', b'text/plain; charset=utf-8')
+
+            def write(change):
+                response.write(json.dumps(change).encode('utf-8') + b'\n')
+
+            def changed(seq, docId, doc):
+                if seq is None:
+                    # the database was deleted
+                    close()
+                    response.finish()
+                    return
+                write(db.change(seq, docId, doc, includeDocs))
+
+            def close():
+                if changed in db.feeds:
+                    db.feeds.remove(changed)
+            # the headers go out right away, even without changes yet
+            response.write(b'')
+            for change in changes:
+                write(change)
+            db.feeds.append(changed)
+            response.onClose(close)
+            return server.NOT_DONE_YET
+
+        if feed == 'longpoll' and not changes:
+
+            def changed(seq, docId, doc):
+                db.feeds.remove(changed)
+                results = []
+                if seq is not None:
+                    results.append(db.change(seq, docId, doc, includeDocs))
+                self._send(request, response, {'results': results,
+                    'last_seq': seq or db.seq})
+            db.feeds.append(changed)
+            response.onClose(lambda: changed in db.feeds and
+                db.feeds.remove(changed))
+            return server.NOT_DONE_YET
+
+        lastSeq = changes and changes[-1]['seq'] or since
+        return {'results': changes, 'last_seq': lastSeq}
+
+    def _viewRows(self, db, docId, viewName):
+        """
+        Return the sorted rows of a view, and its reduce function.
+        """
+        mapped = self._maps.get((db.name, docId, viewName))
+        ddoc = None
+        if mapped is None:
+            ddoc = db.get(docId)
+            try:
+                view = ddoc['body']['views'][viewName]
+            except KeyError:
+                raise _notFound('missing_named_view')
+            try:
+                mapped = (parseMapFunction(view['map']), view.get('reduce'))
+            except ValueError as e:
+                raise CouchError(500, 'unsupported', str(e))
+        mapFunction, reduceFunction = mapped
+
+        rev = ddoc and ddoc['rev']
+        cached = db.views.get((docId, viewName))
+        if cached is not None and cached[:2] == (db.seq, rev):
+            return cached[2], reduceFunction
+
+        rows = []
+        for key, doc in db.docs.items():
+            if doc['deleted'] or key.startswith(('_design/', '_local/')):
+                continue
+            for emitted, value in mapFunction(doc['body']):
+                rows.append({'id': key, 'key': emitted, 'value': value})
+        rows.sort(key=lambda row: (collationKey(row['key']), row['id']))
+        db.views[(docId, viewName)] = (db.seq, rev, rows)
+        return rows, reduceFunction
+
+    def _view(self, request, db, docId, viewName, args):
+        rows, reduceFunction = self._viewRows(db, docId, viewName)
+        keyOf = lambda row: collationKey(row['key'])
+
+        if request.method == b'POST':
+            keys = self._readJSON(request).get('keys', [])
+            selected = []
+            for key in keys:
+                selected.extend(row for row in rows
+                    if keyOf(row) == collationKey(key))
+            offset = 0
+        else:
+            offset, selected = self._range(rows, args, keyOf)
+
+        if reduceFunction and args.get('reduce') != 'false':
+            return self._reduce(selected, reduceFunction,
+                args.get('group') == 'true')
+
+        if args.get('include_docs', '').lower() == 'true':
+            selected = [dict(row, doc=db.docs[row['id']]['body'])
+                for row in selected]
+        header = {'total_rows': len(rows), 'offset': offset}
+        if args.get('update_seq') == 'true':
+            header['update_seq'] = db.seq
+        return self._rows(header, selected)
+
+    def _reduce(self, rows, reduceFunction, group):
+        if reduceFunction == '_count':
+            reduce = len
+        elif reduceFunction == '_sum':
+            reduce = lambda values: sum(row['value'] for row in values)
+        else:
+            raise CouchError(500, 'unsupported',
+                'only _count and _sum reduce functions are supported')
+
+        if not group:
+            return self._rows({}, [{'key': None, 'value': reduce(rows)}]
+                if rows else [])
+        groups = collections.OrderedDict()
+        for row in rows:
+            groups.setdefault(json.dumps(row['key'], sort_keys=True),
+                (row['key'], []))[1].append(row)
+        return self._rows({}, [{'key': key, 'value': reduce(grouped)}
+            for key, grouped in groups.values()])
+
+
+def _jsonArg(args, name, default=None):
+    if name not in args:
+        return default
+    try:
+        return json.loads(args[name])
+    except ValueError:
+        # older clients send some keys as they are
+        return args[name]
+
+
+class FakeCouchDBServer(object):
+    """
+    I run a L{FakeCouchDB} on a free local port, in the way
+    L{paisley.test.util.CouchDBWrapper} runs a real one.
+
+    @ivar resource: the fake CouchDB.
+    @type resource: L{FakeCouchDB}
+    @ivar port:     the port the server listens on.
+    @type port:     C{int}
+    @ivar db:       a client of the server.
+    @type db:       L{client.CouchDB}
+    """
+
+    def __init__(self, **kwargs):
+        """
+        Takes the keyword arguments of L{FakeCouchDB}.
+        """
+        self.resource = FakeCouchDB(**kwargs)
+        self.port = None
+        self.db = None
+        self._listening = None
+
+    def start(self, **kwargs):
+        """
+        Start listening, and create a client of the server with the keyword
+        arguments of L{client.CouchDB}.
+        """
+        from twisted.internet import reactor
+        site = server.Site(self.resource)
+        site.noisy = False
+        self._listening = reactor.listenTCP(0, site, interface='127.0.0.1')
+        self.port = self._listening.getHost().port
+        self.db = client.CouchDB('127.0.0.1', self.port, **kwargs)
+        return self.db
+
+    def stop(self):
+        """
+        Stop listening and close the connections of the client.
+
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+        d = self.db.closeCachedConnections()
+        d.addCallback(lambda _: self._listening.stopListening())
+        return d
@@ -0,0 +1,152 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_aio -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Test for the asyncio API.
+"""
+
+import asyncio
+
+from twisted.trial.unittest import TestCase
+from twisted.web._newclient import ResponseDone
+from twisted.python.failure import Failure
+
+from paisley import aio
+
+from paisley.test.test_client import FakeAgent, FakeResponse
+from paisley.test.test_stream import FakeTransport
+
+
+class StreamingResponse(FakeResponse):
+    """
+    A response delivering its body in chunks, when the test says so.
+    """
+
+    def deliverBody(self, protocol):
+        self.protocol = protocol
+        protocol.makeConnection(FakeTransport())
+
+    def send(self, data):
+        self.protocol.dataReceived(data)
+
+    def finish(self):
+        self.protocol.connectionLost(Failure(ResponseDone()))
+
+
+class AsyncCouchDBTestCase(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.agent = FakeAgent()
+        self.couch = aio.AsyncCouchDB("localhost", loop=self.loop)
+        self.couch.couch.client = self.agent
+
+    def _respond(self, index, response):
+        # the request is done once the coroutine runs
+        self.loop.call_soon(
+            lambda: self.agent.requests[index][4].callback(response))
+
+    def test_methods(self):
+        for name in aio.METHODS:
+            self.failUnless(asyncio.iscoroutinefunction(
+                getattr(aio.AsyncCouchDB, name)))
+
+    def test_infoDB(self):
+
+        async def run():
+            self._respond(0, FakeResponse(body=b'{"db_name": "mydb"}'))
+            return await self.couch.infoDB("mydb")
+        result = self.loop.run_until_complete(run())
+        self.assertEquals(result, {"db_name": "mydb"})
+        self.assertEquals(self.agent.requests[0][1],
+            b"http://localhost:5984/mydb/")
+
+    def test_error(self):
+        from twisted.web import error as tw_error
+
+        async def run():
+            self._respond(0, FakeResponse(404, body=b'{"error": "x"}'))
+            await self.couch.infoDB("mydb")
+        self.assertRaises(tw_error.Error, self.loop.run_until_complete, run())
+
+    def test_cancel(self):
+
+        async def run():
+            task = self.loop.create_task(self.couch.infoDB("mydb"))
+            await asyncio.sleep(0)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.loop.run_until_complete(run())
+        # the request was cancelled
+        self.failUnless(self.agent.requests[0][4].called)
+
+    def test_iterView(self):
+        response = StreamingResponse()
+
+        async def run():
+            rows = []
+            feed = self.couch.iterView("mydb", "design", "view", highWater=2)
+            self._respond(0, response)
+            self.loop.call_soon(response.send,
+                b'{"total_rows": 4, "rows": '
+                b'[{"id": "a"}, {"id": "b"}, {"id": "c"}, ')
+            async for row in feed:
+                rows.append(row)
+                if len(rows) == 1:
+                    # two rows waiting pause receiving
+                    self.failUnless(response.protocol.transport.paused)
+                elif len(rows) == 2:
+                    self.failIf(response.protocol.transport.paused)
+                    response.send(b'{"id": "d"}]}')
+                    response.finish()
+            return rows, feed.header
+        rows, header = self.loop.run_until_complete(run())
+        self.assertEquals([r['id'] for r in rows], ['a', 'b', 'c', 'd'])
+        self.assertEquals(header, {'total_rows': 4})
+
+    def test_iterChanges(self):
+        response = StreamingResponse()
+
+        async def run():
+            changes = []
+            feed = self.couch.iterChanges("mydb", since=5)
+            self._respond(0, response)
+            self.loop.call_soon(response.send,
+                b'{"seq": 6, "id": "a", "changes": []}\n'
+                b'{"seq": 7, "id": "b", "changes": []}\n')
+            async for change in feed:
+                changes.append(change)
+                if len(changes) == 2:
+                    await feed.aclose()
+            return changes
+        changes = self.loop.run_until_complete(run())
+        self.assertEquals([c['seq'] for c in changes], [6, 7])
+        self.assertEquals(self.agent.requests[0][1],
+            b"http://localhost:5984/mydb/_changes?feed=continuous&since=5")
+        self.failUnless(response.protocol.transport.stopped)
+
+    def test_iterChangesFailed(self):
+        from twisted.web import error as tw_error
+
+        async def run():
+            feed = self.couch.iterChanges("mydb")
+            # getting the update_seq to start from fails
+            self._respond(0, FakeResponse(404, body=b'{"error": "x"}'))
+            errors = []
+            for i in range(2):
+                try:
+                    await feed.__anext__()
+                except tw_error.Error as e:
+                    errors.append(e)
+            return errors
+        errors = self.loop.run_until_complete(
+            asyncio.wait_for(run(), 5))
+        self.assertEquals(len(errors), 2)
+        self.assertEquals(len(self.agent.requests), 1)
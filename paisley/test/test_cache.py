@@ -8,11 +8,18 @@
 Test for couchdb client caching implementation.
 """
 
-from twisted.internet import defer
+import json
 
-from paisley import client
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+from paisley import changes, client
+from paisley.cache import LRUCache, SQLiteCache, StaleEntry, ViewCache, \
+    estimateSize
 
 from paisley.test import util
+from paisley.test.fakecouch import FakeCouchDBServer
+from paisley.test.test_client import FakeAgent, FakeResponse
 
 
 class MemoryCacheTestCase(util.CouchDBTestCase):
@@ -69,3 +76,524 @@ class MemoryCacheTestCase(util.CouchDBTestCase):
 
         d.callback(None)
         return d
+
+
+class MemoryCacheCountersTestCase(TestCase):
+
+    def test_deleteBoth(self):
+        cache = client.MemoryCache()
+        cache.store('a', {})
+        cache.store('a', {})
+        cache.mapped('a', object())
+        self.assertEquals(cache.cached, 2)
+        cache.delete('a')
+        cache.delete('a')
+        self.assertEquals(cache.cached, 0)
+
+    def test_namespaces(self):
+        cache = client.MemoryCache()
+        cache.store('a', {'db': 1}, namespace='db1')
+        cache.store('a', {'db': 2}, namespace='db2')
+        cache.mapped('a', object(), namespace='db1')
+        self.assertEquals(cache.stats('db1'), {'cached': 2})
+        self.assertRaises(KeyError, cache.get, 'a')
+
+        cache.flush('db1')
+        self.assertRaises(KeyError, cache.get, 'a', 'db1')
+        self.assertEquals(cache.cached, 1)
+
+    def test_refresh(self):
+        cache = client.MemoryCache()
+        cache.store('a', {'_rev': '1-a'})
+        cache.mapped('a', object())
+        cache.refresh('a', {'_rev': '2-a'})
+        cache.refresh('b', {'_rev': '1-b'})
+        self.assertEquals(cache._docCache[None], {'a': {'_rev': '2-a'}})
+        self.assertEquals(cache.cached, 1)
+
+
+class LRUCacheTestCase(TestCase):
+
+    def _get(self, cache, key):
+        results = []
+        cache.get(key).addCallback(results.append)
+        return results[0]
+
+    def test_maxEntries(self):
+        cache = LRUCache(maxEntries=2)
+        cache.store('a', {'a': 1})
+        cache.store('b', {'b': 1})
+        # a is now used more recently than b
+        self._get(cache, 'a')
+        cache.store('c', {'c': 1})
+        self.assertRaises(KeyError, cache.get, 'b')
+        self.assertEquals(self._get(cache, 'a'), {'a': 1})
+
+        stats = cache.stats()['docs']
+        self.assertEquals((stats['entries'], stats['hits'], stats['misses'],
+            stats['evictions']), (2, 2, 1, 1))
+        self.assertEquals((cache.lookups, cache.hits, cache.cached),
+            (3, 2, 2))
+
+    def test_maxBytes(self):
+        cache = LRUCache(maxEntries=None, maxBytes=100,
+            sizeOf=lambda doc: doc['size'])
+        cache.store('a', {'size': 40})
+        cache.store('b', {'size': 40})
+        cache.store('c', {'size': 40})
+        self.assertEquals(cache.stats()['docs']['bytes'], 80)
+        self.assertRaises(KeyError, cache.get, 'a')
+
+        # too large to cache at all
+        cache.store('d', {'size': 101})
+        self.assertRaises(KeyError, cache.get, 'd')
+        self.assertEquals(cache.stats()['docs']['entries'], 2)
+
+        cache.delete('b')
+        self.assertEquals(cache.stats()['docs']['bytes'], 40)
+
+    def test_separateLimits(self):
+        cache = LRUCache(maxEntries=1, maxObjects=2)
+        cache.store('a', {})
+        cache.mapped('a', object())
+        cache.mapped('b', object())
+        cache.store('b', {})
+        self.assertEquals(cache.stats()['docs']['entries'], 1)
+        self.assertEquals(cache.stats()['objects']['entries'], 2)
+        self.assertEquals(cache.cached, 3)
+
+        # deleting counts both
+        cache.delete('b')
+        self.assertEquals(cache.cached, 1)
+
+    def test_estimateSize(self):
+        small = estimateSize({'a': 'b'})
+        self.failUnless(estimateSize({'a': 'bc' * 1000}) > small + 1000)
+        self.failUnless(estimateSize({'a': ['b', {'c': 'd'}]}) > small)
+
+    def test_client(self):
+        cache = LRUCache()
+        agent = FakeAgent()
+        couch = client.CouchDB("localhost", cache=cache)
+        couch.client = agent
+
+        d = couch.openDoc("mydb", "mydoc")
+        agent.requests[0][4].callback(FakeResponse(
+            body=b'{"_id": "mydoc", "_rev": "1-a"}'))
+        d.addCallback(lambda _: couch.openDoc("mydb", "mydoc"))
+
+        def cb(doc):
+            self.assertEquals(doc['_rev'], '1-a')
+            self.assertEquals(len(agent.requests), 1)
+            self.assertEquals(couch.getCacheStats()['docs']['hits'], 1)
+        d.addCallback(cb)
+        return d
+
+
+class NamespaceTestCase(TestCase):
+
+    def setUp(self):
+        self.cache = LRUCache(maxEntries=3, maxBytes=1000,
+            sizeOf=lambda value: value.get('size', 0))
+
+    def test_separate(self):
+        self.cache.store('a', {'size': 10}, namespace='db1')
+        self.cache.store('a', {'size': 20}, namespace='db2')
+        results = []
+        self.cache.get('a', 'db2').addCallback(results.append)
+        self.assertEquals(results, [{'size': 20}])
+        self.assertRaises(KeyError, self.cache.get, 'a')
+
+        self.cache.delete('a', 'db1')
+        self.assertRaises(KeyError, self.cache.get, 'a', 'db1')
+        self.assertEquals(self.cache.stats()['docs']['entries'], 1)
+
+    def test_accounting(self):
+        self.cache.store('a', {'size': 10}, namespace='db1')
+        self.cache.store('b', {'size': 20}, namespace='db1')
+        self.cache.store('a', {'size': 40}, namespace='db2')
+        self.assertEquals(self.cache.stats('db1')['docs'],
+            {'entries': 2, 'bytes': 30})
+
+        # evictions are accounted to the namespace of the entry
+        self.cache.store('c', {'size': 80}, namespace='db2')
+        self.assertEquals(self.cache.stats('db1')['docs'],
+            {'entries': 1, 'bytes': 20})
+        self.assertEquals(self.cache.stats('db2')['docs'],
+            {'entries': 2, 'bytes': 120})
+
+    def test_refresh(self):
+        self.cache.store('a', {'size': 10}, namespace='db1')
+        self.cache.store('b', {'size': 20}, namespace='db1')
+        self.cache.mapped('a', object(), namespace='db1')
+        results = []
+        self.cache.refresh('a', {'size': 30}, 'db1').addCallback(
+            results.append)
+        self.cache.refresh('c', {'size': 30}, 'db1').addCallback(
+            results.append)
+        self.assertEquals(results, [True, False])
+        self.assertEquals(self.cache.stats('db1'), {
+            'docs': {'entries': 2, 'bytes': 50},
+            'objects': {'entries': 0, 'bytes': None},
+        })
+
+        # refreshing is not using: a is still the least recently used
+        self.cache.store('c', {}, namespace='db1')
+        self.cache.store('d', {}, namespace='db1')
+        self.assertRaises(KeyError, self.cache.get, 'a', 'db1')
+
+    def test_flush(self):
+        self.cache.store('a', {}, namespace='db1')
+        self.cache.mapped('a', object(), namespace='db1')
+        self.cache.store('a', {}, namespace='db2')
+        results = []
+        self.cache.flush('db1').addCallback(results.append)
+        self.assertEquals(results, [2])
+        self.assertEquals(self.cache.stats('db1')['docs']['entries'], 0)
+        self.assertEquals(self.cache.cached, 1)
+
+    def test_client(self):
+        agent = FakeAgent()
+        couch = client.CouchDB("localhost", cache=self.cache)
+        couch.client = agent
+
+        d = couch.openDoc("db1", "mydoc")
+        agent.requests[0][4].callback(FakeResponse(
+            body=b'{"_id": "mydoc", "_rev": "1-a"}'))
+        d.addCallback(lambda _: couch.openDoc("db2", "mydoc"))
+        agent.requests[1][4].callback(FakeResponse(
+            body=b'{"_id": "mydoc", "_rev": "1-b"}'))
+
+        def cb(doc):
+            self.assertEquals(doc['_rev'], '1-b')
+            self.assertEquals(couch.getCacheStats('db1')['docs']['entries'],
+                1)
+
+            # the changes of a database only delete its docs
+            notifier = changes.ChangeNotifier(couch, 'db1')
+            notifier.addCache(self.cache)
+            notifier.changed({'id': 'mydoc', 'seq': 2})
+            self.assertEquals(couch.getCacheStats('db1')['docs']['entries'],
+                0)
+            return couch.flushCache('db2')
+        d.addCallback(cb)
+        d.addCallback(self.assertEquals, 1)
+        return d
+
+    def test_clientMapped(self):
+        couch = client.CouchDB("localhost", cache=self.cache)
+        obj = object()
+        couch.mapped('a', obj, 'db1')
+        self.assertEquals(couch.getCacheStats('db1')['objects']['entries'],
+            1)
+
+        # without a database, as before namespaces
+        couch.mapped('b', obj)
+        results = []
+        self.cache.getObject('b').addCallback(results.append)
+        self.assertEquals(results, [obj])
+
+
+class RevalidatingCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = LRUCache(freshness=10, clock=self.clock)
+
+    def test_stale(self):
+        self.cache.store('a', {'_id': 'a', '_rev': '1-a'})
+        self.clock.advance(9)
+        self.cache.get('a')
+        self.clock.advance(1)
+        e = self.assertRaises(client.StaleEntry, self.cache.get, 'a')
+        self.assertEquals(e.etag, '"1-a"')
+
+        self.cache.revalidated('a', e.value)
+        self.cache.get('a')
+        stats = self.cache.stats()['docs']
+        self.assertEquals((stats['hits'], stats['revalidatedHits'],
+            stats['refetches']), (2, 1, 0))
+
+    def test_noRevision(self):
+        # without a revision to revalidate with, stale is missing
+        self.cache.store('a', {})
+        self.clock.advance(10)
+        self.assertRaises(KeyError, self.cache.get, 'a')
+
+    def test_objects(self):
+        obj = object()
+        self.cache.mapped('a', obj)
+        self.clock.advance(10)
+        self.assertRaises(KeyError, self.cache.getObject, 'a')
+
+    def test_client(self):
+        agent = FakeAgent()
+        couch = client.CouchDB("localhost", cache=self.cache)
+        couch.client = agent
+
+        d = couch.openDoc("mydb", "mydoc")
+        agent.requests[0][4].callback(FakeResponse(
+            body=b'{"_id": "mydoc", "_rev": "1-a"}'))
+
+        def notModified(_):
+            self.clock.advance(10)
+            d = couch.openDoc("mydb", "mydoc")
+            headers = agent.requests[1][2]
+            self.assertEquals(headers.getRawHeaders('If-None-Match'),
+                ['"1-a"'])
+            agent.requests[1][4].callback(FakeResponse(304))
+            return d
+
+        def changed(doc):
+            self.assertEquals(doc['_rev'], '1-a')
+            self.clock.advance(10)
+            d = couch.openDoc("mydb", "mydoc")
+            agent.requests[2][4].callback(FakeResponse(
+                body=b'{"_id": "mydoc", "_rev": "2-b"}'))
+            return d
+
+        def check(doc):
+            self.assertEquals(doc['_rev'], '2-b')
+            stats = couch.getCacheStats()['docs']
+            self.assertEquals((stats['revalidatedHits'], stats['refetches']),
+                (1, 1))
+        d.addCallback(notModified)
+        d.addCallback(changed)
+        d.addCallback(check)
+        return d
+
+    def test_openDocsEvicts(self):
+        agent = FakeAgent()
+        couch = client.CouchDB("localhost", cache=self.cache, timeout=None)
+        couch.client = agent
+        namespace = couch.cacheNamespace('mydb')
+        self.cache.store('c', {'_id': 'c', '_rev': '1-a'},
+            namespace=namespace)
+        self.cache.store('d', {'_id': 'd', '_rev': '1-a'},
+            namespace=namespace)
+        self.clock.advance(10)
+
+        d = couch.openDocs("mydb", ['c', 'd'])
+        agent.requests[0][4].callback(FakeResponse(body=json.dumps({
+            'total_rows': 2, 'offset': 0, 'rows': [
+                {'id': 'c', 'key': 'c',
+                 'value': {'rev': '2-b', 'deleted': True}, 'doc': None},
+                {'key': 'd', 'error': 'not_found'}]}).encode('utf-8')))
+
+        def check(result):
+            self.assertEquals([r['error'] for r in result],
+                ['deleted', 'not_found'])
+            for docId in ('c', 'd'):
+                # gone, not just stale
+                e = self.assertRaises(KeyError,
+                    self.cache.get, docId, namespace)
+                self.assertFalse(isinstance(e, StaleEntry))
+        d.addCallback(check)
+        return d
+
+
+class ViewCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = ViewCache(clock=self.clock)
+        self.agent = FakeAgent()
+        self.couch = client.CouchDB("localhost", viewCache=self.cache,
+            timeout=None)
+        self.couch.client = self.agent
+        self.namespace = self.couch.cacheNamespace('mydb')
+
+    def _respond(self, seq, rows=()):
+        self.agent.requests[-1][4].callback(FakeResponse(body=json.dumps({
+            'total_rows': len(rows), 'offset': 0, 'update_seq': seq,
+            'rows': list(rows)}).encode('utf-8')))
+
+    def test_seq(self):
+        key = ('d', 'v', (), None)
+        # without a known update_seq, nothing is served
+        self.cache.store(self.namespace, key, {'rows': []}, 3)
+        self.assertRaises(KeyError, self.cache.get, self.namespace, key)
+
+        self.cache.advance(self.namespace, 3)
+        self.assertEquals(self.cache.get(self.namespace, key),
+            ({'rows': []}, True))
+        self.cache.advance(self.namespace, 2)
+        self.assertEquals(self.cache.seq(self.namespace), 3)
+        self.cache.advance(self.namespace, 4)
+        self.assertEquals(self.cache.get(self.namespace, key),
+            ({'rows': []}, False))
+
+        stats = self.cache.stats()
+        self.assertEquals((stats['hits'], stats['staleHits'],
+            stats['misses']), (1, 1, 1))
+
+    def test_opaqueSeq(self):
+        # CouchDB 2.x seqs are strings that do not sort as they advance
+        key = ('d', 'v', (), None)
+        self.cache.store(self.namespace, key, {'rows': []}, '9-g1AAAAB')
+        self.cache.advance(self.namespace, '9-g1AAAAB')
+        self.assertEquals(self.cache.get(self.namespace, key),
+            ({'rows': []}, True))
+        self.cache.advance(self.namespace, '8-g1AAAAC')
+        self.assertEquals(self.cache.seq(self.namespace), '9-g1AAAAB')
+        self.cache.advance(self.namespace, '10-g1AAAAA')
+        self.assertEquals(self.cache.seq(self.namespace), '10-g1AAAAA')
+        self.assertEquals(self.cache.get(self.namespace, key),
+            ({'rows': []}, False))
+
+        # without a number, any other seq is newer
+        self.cache.store(self.namespace, key, {'rows': []}, 'g1AAAAB')
+        self.cache.advance(self.namespace, 'g1AAAAB')
+        self.assertEquals(self.cache.get(self.namespace, key),
+            ({'rows': []}, True))
+        self.cache.advance(self.namespace, 'g1AAAAA')
+        self.assertEquals(self.cache.get(self.namespace, key),
+            ({'rows': []}, False))
+
+    def test_client(self):
+        self.cache.advance(self.namespace, 5)
+        d = self.couch.openView('mydb', 'd', 'v', startkey='a', limit=10)
+        self.failUnless(b'update_seq=true' in self.agent.requests[0][1])
+        self._respond(5, [{'key': 'a', 'value': 1}])
+
+        def cached(result):
+            self.failIf('update_seq' in result)
+            # the same query, with the arguments in another order
+            d = self.couch.openView('mydb', 'd', 'v', limit=10, startkey='a')
+            self.assertEquals(len(self.agent.requests), 1)
+            return d
+
+        def changed(result):
+            self.assertEquals(result['rows'], [{'key': 'a', 'value': 1}])
+            self.cache.advance(self.namespace, 6)
+            d = self.couch.openView('mydb', 'd', 'v', startkey='a', limit=10)
+            self.assertEquals(len(self.agent.requests), 2)
+            self._respond(6, [{'key': 'a', 'value': 2}])
+            return d
+
+        def check(result):
+            self.assertEquals(result['rows'], [{'key': 'a', 'value': 2}])
+            self.assertEquals(self.cache.stats()['hits'], 1)
+        d.addCallback(cached)
+        d.addCallback(changed)
+        d.addCallback(check)
+        return d
+
+    def test_staleWhileRefresh(self):
+        self.cache.staleWhileRefresh = True
+        self.cache.advance(self.namespace, 1)
+        self.couch.openView('mydb', 'd', 'v')
+        self._respond(1, [{'key': 'a', 'value': 1}])
+        self.cache.advance(self.namespace, 2)
+
+        results = []
+        self.couch.openView('mydb', 'd', 'v').addCallback(results.append)
+        self.couch.openView('mydb', 'd', 'v').addCallback(results.append)
+        # both served the stale result, with one refresh in the background
+        self.assertEquals([r['rows'][0]['value'] for r in results], [1, 1])
+        self.assertEquals(len(self.agent.requests), 2)
+
+        self._respond(2, [{'key': 'a', 'value': 2}])
+        self.couch.openView('mydb', 'd', 'v').addCallback(results.append)
+        self.assertEquals(results[-1]['rows'][0]['value'], 2)
+
+    def test_polling(self):
+        self.cache.startPolling(self.couch, 'mydb', 10)
+        self.assertEquals(len(self.agent.requests), 1)
+        self.agent.requests[0][4].callback(FakeResponse(
+            body=b'{"db_name": "mydb", "update_seq": 3}'))
+        self.assertEquals(self.cache.seq(self.namespace), 3)
+
+        self.clock.advance(10)
+        self.assertEquals(len(self.agent.requests), 2)
+        self.agent.requests[1][4].callback(FakeResponse(404,
+            body=b'{"error": "not_found"}'))
+        self.cache.stopPolling(self.couch, 'mydb')
+        self.clock.advance(10)
+        self.assertEquals(len(self.agent.requests), 2)
+
+
+class SQLiteCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.cache = SQLiteCache(self.path)
+        self.addCleanup(lambda: self.cache.close())
+
+    def _get(self, key, namespace):
+        results = []
+        self.cache.get(key, namespace).addCallback(results.append)
+        return results[0]
+
+    def _restart(self):
+        self.cache.close()
+        self.cache = SQLiteCache(self.path)
+
+    def test_persistent(self):
+        self.cache.store('a', {'_id': 'a', '_rev': '1-a'}, namespace='db1')
+        self.cache.store('a', {'_id': 'a', '_rev': '1-b'}, namespace='db2')
+        self.cache.saveSeq('db1', 5)
+        self.cache.mapped('a', object(), namespace='db1')
+        self.assertEquals(self.cache.stats('db1')['cached'], 2)
+
+        self._restart()
+        self.assertEquals(self._get('a', 'db2')['_rev'], '1-b')
+        self.assertEquals(self.cache.getSeq('db1'), 5)
+        self.assertRaises(KeyError, self.cache.getObject, 'a', 'db1')
+
+        self.cache.flush('db1')
+        self.assertRaises(KeyError, self.cache.get, 'a', 'db1')
+        self.assertEquals(self.cache.getSeq('db1'), None)
+        self.assertEquals((self.cache.lookups, self.cache.hits,
+            self.cache.cached), (3, 1, 1))
+
+    @defer.inlineCallbacks
+    def test_catchUp(self):
+        server = FakeCouchDBServer()
+        couch = server.start(cache=self.cache)
+        self.addCleanup(server.stop)
+        namespace = couch.cacheNamespace('mydb')
+        yield couch.createDB('mydb')
+        yield couch.saveDocs('mydb', [{'_id': docId}
+            for docId in ('a', 'b', 'c')])
+        self.cache.store('stale', {}, namespace=namespace)
+
+        # without a saved seq, nothing cached can be trusted
+        yield self.cache.catchUp(couch, 'mydb')
+        self.assertRaises(KeyError, self.cache.get, 'stale', namespace)
+        self.assertEquals(self.cache.getSeq(namespace), 3)
+        a = yield couch.openDoc('mydb', 'a')
+        b = yield couch.openDoc('mydb', 'b')
+        yield couch.openDoc('mydb', 'c')
+
+        # changed while not running
+        self._restart()
+        couch._cache = self.cache
+        yield couch.saveDoc('mydb', a, docId='a')
+        yield couch.deleteDoc('mydb', 'b', b['_rev'])
+        yield couch.saveDoc('mydb', {}, docId='d')
+
+        evicted = yield self.cache.catchUp(couch, 'mydb', refresh=True)
+        self.assertEquals(evicted, 2)
+        self.failUnless(self._get('a', namespace)['_rev'].startswith('2-'))
+        self.assertRaises(KeyError, self.cache.get, 'b', namespace)
+        self.assertRaises(KeyError, self.cache.get, 'd', namespace)
+        self.assertEquals(self._get('c', namespace)['_id'], 'c')
+        self.assertEquals(self.cache.getSeq(namespace), 6)
+
+    def test_refresh(self):
+        self.cache.store('a', {'_rev': '1-a'}, namespace='db1')
+        self.cache.refresh('a', {'_rev': '2-a'}, 'db1')
+        self.cache.refresh('b', {'_rev': '1-b'}, 'db1')
+        self.assertEquals(self._get('a', 'db1'), {'_rev': '2-a'})
+        self.assertRaises(KeyError, self.cache.get, 'b', 'db1')
+
+    def test_notifier(self):
+        couch = client.CouchDB('localhost')
+        namespace = couch.cacheNamespace('mydb')
+        self.cache.store('a', {}, namespace=namespace)
+        notifier = changes.ChangeNotifier(couch, 'mydb')
+        notifier.addCache(self.cache)
+        notifier.changed({'id': 'a', 'seq': 7})
+        self.assertRaises(KeyError, self.cache.get, 'a', namespace)
+        self.assertEquals(self.cache.getSeq(namespace), 7)
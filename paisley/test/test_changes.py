@@ -43,6 +43,32 @@ class TestStubChangeReceiver(unittest.TestCase):
         self.assertEquals(notifier.changes[2]["deleted"], True)
 
 
+class StubCacheTestCase(unittest.TestCase):
+
+    def testRefreshNotImplemented(self):
+
+        class DictCache(client.Cache):
+            """
+            A cache implementing only the required methods.
+            """
+
+            def __init__(self):
+                self.docs = {'a': {'_id': 'a'}}
+
+            def delete(self, key, namespace=None):
+                self.docs.pop(key, None)
+                return defer.succeed(True)
+
+        cache = DictCache()
+        notifier = changes.ChangeNotifier(client.CouchDB('localhost'),
+            'test', refresh=True)
+        notifier.addCache(cache)
+        notifier.changed({'id': 'a', 'seq': 1,
+            'doc': {'_id': 'a', 'new': True}})
+        # the document is deleted instead of refreshed
+        self.assertEquals(cache.docs, {})
+
+
 class BaseTestCase(util.CouchDBTestCase):
     tearing = False # set to True during teardown so we can assert
     expect_tearing = False
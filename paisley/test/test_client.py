@@ -11,17 +11,19 @@ Test for couchdb client.
 from paisley import pjson as json
 
 import cgi
+import io
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 
 from twisted.trial.unittest import TestCase
 from twisted.internet.defer import Deferred
 from twisted.internet import reactor
-from twisted.web import resource, server
-from twisted.web._newclient import ResponseDone
+from twisted.web import error as tw_error, resource, server
+from twisted.web.http_headers import Headers
+from twisted.web._newclient import ResponseDone, ResponseNeverReceived
 from twisted.python.failure import Failure
 
-from paisley import client
+from paisley import client, stream
 
 from paisley.test import util
 
@@ -70,6 +72,8 @@ class CouchDBTestCase(TestCase):
         import logging
         log = logging.getLogger('paisley')
         self.assertNotEqual(log, client.log)
+        # every level the client logs at is silenced
+        client.log.warning('%s', 'silenced')
 
     def test_enable_log_and_defaults(self):
         client = TestableCouchDB('localhost')
@@ -283,6 +287,57 @@ class CouchDBTestCase(TestCase):
         d.callback("test")
         return d.addCallback(self.assertEquals, "test")
 
+    def test_openDocs(self):
+        """
+        Test openDocs: cached documents should not be fetched again.
+        """
+        cache = client.MemoryCache()
+        self.client = TestableCouchDB("localhost", cache=cache)
+        cache.store('a', {'_id': 'a', '_rev': '1-a'},
+            namespace=self.client.cacheNamespace('mydb'))
+
+        d = self.client.openDocs("mydb", ["b", "a", "c", "d"])
+        self.assertEquals(self.client.uri,
+            "/mydb/_all_docs?include_docs=true")
+        self.assertEquals(self.client.kwargs["method"], "POST")
+        self.assertEquals(json.loads(self.client.kwargs["postdata"]),
+            {"keys": ["b", "c", "d"]})
+
+        self.client.deferred.callback(json.dumps({'rows': [
+            {'id': 'b', 'key': 'b', 'value': {'rev': '1-b'},
+             'doc': {'_id': 'b', '_rev': '1-b'}},
+            {'id': 'c', 'key': 'c', 'value': {'rev': '2-c', 'deleted': True},
+             'doc': None},
+            {'key': 'd', 'error': 'not_found'},
+        ]}))
+
+        def cb(result):
+            self.assertEquals(result, [
+                {'id': 'b', 'rev': '1-b', 'doc': {'_id': 'b', '_rev': '1-b'}},
+                {'id': 'a', 'rev': '1-a', 'doc': {'_id': 'a', '_rev': '1-a'}},
+                {'id': 'c', 'rev': '2-c', 'error': 'deleted'},
+                {'id': 'd', 'error': 'not_found'},
+            ])
+            self.failUnless('b' in
+                cache._docCache[self.client.cacheNamespace('mydb')])
+        d.addCallback(cb)
+        return d
+
+    def test_openDocsAllCached(self):
+        """
+        Test openDocs does not do a request when everything is cached.
+        """
+        cache = client.MemoryCache()
+        self.client = TestableCouchDB("localhost", cache=cache)
+        cache.store('a', {'_id': 'a', '_rev': '1-a'},
+            namespace=self.client.cacheNamespace('mydb'))
+
+        d = self.client.openDocs("mydb", ["a"])
+        self.failIf(self.client.called)
+        d.addCallback(self.assertEquals,
+            [{'id': 'a', 'rev': '1-a', 'doc': {'_id': 'a', '_rev': '1-a'}}])
+        return d
+
     def test_saveDocWithDocId(self):
         """
         Test saveDoc, giving an explicit document ID.
@@ -301,6 +356,15 @@ class CouchDBTestCase(TestCase):
         self.assertEquals(self.client.kwargs["method"], "POST")
         return self._checkParseDeferred(d)
 
+    def test_saveEncodedDoc(self):
+        """
+        saveDoc should send an already encoded document as it is.
+        """
+        d = self.client.saveDoc("mydb", b'{"value": "mybody"}', "mydoc")
+        self.assertEquals(self.client.kwargs["postdata"],
+            b'{"value": "mybody"}')
+        return self._checkParseDeferred(d)
+
     def test_saveStructuredDoc(self):
         """
         saveDoc should automatically serialize a structured document.
@@ -320,6 +384,34 @@ class CouchDBTestCase(TestCase):
         self.assertEquals(self.client.kwargs["method"], "DELETE")
         return self._checkParseDeferred(d)
 
+    def test_saveDocs(self):
+        """
+        Test saveDocs: this should C{POST} all documents to _bulk_docs.
+        """
+        d = self.client.saveDocs("mydb", [{"_id": "a"}, '{"_id": "b"}'])
+        self.assertEquals(self.client.uri, "/mydb/_bulk_docs")
+        self.assertEquals(self.client.kwargs["method"], "POST")
+        self.assertEquals(self.client.kwargs["postdata"],
+            b'{"docs": [{"_id": "a"}, {"_id": "b"}]}')
+        self.client.deferred.callback(
+            '[{"id": "a", "rev": "1-x"}, {"id": "b", "rev": "1-y"}]')
+        d.addCallback(self.assertEquals,
+            [{"id": "a", "rev": "1-x"}, {"id": "b", "rev": "1-y"}])
+        return d
+
+    def test_deleteDocs(self):
+        """
+        Test deleteDocs: this should C{POST} deleted stubs to _bulk_docs.
+        """
+        d = self.client.deleteDocs("mydb", [{"_id": "a", "_rev": "1-x"}])
+        self.assertEquals(self.client.uri, "/mydb/_bulk_docs")
+        self.assertEquals(self.client.kwargs["method"], "POST")
+        self.assertEquals(json.loads(self.client.kwargs["postdata"]),
+            {"docs": [{"_id": "a", "_rev": "1-x", "_deleted": True}]})
+        self.client.deferred.callback('[{"id": "a", "rev": "2-x"}]')
+        d.addCallback(self.assertEquals, [{"id": "a", "rev": "2-x"}])
+        return d
+
     def test_addAttachments(self):
         """
         Test addAttachments.
@@ -380,6 +472,45 @@ class CouchDBTestCase(TestCase):
         self.assertEquals(self.client.kwargs['postdata'],
                           '{"keys": [1, 3, 4, "hello, world", {"1": 5}]}')
 
+    def test_openViewStartKeyDocId(self):
+        """
+        Test openView passes document ids without JSON-encoding them.
+        """
+        d = self.client.openView("mydb", "viewdoc", "myview",
+            startkey=1, startkey_docid="abc")
+        self.failUnless("startkey=1" in self.client.uri)
+        self.failUnless("startkey_docid=abc" in self.client.uri)
+        return self._checkParseDeferred(d)
+
+    def test_openViewStreaming(self):
+        """
+        Test openView with a row callback streams the response.
+        """
+        rows = []
+        d = self.client.openView("mydb", "viewdoc", "myview",
+            rowCallback=rows.append)
+        self.assertEquals(self.client.uri,
+            "/mydb/_design/viewdoc/_view/myview?")
+        self.assertEquals(self.client.kwargs["method"], "GET")
+
+        # the receiver parses the rows and fires with the header
+        receiver = self.client.kwargs["receiverFactory"](Deferred())
+        self.assertEquals(receiver._rowCallback, rows.append)
+        d.callback({'total_rows': 0, 'offset': 0})
+        d.addCallback(self.assertEquals, {'total_rows': 0, 'offset': 0})
+        return d
+
+    def test_listDocStreaming(self):
+        """
+        Test listDoc with a row callback streams the response.
+        """
+        d = self.client.listDoc("mydb", rowCallback=lambda row: None)
+        self.assertEquals(self.client.uri, "/mydb/_all_docs")
+        self.failUnless(self.client.kwargs["receiverFactory"])
+        d.callback({'total_rows': 0, 'offset': 0})
+        d.addCallback(self.assertEquals, {'total_rows': 0, 'offset': 0})
+        return d
+
     def test_tempView(self):
         """
         Test tempView.
@@ -422,6 +553,444 @@ class CouchDBTestCase(TestCase):
         self.assertEquals(version, (1, 1, 1))
 
 
+class BulkCouchDB(client.CouchDB):
+    """
+    A couchdb client that records every POST and answers it later.
+    """
+
+    def __init__(self, *args, **kwargs):
+        client.CouchDB.__init__(self, *args, **kwargs)
+        self.posts = []
+
+    def post(self, uri, body, descr='', **kwargs):
+        d = Deferred()
+        self.posts.append((uri, body, d))
+        return d
+
+
+class BulkDocsTestCase(TestCase):
+
+    def setUp(self):
+        self.client = BulkCouchDB("localhost")
+
+    def test_chunkDocs(self):
+        docs = ['{"a": 1}', '{"b": 2}', '{"c": 3}']
+        self.assertEquals(list(client._chunkDocs(docs, 2, 1024)),
+            [docs[:2], docs[2:]])
+        self.assertEquals(list(client._chunkDocs(docs, 10, 20)),
+            [docs[:2], docs[2:]])
+        # documents bigger than the limit still get sent
+        self.assertEquals(list(client._chunkDocs(docs, 10, 1)),
+            [[docs[0]], [docs[1]], [docs[2]]])
+
+    def test_saveDocsChunked(self):
+        docs = [{'_id': str(i)} for i in range(5)]
+        d = self.client.saveDocs('mydb', docs, chunkSize=2, concurrency=2)
+
+        # only two chunks can be in flight
+        self.assertEquals(len(self.client.posts), 2)
+
+        # answer out of order; results still come back in input order
+        self.client.posts[1][2].callback(
+            '[{"id": "2", "rev": "1-a"}, {"id": "3", "rev": "1-a"}]')
+        self.assertEquals(len(self.client.posts), 3)
+        self.client.posts[2][2].callback(
+            '[{"id": "4", "error": "conflict", "reason": "conflict"}]')
+        self.client.posts[0][2].callback(
+            '[{"id": "0", "rev": "1-a"}, {"id": "1", "rev": "1-a"}]')
+
+        def cb(result):
+            self.assertEquals([r['id'] for r in result],
+                ['0', '1', '2', '3', '4'])
+            self.assertEquals(result[4]['error'], 'conflict')
+        d.addCallback(cb)
+        return d
+
+    def test_saveDocsFailure(self):
+        docs = [{'_id': str(i)} for i in range(5)]
+        d = self.client.saveDocs('mydb', docs, chunkSize=2, concurrency=2)
+        self.client.posts[0][2].errback(RuntimeError('boom'))
+        self.client.posts[1][2].callback(
+            '[{"id": "2", "rev": "1-a"}, {"id": "3", "rev": "1-a"}]')
+        self.client.posts[2][2].errback(tw_error.Error(400,
+            b'{"error": "bad_request", "reason": "too big"}'))
+
+        def cb(result):
+            # the documents of failed chunks get an error each
+            self.assertEquals(result[:2], [
+                {'id': '0', 'error': 'request_failed', 'reason': 'boom'},
+                {'id': '1', 'error': 'request_failed', 'reason': 'boom'}])
+            self.assertEquals([r.get('rev') for r in result[2:4]],
+                ['1-a', '1-a'])
+            self.assertEquals(result[4],
+                {'id': '4', 'error': 'bad_request', 'reason': 'too big'})
+        d.addCallback(cb)
+        return d
+
+
+class FakeResponse(object):
+    """
+    A response delivering a preset body.
+    """
+
+    def __init__(self, code=200, body=b'', headers=None):
+        self.code = code
+        self.body = body
+        self.length = len(body)
+        if headers is None:
+            headers = {'Content-Type': ['application/json']}
+        self.headers = Headers(headers)
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(Failure(ResponseDone()))
+
+
+class FakeAgent(object):
+    """
+    An agent recording requests, to be answered by the test.
+
+    @ivar requests: list of (method, uri, headers, bodyProducer, deferred)
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        d = Deferred(self._cancel)
+        self.requests.append((method, uri, headers, bodyProducer, d))
+        return d
+
+    def _cancel(self, d):
+        # like HTTP11ClientProtocol, before the response arrived
+        d.errback(ResponseNeverReceived([Failure(defer.CancelledError())]))
+
+
+class CoalesceTestCase(TestCase):
+
+    def setUp(self):
+        self.agent = FakeAgent()
+        self.client = client.CouchDB("localhost", coalesce=True,
+            timeout=None)
+        self.client.client = self.agent
+
+    def test_coalesced(self):
+        d1 = self.client.get("/mydb/mydoc")
+        d2 = self.client.get("/mydb/mydoc")
+        self.assertEquals(len(self.agent.requests), 1)
+        self.assertEquals(self.client.coalesced, 1)
+
+        self.agent.requests[0][4].callback(FakeResponse(body=b'{"a": 1}'))
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(lambda results: self.assertEquals(
+            [bytes(r) for r in results], [b'{"a": 1}', b'{"a": 1}']))
+        return d
+
+    def test_coalescedFailure(self):
+        d1 = self.client.get("/mydb/mydoc")
+        d2 = self.client.get("/mydb/mydoc")
+        self.agent.requests[0][4].errback(RuntimeError('boom'))
+        return defer.gatherResults([
+            self.assertFailure(d1, RuntimeError),
+            self.assertFailure(d2, RuntimeError)])
+
+    def test_leaderTimedOut(self):
+        clock = task.Clock()
+        self.client._clock = clock
+        d1 = self.client.get("/mydb/mydoc", timeout=1)
+        d2 = self.client.get("/mydb/mydoc", timeout=5)
+        clock.advance(1)
+        # the request goes on for the one still waiting
+        self.assertEquals(len(self.agent.requests), 1)
+        self.agent.requests[0][4].callback(FakeResponse(body=b'{"a": 1}'))
+        d2.addCallback(lambda result: self.assertEquals(bytes(result),
+            b'{"a": 1}'))
+        return defer.gatherResults([
+            self.assertFailure(d1, client.RequestTimeout), d2])
+
+    def test_allTimedOut(self):
+        clock = task.Clock()
+        self.client._clock = clock
+        d1 = self.client.get("/mydb/mydoc", timeout=1)
+        d2 = self.client.get("/mydb/mydoc", timeout=2)
+        clock.advance(2)
+        # nobody waits anymore, so the request is cancelled
+        self.failUnless(self.agent.requests[0][4].called)
+        self.assertEquals(self.client._inFlight, {})
+        self.client.get("/mydb/mydoc")
+        self.assertEquals(len(self.agent.requests), 2)
+        return defer.gatherResults([
+            self.assertFailure(d1, client.RequestTimeout),
+            self.assertFailure(d2, client.RequestTimeout)])
+
+    def test_notCoalesced(self):
+        # a new request is done once the previous one is done
+        self.client.get("/mydb/mydoc")
+        self.agent.requests[0][4].callback(FakeResponse(body=b'{}'))
+        self.client.get("/mydb/mydoc")
+        # other uris and methods are not coalesced
+        self.client.get("/mydb/other")
+        self.client.post("/mydb/mydoc", "{}")
+        self.client.post("/mydb/mydoc", "{}")
+        self.assertEquals(len(self.agent.requests), 5)
+        self.assertEquals(self.client.coalesced, 0)
+
+    def test_disabled(self):
+        self.client = client.CouchDB("localhost", timeout=None)
+        self.client.client = self.agent
+        self.client.get("/mydb/mydoc")
+        self.client.get("/mydb/mydoc")
+        self.assertEquals(len(self.agent.requests), 2)
+
+
+class PreparedRequestTestCase(TestCase):
+
+    def setUp(self):
+        self.agent = FakeAgent()
+        self.client = client.CouchDB("localhost", username="user",
+            password="p\xe4ss", cookieAuth=False, timeout=None)
+        self.client.client = self.agent
+
+    def test_url(self):
+        self.client.get("/mydb/caf%C3%A9")
+        self.assertEquals(self.agent.requests[0][1],
+            b"http://localhost:5984/mydb/caf%C3%A9")
+
+    def test_shared(self):
+        self.client.get("/mydb/a")
+        self.client.get("/mydb/b")
+        first, second = [request[2] for request in self.agent.requests]
+        self.assertIdentical(first, second)
+        self.assertEquals(first.getRawHeaders('Authorization'),
+            ['Basic dXNlcjpww6Rzcw=='])
+        self.assertEquals(first.getRawHeaders('Accept'),
+            ['application/json'])
+
+    def test_ownHeaders(self):
+        self.client.get("/mydb/a")
+        self.client.getAttachment("mydb", "a", "file", io.BytesIO())
+        shared, own = [request[2] for request in self.agent.requests]
+        self.assertEquals(own.getRawHeaders('Accept'), ['*/*'])
+        self.assertEquals(own.getRawHeaders('Authorization'),
+            shared.getRawHeaders('Authorization'))
+        # the shared headers are left alone
+        self.assertEquals(shared.getRawHeaders('Accept'),
+            ['application/json'])
+
+    def test_credentialsChanged(self):
+        self.client.get("/mydb/a")
+        self.client.password = "other"
+        self.client.get("/mydb/a")
+        first, second = [request[2] for request in self.agent.requests]
+        self.assertNotEquals(first.getRawHeaders('Authorization'),
+            second.getRawHeaders('Authorization'))
+
+
+class AttachmentTestCase(TestCase):
+
+    def setUp(self):
+        self.agent = FakeAgent()
+        self.client = client.CouchDB("localhost", timeout=None)
+        self.client.client = self.agent
+
+    def test_putAttachment(self):
+        data = io.BytesIO(b'x' * 100)
+        d = self.client.putAttachment("mydb", "my doc", "a file.txt", data,
+            revision="1-a", contentType="text/plain")
+        method, uri, headers, producer, result = self.agent.requests[0]
+        self.assertEquals(method, b"PUT")
+        self.assertEquals(uri,
+            b"http://localhost:5984/mydb/my%20doc/a%20file.txt?rev=1-a")
+        self.assertEquals(headers.getRawHeaders('Content-Type'),
+            ['text/plain'])
+        # streamed from the file, not read into memory
+        self.assertEquals(producer.length, 100)
+        self.assertIdentical(producer._inputFile, data)
+
+        result.callback(FakeResponse(
+            body=b'{"ok": true, "id": "my doc", "rev": "2-b"}'))
+        d.addCallback(self.assertEquals,
+            {"ok": True, "id": "my doc", "rev": "2-b"})
+        return d
+
+    def test_putAttachmentLength(self):
+        self.client.putAttachment("mydb", "_design/d", "a", io.BytesIO(),
+            length=5)
+        method, uri, headers, producer, result = self.agent.requests[0]
+        self.assertEquals(uri, b"http://localhost:5984/mydb/_design/d/a")
+        self.assertEquals(producer.length, 5)
+
+    def test_getAttachment(self):
+        consumer = io.BytesIO()
+        d = self.client.getAttachment("mydb", "mydoc", "a", consumer)
+        method, uri, headers, producer, result = self.agent.requests[0]
+        self.assertEquals(uri, b"http://localhost:5984/mydb/mydoc/a")
+        self.assertEquals(headers.getRawHeaders('Range'), None)
+
+        result.callback(FakeResponse(body=b'\x00\xff' * 10,
+            headers={'Content-Type': ['application/octet-stream']}))
+
+        def cb(written):
+            self.assertEquals(written, 20)
+            self.assertEquals(consumer.getvalue(), b'\x00\xff' * 10)
+        d.addCallback(cb)
+        return d
+
+    def test_getAttachmentRange(self):
+        self.client.getAttachment("mydb", "mydoc", "a", io.BytesIO(),
+            offset=10, length=5)
+        self.client.getAttachment("mydb", "mydoc", "a", io.BytesIO(),
+            offset=10)
+        self.assertEquals(self.agent.requests[0][2].getRawHeaders('Range'),
+            ['bytes=10-14'])
+        self.assertEquals(self.agent.requests[1][2].getRawHeaders('Range'),
+            ['bytes=10-'])
+
+    def test_getAttachmentPart(self):
+        consumer = io.BytesIO()
+        d = self.client.getAttachment("mydb", "mydoc", "a", consumer,
+            offset=10, length=5)
+        self.agent.requests[0][4].callback(FakeResponse(206, body=b'abcde',
+            headers={'Content-Range': ['bytes 10-14/100']}))
+        d.addCallback(self.assertEquals, 5)
+        return d
+
+    def test_getAttachmentRangeIgnored(self):
+        consumer = io.BytesIO()
+        d = self.client.getAttachment("mydb", "mydoc", "a", consumer,
+            offset=10, length=5)
+        # compressed attachments are sent whole
+        self.agent.requests[0][4].callback(FakeResponse(body=b'x' * 100,
+            headers={'Content-Type': ['text/plain']}))
+        self.assertEquals(consumer.getvalue(), b'')
+        return self.assertFailure(d, stream.RangeMismatch)
+
+
+class StalledResponse(FakeResponse):
+    """
+    A response delivering the first half of its body, and then nothing.
+    """
+
+    def __init__(self, *args, **kwargs):
+        FakeResponse.__init__(self, *args, **kwargs)
+        self.stopped = False
+
+    def deliverBody(self, protocol):
+        response = self
+
+        class Transport(object):
+
+            def stopProducing(self):
+                response.stopped = True
+        protocol.makeConnection(Transport())
+        protocol.dataReceived(self.body[:len(self.body) // 2])
+
+
+class TimeoutTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.agent = FakeAgent()
+        self.client = client.CouchDB("localhost", timeout=10)
+        self.client.client = self.agent
+        self.client._clock = self.clock
+
+    def test_timedOut(self):
+        d = self.client.get("/mydb/mydoc", descr='openDoc')
+        self.clock.advance(9)
+        self.failIf(d.called)
+        self.clock.advance(1)
+        self.assertEquals(self.client.getTimeoutStats(), {'openDoc': 1})
+        # the request was cancelled
+        self.assertFailure(self.agent.requests[0][4], ResponseNeverReceived)
+        return self.assertFailure(d, client.RequestTimeout)
+
+    def test_perCall(self):
+        d = self.client.infoDB("mydb", timeout=1)
+        self.client.listDB(timeout=0)
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(1)
+        self.assertEquals(self.client.getTimeoutStats(), {'infoDB': 1})
+        self.agent.requests[1][4].callback(FakeResponse(body=b'[]'))
+        return self.assertFailure(d, client.RequestTimeout)
+
+    def test_completed(self):
+        d = self.client.listDB()
+        self.agent.requests[0][4].callback(FakeResponse(body=b'[]'))
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        d.addCallback(self.assertEquals, [])
+        return d
+
+    def test_bodyCancelled(self):
+        d = self.client.get("/mydb/mydoc", descr='openDoc')
+        response = StalledResponse(body=b'{"a": 1}')
+        self.agent.requests[0][4].callback(response)
+        self.failIf(response.stopped)
+        self.clock.advance(10)
+        # the connection is not left with the rest of the body
+        self.failUnless(response.stopped)
+        return self.assertFailure(d, client.RequestTimeout)
+
+    def test_scheduled(self):
+        self.client.scheduler.maxPerHost = 1
+        self.client.get("/mydb/a", timeout=0)
+        d = self.client.get("/mydb/b")
+        self.clock.advance(10)
+        self.assertEquals(self.client.getSchedulerStats()['queued'], 0)
+        self.agent.requests[0][4].callback(FakeResponse(body=b'{}'))
+        # the queued request is never sent
+        self.assertEquals(len(self.agent.requests), 1)
+        return self.assertFailure(d, client.RequestTimeout)
+
+    def test_notRetried(self):
+        from paisley.retry import RetryPolicy
+
+        self.client.retryPolicy = RetryPolicy(clock=self.clock)
+        d = self.client.get("/mydb/mydoc", descr='openDoc')
+        self.clock.advance(10)
+        # the cancelled attempt is not retried after the deadline
+        self.clock.advance(60)
+        self.assertEquals(len(self.agent.requests), 1)
+        stats = self.client.getSchedulerStats()
+        self.assertEquals((stats['inFlight'], stats['queued']), (0, 0))
+        self.assertEquals(self.client.getPoolStats()['inUse'], 0)
+        return self.assertFailure(d, client.RequestTimeout)
+
+    def test_streamed(self):
+        self.client = client.CouchDB("localhost")
+        self.client.client = self.agent
+        self.client._clock = self.clock
+        consumer = io.BytesIO()
+        d = self.client.getAttachment("mydb", "mydoc", "a", consumer)
+        response = SteadyResponse()
+        self.agent.requests[0][4].callback(response)
+
+        # a slow but steady body takes longer than the default timeout
+        for i in range(60):
+            self.clock.advance(10)
+            response.protocol.dataReceived(b'x' * 1024)
+        self.failIf(d.called)
+        response.protocol.connectionLost(Failure(ResponseDone()))
+        d.addCallback(self.assertEquals, 60 * 1024)
+        return d
+
+    def test_streamedPerCall(self):
+        d = self.client.openView("mydb", "design", "view",
+            rowCallback=lambda row: None, timeout=5)
+        self.agent.requests[0][4].callback(SteadyResponse())
+        self.clock.advance(5)
+        return self.assertFailure(d, client.RequestTimeout)
+
+
+class SteadyResponse(FakeResponse):
+    """
+    A response delivering its body as the test feeds it.
+    """
+
+    def deliverBody(self, protocol):
+        self.protocol = protocol
+
+
 class FakeCouchDBResource(resource.Resource):
     """
     Fake a couchDB resource.
@@ -441,7 +1010,7 @@ class FakeCouchDBResource(resource.Resource):
         """
         Return C{result}.
         """
-        return self.result
+        return self.result.encode('utf-8')
 
 
 class ConnectedCouchDBTestCase(TestCase):
@@ -458,6 +1027,7 @@ class ConnectedCouchDBTestCase(TestCase):
         port = reactor.listenTCP(0, site, interface="127.0.0.1")
         self.addCleanup(port.stopListening)
         self.client = client.CouchDB("127.0.0.1", port.getHost().port)
+        self.addCleanup(self.client.closeCachedConnections)
 
     def test_listDB(self):
         """
@@ -851,6 +1421,16 @@ class RealCouchDBTestCase(util.CouchDBTestCase):
         d.callback(None)
         return d
 
+    @defer.inlineCallbacks
+    def test_saveEncodedDoc(self):
+        """
+        saveDoc should send an already encoded document as it is.
+        """
+        doc_id = 'foo'
+        yield self.db.saveDoc(self.db_name, b'{"value": "mybody"}', doc_id)
+        result = yield self.db.openDoc(self.db_name, doc_id)
+        self.assertEquals(result['value'], 'mybody')
+
     def test_saveStructuredDoc(self):
         """
         saveDoc should automatically serialize a structured document.
@@ -1184,8 +1764,9 @@ class ResponseReceiverTestCase(TestCase):
         data = u'\u201cI\xf1t\xebrn\xe2ti\xf4n\xe0liz\xe6ti\xf8n\u201d'
         d.addCallback(lambda encoded_out: self.assertEqual(encoded_out, data))
 
-        for c in data.encode('utf-8'):
-            rvr.dataReceived(c)
+        encoded = data.encode('utf-8')
+        for i in range(len(encoded)):
+            rvr.dataReceived(encoded[i:i + 1])
 
         rvr.connectionLost(Failure(ResponseDone()))
 
@@ -1196,7 +1777,21 @@ class ResponseReceiverTestCase(TestCase):
         data = util.eight_bit_test_string()
         d.addCallback(lambda out: self.assertEqual(out, data))
 
-        for c in data:
-            rvr.dataReceived(c)
+        for i in range(len(data)):
+            rvr.dataReceived(data[i:i + 1])
 
         rvr.connectionLost(Failure(ResponseDone()))
+
+
+class StringProducerTestCase(TestCase):
+
+    def test_length(self):
+        producer = client.StringProducer(
+            u'\u201cI\xf1t\xebrn\xe2ti\xf4n\u201d')
+        self.assertEquals(producer.length, len(producer.body))
+        self.assertEquals(type(producer.body), bytes)
+
+    def test_bytes(self):
+        producer = client.StringProducer(b'{}')
+        self.assertEquals(producer.body, b'{}')
+        self.assertEquals(producer.length, 2)
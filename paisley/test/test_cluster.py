@@ -0,0 +1,175 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_cluster -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Test for the cluster client.
+"""
+
+from twisted.internet import defer, error, task
+from twisted.trial.unittest import TestCase
+
+from paisley import client, cluster, compress, retry
+
+from paisley.test.test_client import FakeAgent, FakeResponse
+
+
+NODES = [('node1', 5984), ('node2', 5984), ('node3', 5984)]
+
+
+class CouchClusterTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.agent = FakeAgent()
+        self.cluster = cluster.CouchCluster(NODES, healthInterval=None,
+            clock=self.clock, retryPolicy=retry.RetryPolicy(maxAttempts=1))
+        self.cluster.client = self.agent
+
+    def _hosts(self):
+        return [uri.split(b'/')[2].split(b':')[0]
+            for method, uri, headers, body, d in self.agent.requests]
+
+    def _answer(self, index, code=200, body=b'{}'):
+        self.agent.requests[index][4].callback(FakeResponse(code, body))
+
+    def test_leastInFlight(self):
+        self.cluster.readPolicy = cluster.LEAST_IN_FLIGHT
+        for i in range(3):
+            self.cluster.get("/mydb/doc%d" % i)
+        self.assertEquals(sorted(self._hosts()),
+            [b'node1', b'node2', b'node3'])
+
+        self._answer(1)
+        self.cluster.get("/mydb/doc")
+        self.assertEquals(self._hosts()[3], self._hosts()[1])
+
+    def test_latency(self):
+        # every node answers once, node2 fastest
+        for i in range(3):
+            self.cluster.get("/mydb/doc%d" % i)
+        hosts = self._hosts()
+        for delay, host in [(0.05, b'node2'), (0.2, b'node1'),
+                            (0.3, b'node3')]:
+            self.clock.advance(delay)
+            self._answer(hosts.index(host))
+
+        self.cluster.get("/mydb/doc")
+        self.assertEquals(self._hosts()[3], b'node2')
+        latencies = [n['latency'] for n in self.cluster.getNodeStats()]
+        self.assertEquals(latencies, [0.25, 0.05, 0.55])
+
+    def test_unmeasured(self):
+        # a node that did not answer yet is not preferred whatever its load
+        self.cluster.nodes[0].inFlight = 500
+        self.cluster.nodes[1].latency = 0.01
+        self.cluster.nodes[2].latency = 0.01
+        for i in range(6):
+            self.assertNotIdentical(self.cluster.pickNode(),
+                self.cluster.nodes[0])
+
+        # nor is it left out when it is not loaded
+        self.cluster.nodes[0].inFlight = 0
+        self.cluster.nodes[1].inFlight = 1
+        self.cluster.nodes[2].inFlight = 1
+        self.assertIdentical(self.cluster.pickNode(), self.cluster.nodes[0])
+
+    def test_writePolicy(self):
+        self.cluster.nodes[0].latency = 0.01
+        self.cluster.nodes[1].latency = 0.5
+        self.cluster.nodes[2].latency = 0.5
+        self.cluster.nodes[0].inFlight = 1
+        self.cluster.get("/mydb/doc")
+        self.cluster.put("/mydb/doc", "{}")
+        self.assertEquals(self._hosts()[0], b'node1')
+        self.assertNotEquals(self._hosts()[1], b'node1')
+
+    def test_eject(self):
+        self.cluster.readPolicy = cluster.LEAST_IN_FLIGHT
+        node = self.cluster.nodes[0]
+        for other in self.cluster.nodes[1:]:
+            other.inFlight = 5
+        for i in range(3):
+            d = self.cluster.get("/mydb/doc")
+            d.addErrback(lambda f: f.trap(error.ConnectionRefusedError))
+            self.agent.requests[-1][4].errback(error.ConnectionRefusedError())
+        self.assertEquals(self._hosts(), [b'node1'] * 3)
+        self.failIf(node.healthy)
+        self.assertEquals(node.stats()['ejections'], 1)
+
+        for i in range(10):
+            self.assertNotIdentical(self.cluster.pickNode(), node)
+
+    def test_timedOut(self):
+        self.cluster.readPolicy = cluster.LEAST_IN_FLIGHT
+        node = self.cluster.nodes[0]
+        for other in self.cluster.nodes[1:]:
+            other.inFlight = 5
+        for i in range(3):
+            d = self.cluster.get("/mydb/doc", timeout=1)
+            self.clock.advance(1)
+            self.assertFailure(d, client.RequestTimeout)
+        self.assertEquals(self._hosts(), [b'node1'] * 3)
+        self.failIf(node.healthy)
+
+    def test_cancelled(self):
+        # requests cancelled before their deadline did not fail
+        node = self.cluster.nodes[0]
+        for i in range(3):
+            d = self.cluster.get("/mydb/doc", timeout=1)
+            d.cancel()
+            self.assertFailure(d, defer.CancelledError)
+        self.assertEquals([n.failures for n in self.cluster.nodes],
+            [0, 0, 0])
+        self.failUnless(node.healthy)
+
+    def test_allEjected(self):
+        for node in self.cluster.nodes[1:]:
+            self.cluster._eject(node)
+        self.assertIdentical(self.cluster.pickNode(), self.cluster.nodes[0])
+        self.cluster._eject(self.cluster.nodes[0])
+        self.failUnless(self.cluster.pickNode() in self.cluster.nodes)
+
+    def test_healthCheck(self):
+        self.cluster._eject(self.cluster.nodes[0])
+        self.cluster.startHealthChecks(10)
+        self.addCleanup(self.cluster.stopHealthChecks)
+
+        self.clock.advance(10)
+        self.assertEquals(self._hosts(), [b'node1', b'node2', b'node3'])
+        self._answer(0, body=b'{"couchdb": "Welcome", "version": "1.6.1"}')
+        self._answer(1, code=500, body=b'{"error": "oops"}')
+        self.agent.requests[2][4].errback(error.ConnectionRefusedError())
+
+        self.assertEquals([n.healthy for n in self.cluster.nodes],
+            [True, False, False])
+
+    def test_healthCheckOptions(self):
+        self.cluster = cluster.CouchCluster(NODES, healthInterval=None,
+            clock=self.clock, username='user', password='secret',
+            cookieAuth=False, compressionPolicy=compress.CompressionPolicy())
+        self.cluster.client = self.agent
+        self.cluster.checkHealth()
+
+        # checked like the other requests, without logging in
+        self.assertEquals(self._hosts(), [b'node1', b'node2', b'node3'])
+        headers = self.agent.requests[0][2]
+        self.failUnless(headers.getRawHeaders('Authorization'))
+        self.failUnless(headers.getRawHeaders('Accept-Encoding'))
+
+    def test_healthCheckTimedOut(self):
+        self.cluster.startHealthChecks(10)
+        self.addCleanup(self.cluster.stopHealthChecks)
+
+        self.clock.advance(10)
+        self._answer(0, body=b'{"couchdb": "Welcome", "version": "1.6.1"}')
+        self._answer(1, body=b'{"couchdb": "Welcome", "version": "1.6.1"}')
+        # node3 does not answer within the interval
+        self.clock.advance(10)
+        self.assertEquals([n.healthy for n in self.cluster.nodes],
+            [True, True, False])
+        # and the next checks go out an interval later
+        self.clock.advance(10)
+        self.assertEquals(len(self.agent.requests), 6)
@@ -0,0 +1,189 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_compress -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Test for compressed transfer.
+"""
+
+import gzip
+import json
+import zlib
+
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+from twisted.web._newclient import ResponseDone
+
+from paisley import client, compress
+
+from paisley.test.test_client import FakeAgent, FakeResponse
+
+
+class Collector(object):
+    """
+    A protocol collecting what it receives.
+    """
+
+    def __init__(self):
+        self.data = []
+        self.reason = None
+        self.transport = None
+
+    def makeConnection(self, transport):
+        self.transport = transport
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        self.reason = reason
+
+
+class CompressionPolicyTestCase(TestCase):
+
+    def setUp(self):
+        self.policy = compress.CompressionPolicy(compressRequests=True,
+            threshold=100)
+
+    def test_requestHeaders(self):
+        headers = {}
+        self.policy.requestHeaders(headers)
+        self.assertEquals(headers['Accept-Encoding'], ['gzip, deflate'])
+
+        # ranges would apply to the compressed body
+        headers = {'Range': ['bytes=0-9']}
+        self.policy.requestHeaders(headers)
+        self.failIf('Accept-Encoding' in headers)
+
+    def test_compress(self):
+        body = b'{"a": 1}' * 100
+        headers = {}
+        compressed = self.policy.compress(body, headers)
+        self.assertEquals(gzip.decompress(compressed), body)
+        self.assertEquals(headers['Content-Encoding'], ['gzip'])
+        stats = self.policy.stats()
+        self.assertEquals(stats['requests'], 1)
+        self.assertEquals(stats['requestBytesSaved'],
+            len(body) - len(compressed))
+
+    def test_belowThreshold(self):
+        headers = {}
+        self.assertEquals(self.policy.compress(b'{}', headers), b'{}')
+        self.assertEquals(headers, {})
+        self.assertEquals(self.policy.requests, 0)
+
+    def _decode(self, encoding, chunks):
+        response = FakeResponse(headers={'Content-Encoding': [encoding]})
+        collector = Collector()
+        protocol = self.policy.decoder(response, collector)
+        for chunk in chunks:
+            protocol.dataReceived(chunk)
+        protocol.connectionLost(Failure(ResponseDone()))
+        return collector
+
+    def test_gzip(self):
+        body = b'{"rows": []}' * 1000
+        compressed = gzip.compress(body)
+        chunks = [compressed[i:i + 10] for i in range(0, len(compressed), 10)]
+        collector = self._decode('gzip', chunks)
+        self.assertEquals(b''.join(collector.data), body)
+        self.failUnless(collector.reason.check(ResponseDone))
+
+        stats = self.policy.stats()
+        self.assertEquals(stats['responses'], 1)
+        self.assertEquals(stats['responseWireBytes'], len(compressed))
+        self.assertEquals(stats['responseBytes'], len(body))
+
+    def test_deflate(self):
+        body = b'{"ok": true}'
+        collector = self._decode('deflate', [zlib.compress(body)])
+        self.assertEquals(b''.join(collector.data), body)
+
+    def test_rawDeflate(self):
+        body = b'{"ok": true}'
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        collector = self._decode('deflate',
+            [compressor.compress(body) + compressor.flush()])
+        self.assertEquals(b''.join(collector.data), body)
+
+    def test_identity(self):
+        collector = Collector()
+        self.assertIdentical(
+            self.policy.decoder(FakeResponse(), collector), collector)
+
+    def test_corrupt(self):
+        collector = self._decode('gzip', [b'not gzip at all'])
+        self.failUnless(collector.reason.check(zlib.error))
+
+    def test_truncated(self):
+        compressed = gzip.compress(b'{"rows": []}' * 1000)
+        collector = self._decode('gzip', [compressed[:-20]])
+        self.failUnless(collector.reason.check(zlib.error))
+
+
+class ClientCompressionTestCase(TestCase):
+
+    def setUp(self):
+        self.agent = FakeAgent()
+        self.policy = compress.CompressionPolicy(compressRequests=True,
+            threshold=100)
+        self.client = client.CouchDB("localhost",
+            compressionPolicy=self.policy, timeout=None)
+        self.client.client = self.agent
+
+    def _gzipResponse(self, body):
+        return FakeResponse(body=gzip.compress(body), headers={
+            'Content-Type': ['application/json'],
+            'Content-Encoding': ['gzip'],
+        })
+
+    def test_get(self):
+        d = self.client.get("/mydb/mydoc")
+        headers = self.agent.requests[0][2]
+        self.assertEquals(headers.getRawHeaders('Accept-Encoding'),
+            ['gzip, deflate'])
+        self.agent.requests[0][4].callback(self._gzipResponse(b'{"a": 1}'))
+        d.addCallback(lambda body: self.assertEquals(bytes(body), b'{"a": 1}'))
+        return d
+
+    def test_streamedView(self):
+        rows = []
+        d = self.client.openView("mydb", "design", "view",
+            rowCallback=rows.append)
+        body = json.dumps({'total_rows': 500,
+            'rows': [{'id': str(i)} for i in range(500)]}).encode('utf-8')
+        self.agent.requests[0][4].callback(self._gzipResponse(body))
+
+        def check(header):
+            self.assertEquals(len(rows), 500)
+            self.assertEquals(header, {'total_rows': 500})
+            self.failUnless(
+                self.client.getCompressionStats()['responseBytesSaved'] > 0)
+        d.addCallback(check)
+        return d
+
+    def test_saveDocs(self):
+        docs = [{'_id': str(i), 'value': 'x' * 10} for i in range(50)]
+        d = self.client.saveDocs("mydb", docs)
+        headers, producer = self.agent.requests[0][2:4]
+        self.assertEquals(headers.getRawHeaders('Content-Encoding'), ['gzip'])
+        sent = json.loads(gzip.decompress(producer.body).decode('utf-8'))
+        self.assertEquals(len(sent['docs']), 50)
+        self.agent.requests[0][4].callback(FakeResponse(body=b'[]'))
+        return d
+
+    def test_smallBody(self):
+        self.client.saveDoc("mydb", {'a': 1}, docId="mydoc")
+        headers, producer = self.agent.requests[0][2:4]
+        self.assertEquals(headers.getRawHeaders('Content-Encoding'), None)
+        self.assertEquals(producer.body, b'{"a": 1}')
+
+    def test_default(self):
+        couch = client.CouchDB("localhost", timeout=None)
+        couch.client = self.agent
+        couch.get("/mydb/mydoc")
+        headers = self.agent.requests[0][2]
+        self.assertEquals(headers.getRawHeaders('Accept-Encoding'), None)
+        self.assertEquals(couch.getCompressionStats(), {})
@@ -0,0 +1,326 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_fakecouch -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Test the client against the in-memory CouchDB.
+"""
+
+import json
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+from twisted.web import error as tw_error
+from twisted.web.test.requesthelper import DummyRequest
+
+from paisley import changes, client
+from paisley.test import fakecouch
+
+
+class MapFunctionTestCase(TestCase):
+
+    def test_member(self):
+        f = fakecouch.parseMapFunction(
+            'function(doc) { if (doc.type) { emit(doc.type, null); } }')
+        self.assertEquals(f({'type': 'tag'}), [('tag', None)])
+        self.assertEquals(f({}), [])
+
+    def test_nested(self):
+        f = fakecouch.parseMapFunction(
+            'function(doc) {\n  emit(doc.a.b, doc);\n}')
+        self.assertEquals(f({'a': {'b': 1}}), [(1, {'a': {'b': 1}})])
+        self.assertEquals(f({}), [(None, {})])
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, fakecouch.parseMapFunction,
+            'function(doc) { for (var i in doc) emit(i, 1); }')
+
+    def test_collation(self):
+        values = [{}, ['a'], 'b', 'a', 2, 1, True, False, None]
+        self.assertEquals(sorted(values, key=fakecouch.collationKey),
+            values[::-1])
+
+
+class KnobsTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.fake = fakecouch.FakeCouchDB(clock=self.clock)
+
+    def _render(self):
+        request = DummyRequest([b''])
+        self.fake.render(request)
+        return request
+
+    def test_latency(self):
+        self.fake.latency = 0.5
+        request = self._render()
+        self.clock.advance(0.4)
+        self.assertEquals(request.written, [])
+        self.clock.advance(0.1)
+        self.assertEquals(json.loads(b''.join(request.written)),
+            {'couchdb': 'Welcome', 'version': '1.6.1'})
+        self.assertEquals(request.finished, 1)
+
+    def test_throughput(self):
+        self.fake.throughput = 10
+        self.fake.chunkSize = 10
+        request = self._render()
+        # written in chunks, one per second
+        self.assertEquals(len(request.written), 1)
+        self.clock.advance(1)
+        self.assertEquals(len(request.written), 2)
+        self.clock.pump([1] * 4)
+        self.assertEquals(request.finished, 1)
+        self.assertEquals(self.fake.bytesSent,
+            len(b''.join(request.written)))
+
+
+class FakeCouchDBTestCase(TestCase):
+
+    def setUp(self):
+        self.server = fakecouch.FakeCouchDBServer()
+        self.db = self.server.start()
+        self.addCleanup(self.server.stop)
+        return self.db.createDB('mydb')
+
+    @defer.inlineCallbacks
+    def test_database(self):
+        self.assertEquals((yield self.db.listDB()), ['mydb'])
+        info = yield self.db.infoDB('mydb')
+        self.assertEquals((info['doc_count'], info['update_seq']), (0, 0))
+        yield self.assertFailure(self.db.createDB('mydb'), tw_error.Error)
+        yield self.db.deleteDB('mydb')
+        self.assertEquals((yield self.db.listDB()), [])
+
+    @defer.inlineCallbacks
+    def test_document(self):
+        result = yield self.db.saveDoc('mydb', {'a': 1}, docId='my/doc')
+        doc = yield self.db.openDoc('mydb', 'my/doc')
+        self.assertEquals(doc, {'_id': 'my/doc', '_rev': result['rev'],
+            'a': 1})
+
+        # updates need the current revision
+        e = yield self.assertFailure(
+            self.db.saveDoc('mydb', {'a': 2}, docId='my/doc'),
+            tw_error.Error)
+        self.assertEquals(e.status, b'409')
+        doc['a'] = 2
+        updated = yield self.db.saveDoc('mydb', doc, docId='my/doc')
+        self.failUnless(updated['rev'].startswith('2-'))
+        old = yield self.db.openDoc('mydb', 'my/doc', revision=result['rev'])
+        self.assertEquals(old['a'], 1)
+
+        yield self.db.deleteDoc('mydb', 'my/doc', updated['rev'])
+        yield self.assertFailure(self.db.openDoc('mydb', 'my/doc'),
+            tw_error.Error)
+
+    @defer.inlineCallbacks
+    def test_notModified(self):
+        from paisley.cache import LRUCache
+        cache = LRUCache(freshness=0)
+        couch = client.CouchDB('127.0.0.1', self.server.port, cache=cache)
+        self.addCleanup(couch.closeCachedConnections)
+        yield couch.saveDoc('mydb', {'a': 1}, docId='mydoc')
+        yield couch.openDoc('mydb', 'mydoc')
+        doc = yield couch.openDoc('mydb', 'mydoc')
+        self.assertEquals(doc['a'], 1)
+        self.assertEquals(cache.revalidatedHits, 1)
+
+    @defer.inlineCallbacks
+    def test_bulk(self):
+        docs = [{'_id': 'doc%d' % i, 'i': i} for i in range(10)]
+        results = yield self.db.saveDocs('mydb', docs, chunkSize=4)
+        self.assertEquals(len(results), 10)
+        conflicts = yield self.db.saveDocs('mydb', docs[:1])
+        self.assertEquals(conflicts[0]['error'], 'conflict')
+
+        result = yield self.db.listDoc('mydb', startkey='doc2',
+            endkey='doc4', include_docs=True)
+        self.assertEquals([row['doc']['i'] for row in result['rows']],
+            [2, 3, 4])
+        self.assertEquals(result['total_rows'], 10)
+
+        found = yield self.db.openDocs('mydb', ['doc1', 'none'])
+        self.assertEquals(found[0]['doc']['i'], 1)
+        self.assertEquals(found[1], {'id': 'none', 'error': 'not_found'})
+
+    @defer.inlineCallbacks
+    def test_view(self):
+        yield self.db.saveDocs('mydb', [{'type': t} for t in 'abacb'] +
+            [{'other': 1}])
+        yield self.db.saveDoc('mydb', {'views': {
+            'types': {
+                'map': 'function(doc) { if (doc.type) '
+                    '{ emit(doc.type, 1); } }',
+                'reduce': '_count',
+            },
+        }}, docId='_design/d')
+
+        result = yield self.db.openView('mydb', 'd', 'types', key='a',
+            reduce=False)
+        self.assertEquals([row['key'] for row in result['rows']],
+            ['a', 'a'])
+        result = yield self.db.openView('mydb', 'd', 'types', group=True)
+        self.assertEquals(result['rows'], [{'key': 'a', 'value': 2},
+            {'key': 'b', 'value': 2}, {'key': 'c', 'value': 1}])
+
+        rows = []
+        yield self.db.openView('mydb', 'd', 'types', keys=['c', 'b'],
+            reduce=False, rowCallback=rows.append)
+        self.assertEquals([row['key'] for row in rows], ['c', 'b', 'b'])
+
+    @defer.inlineCallbacks
+    def test_pythonView(self):
+        self.server.resource.addView('mydb', 'd', 'squares',
+            lambda doc: [(doc['i'] ** 2, None)])
+        yield self.db.saveDocs('mydb', [{'i': i} for i in (3, -1, 2)])
+        result = yield self.db.openView('mydb', 'd', 'squares',
+            descending=True, limit=2)
+        self.assertEquals([row['key'] for row in result['rows']], [9, 4])
+
+    @defer.inlineCallbacks
+    def test_changes(self):
+        yield self.db.saveDoc('mydb', {}, docId='before')
+        received = []
+        done = defer.Deferred()
+
+        class Listener(changes.ChangeListener):
+
+            def changed(self, change):
+                received.append(change)
+                if len(received) == 3:
+                    done.callback(None)
+
+        notifier = changes.ChangeNotifier(self.db, 'mydb', since=0)
+        notifier.addListener(Listener())
+        yield notifier.start()
+        result = yield self.db.saveDoc('mydb', {}, docId='after')
+        yield self.db.deleteDoc('mydb', 'after', result['rev'])
+        yield done
+        notifier.stop()
+
+        self.assertEquals([(c['seq'], c['id']) for c in received],
+            [(1, 'before'), (2, 'after'), (3, 'after')])
+        self.failUnless(received[2]['deleted'])
+
+    @defer.inlineCallbacks
+    def test_changesRefresh(self):
+        from paisley.cache import LRUCache
+        cache = LRUCache()
+        couch = client.CouchDB('127.0.0.1', self.server.port, cache=cache)
+        self.addCleanup(couch.closeCachedConnections)
+        yield couch.saveDocs('mydb', [{'_id': 'a'}, {'_id': 'b'}])
+        a = yield couch.openDoc('mydb', 'a')
+
+        namespace = couch.cacheNamespace('mydb')
+        received = []
+        refreshed = []
+        done = defer.Deferred()
+
+        class Listener(changes.ChangeListener):
+
+            def changed(self, change):
+                # called after the caches were written
+                received.append(change)
+                if len(received) == 1:
+                    cache.get('a', namespace).addCallback(refreshed.append)
+                if len(received) == 3:
+                    done.callback(None)
+
+        notifier = changes.ChangeNotifier(couch, 'mydb', refresh=True)
+        notifier.addCache(cache)
+        notifier.addListener(Listener())
+        yield notifier.start()
+
+        result = yield couch.saveDoc('mydb', a, docId='a')
+        yield couch.saveDoc('mydb', {'new': True}, docId='c')
+        yield couch.deleteDoc('mydb', 'a', result['rev'])
+        yield done
+        notifier.stop()
+
+        # a was refreshed, and evicted once deleted; c was never resident
+        self.assertEquals(refreshed[0]['_rev'], result['rev'])
+        self.assertRaises(KeyError, cache.get, 'a', namespace)
+        self.assertRaises(KeyError, cache.get, 'c', namespace)
+
+    @defer.inlineCallbacks
+    def test_changesSession(self):
+        self.server.resource.users = {'user': 'secret'}
+        first = client.CouchDB('127.0.0.1', self.server.port,
+            username='user', password='secret')
+        self.addCleanup(first.closeCachedConnections)
+        yield first.saveDoc('mydb', {}, docId='a')
+        self.addCleanup(first._sessionManager.stop)
+
+        # shares the session of the first client, but never logged in
+        couch = client.CouchDB('127.0.0.1', self.server.port,
+            username='user', password='secret')
+        self.addCleanup(couch.closeCachedConnections)
+        changed = defer.Deferred()
+
+        class Listener(changes.ChangeListener):
+
+            def changed(self, change):
+                changed.callback(change)
+
+        notifier = changes.ChangeNotifier(couch, 'mydb', since=0)
+        notifier.addListener(Listener())
+        yield notifier.start()
+        change = yield changed
+        notifier.stop()
+        self.assertEquals(change['id'], 'a')
+        self.assertEquals(couch.getSessionStats()['logins'], 1)
+    test_changesSession.timeout = 10
+
+    @defer.inlineCallbacks
+    def test_viewCache(self):
+        from paisley.cache import ViewCache
+        viewCache = ViewCache()
+        couch = client.CouchDB('127.0.0.1', self.server.port,
+            viewCache=viewCache)
+        self.addCleanup(couch.closeCachedConnections)
+        self.server.resource.addView('mydb', 'd', 'all',
+            lambda doc: [(doc['_id'], None)])
+
+        changed = defer.Deferred()
+
+        class Listener(changes.ChangeListener):
+
+            def changed(self, change):
+                changed.callback(None)
+
+        notifier = changes.ChangeNotifier(couch, 'mydb')
+        notifier.addViewCache(viewCache)
+        notifier.addListener(Listener())
+        yield notifier.start()
+
+        result = yield couch.openView('mydb', 'd', 'all')
+        self.assertEquals(result['rows'], [])
+        requests = self.server.resource.requests
+        yield couch.openView('mydb', 'd', 'all')
+        self.assertEquals(self.server.resource.requests, requests)
+
+        yield couch.saveDoc('mydb', {}, docId='new')
+        yield changed
+        notifier.stop()
+        result = yield couch.openView('mydb', 'd', 'all')
+        self.assertEquals([row['id'] for row in result['rows']], ['new'])
+
+    @defer.inlineCallbacks
+    def test_session(self):
+        self.server.resource.users = {'user': 'secret'}
+        couch = client.CouchDB('127.0.0.1', self.server.port,
+            username='user', password='secret')
+        self.addCleanup(couch.closeCachedConnections)
+        self.assertEquals((yield couch.listDB()), ['mydb'])
+        self.addCleanup(couch._sessionManager.stop)
+        self.assertEquals(couch.getSessionStats()['logins'], 1)
+
+        yield self.assertFailure(self.db.listDB(), tw_error.Error)
+        wrong = client.CouchDB('127.0.0.1', self.server.port,
+            username='user', password='wrong')
+        self.addCleanup(wrong.closeCachedConnections)
+        yield self.assertFailure(wrong.listDB(), client.AuthenticationError)
@@ -0,0 +1,115 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_hedge -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Test for hedging slow reads.
+"""
+
+from twisted.internet import defer, error, task
+from twisted.trial.unittest import TestCase
+
+from paisley import client, hedge
+
+from paisley.test.test_client import FakeAgent, FakeResponse
+
+
+class HedgePolicyTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.policy = hedge.HedgePolicy(maxDelay=0.5, clock=self.clock)
+        self.requests = []
+        self.cancelled = []
+
+    def _request(self):
+        d = defer.Deferred(lambda d: self.cancelled.append(d))
+        self.requests.append(d)
+        return d
+
+    def test_fast(self):
+        results = []
+        self.policy.call(self._request).addCallback(results.append)
+        self.requests[0].callback('first')
+        self.assertEquals(results, ['first'])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        self.assertEquals(self.policy.hedges, 0)
+
+    def test_hedged(self):
+        results = []
+        self.policy.call(self._request).addCallback(results.append)
+        self.clock.advance(0.5)
+        self.assertEquals(len(self.requests), 2)
+
+        # the copy answers first, the first request is cancelled
+        self.requests[1].callback('copy')
+        self.assertEquals(results, ['copy'])
+        self.assertEquals(self.cancelled, [self.requests[0]])
+        self.assertEquals(self.policy.hedgeWins, 1)
+
+    def test_firstFails(self):
+        results = []
+        self.policy.call(self._request).addCallback(results.append)
+        self.clock.advance(0.5)
+        self.requests[0].errback(error.ConnectionLost())
+        self.assertEquals(results, [])
+        self.requests[1].callback('copy')
+        self.assertEquals(results, ['copy'])
+
+    def test_failure(self):
+        d = self.policy.call(self._request)
+        self.requests[0].errback(error.ConnectionLost())
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        return self.assertFailure(d, error.ConnectionLost)
+
+    def test_percentile(self):
+        for i in range(100):
+            self.policy.record(i / 1000.0)
+        self.assertEquals(self.policy.delay(), 0.095)
+        self.policy.record(5)
+        self.assertEquals(self.policy.delay(), 0.095)
+
+    def test_budget(self):
+        self.policy.budget = 1
+        self.policy._tokens = 1
+        for i in range(3):
+            self.policy.call(self._request)
+            self.clock.advance(0.5)
+        self.assertEquals(self.policy.hedges, 1)
+        self.assertEquals(self.policy.budgetExhausted, 2)
+        self.assertEquals(len(self.requests), 4)
+
+    def test_cancel(self):
+        d = self.policy.call(self._request)
+        self.clock.advance(0.5)
+        d.cancel()
+        self.assertEquals(self.cancelled, self.requests)
+        return self.assertFailure(d, defer.CancelledError)
+
+
+class ClientHedgeTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.agent = FakeAgent()
+        self.client = client.CouchDB("localhost",
+            hedgePolicy=hedge.HedgePolicy(maxDelay=0.1, clock=self.clock),
+            timeout=None)
+        self.client.client = self.agent
+
+    def test_get(self):
+        d = self.client.get("/mydb/mydoc")
+        self.clock.advance(0.1)
+        self.assertEquals(len(self.agent.requests), 2)
+        self.agent.requests[1][4].callback(FakeResponse(body=b'{"a": 1}'))
+        d.addCallback(lambda body: self.assertEquals(bytes(body), b'{"a": 1}'))
+        return d
+
+    def test_writesNotHedged(self):
+        self.client.saveDoc("mydb", {'_rev': '1-a'}, docId="mydoc")
+        self.client.openView("mydb", "design", "view",
+            rowCallback=lambda row: None)
+        self.clock.advance(1)
+        self.assertEquals(len(self.agent.requests), 2)
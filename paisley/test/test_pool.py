@@ -0,0 +1,77 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_pool -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Test for the persistent connection pool.
+"""
+
+from twisted.internet import reactor
+from twisted.trial.unittest import TestCase
+from twisted.web import server
+
+from paisley import client, pool
+
+from paisley.test.test_client import FakeCouchDBResource
+
+
+class ConnectionPoolTestCase(TestCase):
+
+    def setUp(self):
+        self.resource = FakeCouchDBResource()
+        self.resource.result = '["mydb"]'
+        site = server.Site(self.resource)
+        port = reactor.listenTCP(0, site, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.client = client.CouchDB("127.0.0.1", port.getHost().port)
+        self.addCleanup(self.client.closeCachedConnections)
+
+    def test_defaultPool(self):
+        self.failUnless(isinstance(self.client.pool, pool.ConnectionPool))
+        self.assertEquals(self.client.getPoolStats(), {
+            'inUse': 0, 'idle': 0, 'created': 0, 'reused': 0})
+
+    def test_sharedPool(self):
+        shared = pool.ConnectionPool(reactor, maxPersistentPerHost=4)
+        one = client.CouchDB("localhost", pool=shared)
+        two = client.CouchDB("localhost", pool=shared)
+        self.assertIdentical(one.pool, two.pool)
+        self.assertEquals(shared.maxPersistentPerHost, 4)
+
+    def test_reused(self):
+        d = self.client.listDB()
+
+        def firstCb(_):
+            stats = self.client.getPoolStats()
+            self.assertEquals(stats['created'], 1)
+            self.assertEquals(stats['reused'], 0)
+            return self.client.listDB()
+        d.addCallback(firstCb)
+
+        def secondCb(_):
+            stats = self.client.getPoolStats()
+            self.assertEquals(stats['created'], 1)
+            self.assertEquals(stats['reused'], 1)
+            self.assertEquals(stats['inUse'], 0)
+            self.assertEquals(stats['idle'], 1)
+        d.addCallback(secondCb)
+        return d
+
+    def test_warmup(self):
+        self.resource.result = '{"couchdb": "Welcome", "version": "1.6.1"}'
+        shared = pool.ConnectionPool(reactor, maxPersistentPerHost=3)
+        self.client = client.CouchDB("127.0.0.1", self.client.port,
+            pool=shared)
+        self.addCleanup(shared.closeCachedConnections)
+        d = self.client.warmup()
+
+        def cb(version):
+            self.assertEquals(version, (1, 6, 1))
+            self.assertEquals(self.client.version, (1, 6, 1))
+            stats = self.client.getPoolStats()
+            self.assertEquals(stats['created'], 3)
+            self.assertEquals(stats['idle'], 3)
+        d.addCallback(cb)
+        return d
@@ -0,0 +1,179 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_retry -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Test for retrying failed requests.
+"""
+
+from twisted.internet import defer, error, task
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+from twisted.web import error as tw_error
+
+from paisley import client, retry
+
+from paisley.test.test_client import FakeAgent, FakeResponse
+
+
+class RetryPolicyTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.policy = retry.RetryPolicy(jitter=False, clock=self.clock)
+        self.outcomes = []
+        self.calls = 0
+
+    def _attempt(self):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            return defer.fail(outcome)
+        return defer.succeed((b'', outcome))
+
+    def test_connectionError(self):
+        self.outcomes = [error.ConnectionRefusedError(), None]
+        results = []
+        self.policy.call(self._attempt).addCallback(results.append)
+        self.assertEquals(self.calls, 1)
+
+        self.clock.advance(0.1)
+        self.assertEquals(self.calls, 2)
+        self.assertEquals(results, [(b'', None)])
+        self.assertEquals(self.policy.stats(), {'calls': 1, 'attempts': 2,
+            'retries': 1, 'giveUps': 0, 'budgetExhausted': 0})
+
+    def test_backoff(self):
+        self.outcomes = [FakeResponse(503)] * 4
+        d = self.policy.call(self._attempt)
+        self.clock.pump([0.1, 0.2, 0.4])
+        self.assertEquals(self.calls, 4)
+        self.assertEquals(self.policy.giveUps, 1)
+
+        # the last response is passed on
+        d.addCallback(lambda result: self.assertEquals(result[1].code, 503))
+        return d
+
+    def test_jitter(self):
+        self.policy.jitter = True
+        for i in range(20):
+            delay = self.policy.backoff(3)
+            self.failUnless(0 <= delay <= 0.4)
+
+    def test_notRetried(self):
+        self.outcomes = [RuntimeError(), FakeResponse(409)]
+        d1 = self.policy.call(self._attempt)
+        d2 = self.policy.call(self._attempt)
+        self.assertEquals(self.calls, 2)
+        self.assertEquals(self.policy.retries, 0)
+        d2.addCallback(lambda result: self.assertEquals(result[1].code, 409))
+        return defer.gatherResults([self.assertFailure(d1, RuntimeError), d2])
+
+    def test_retryAfter(self):
+        self.outcomes = [FakeResponse(503, headers={'Retry-After': ['2']}),
+            None]
+        self.policy.call(self._attempt)
+        self.clock.advance(1.9)
+        self.assertEquals(self.calls, 1)
+        self.clock.advance(0.1)
+        self.assertEquals(self.calls, 2)
+
+    def test_retryAfterTooLong(self):
+        self.outcomes = [FakeResponse(503, headers={'Retry-After': ['60']})]
+        self.policy.call(self._attempt)
+        self.assertEquals(self.policy.giveUps, 1)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_parseRetryAfter(self):
+        self.assertEquals(retry.parseRetryAfter('120'), 120)
+        self.assertEquals(retry.parseRetryAfter(
+            'Wed, 21 Oct 2015 07:28:00 GMT', 1445412470), 10)
+        self.assertEquals(retry.parseRetryAfter('soon'), None)
+
+    def test_budget(self):
+        self.policy = retry.RetryPolicy(maxAttempts=2, jitter=False,
+            budget=2, budgetRatio=0.5, clock=self.clock)
+        self.outcomes = [error.ConnectionLost()] * 10
+        for i in range(4):
+            self.policy.call(self._attempt).addErrback(lambda _: None)
+            self.clock.advance(1)
+        # every request saves up half a retry
+        self.assertEquals(self.policy.retries, 3)
+        self.assertEquals(self.policy.budgetExhausted, 1)
+        self.assertEquals(self.policy.giveUps, 4)
+
+    def test_cancel(self):
+        self.outcomes = [error.ConnectionLost()]
+        d = self.policy.call(self._attempt)
+        d.cancel()
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_cancelInFlight(self):
+        from twisted.web._newclient import ResponseNeverReceived
+
+        def attempt():
+            self.calls += 1
+            # agents fail cancelled requests with a retryable error
+            return defer.Deferred(lambda d: d.errback(
+                ResponseNeverReceived([Failure(defer.CancelledError())])))
+        d = self.policy.call(attempt)
+        d.cancel()
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        self.assertEquals(self.calls, 1)
+        self.assertEquals(self.policy.retries, 0)
+        return self.assertFailure(d, defer.CancelledError)
+
+
+class ClientRetryTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.agent = FakeAgent()
+        self.client = client.CouchDB("localhost",
+            retryPolicy=retry.RetryPolicy(jitter=False, clock=self.clock),
+            timeout=None)
+        self.client.client = self.agent
+
+    def test_get(self):
+        d = self.client.get("/mydb/mydoc")
+        self.agent.requests[0][4].callback(FakeResponse(503))
+        self.clock.advance(0.1)
+        self.assertEquals(len(self.agent.requests), 2)
+        self.agent.requests[1][4].callback(FakeResponse(body=b'{}'))
+        d.addCallback(lambda body: self.assertEquals(bytes(body), b'{}'))
+        return d
+
+    def test_givenUp(self):
+        self.client.retryPolicy.maxAttempts = 1
+        d = self.client.get("/mydb/mydoc")
+        self.agent.requests[0][4].callback(FakeResponse(503))
+        return self.assertFailure(d, tw_error.Error)
+
+    def test_writes(self):
+        # creating a document could create it twice
+        dl = [self.client.saveDoc("mydb", {'a': 1}),
+            self.client.saveDoc("mydb", '{"_rev": "1-a"}', docId="mydoc"),
+            self.client.post("/mydb/_compact", ""),
+            # updating or deleting a given revision can be retried
+            self.client.saveDoc("mydb", {'_rev': '1-a'}, docId="mydoc"),
+            self.client.deleteDoc("mydb", "mydoc", "1-a")]
+        for d in dl:
+            d.addErrback(lambda f: f.trap(error.ConnectionLost))
+        for method, uri, headers, body, d in self.agent.requests:
+            d.errback(error.ConnectionLost())
+        self.clock.advance(0.1)
+        self.assertEquals([r[0] for r in self.agent.requests[5:]],
+            [b"PUT", b"DELETE"])
+        self.assertEquals(self.client.getRetryStats()['retries'], 2)
+
+    def test_streamingFailure(self):
+        # rows may have been handed out already
+        d = self.client.openView("mydb", "design", "view",
+            rowCallback=lambda row: None)
+        self.agent.requests[0][4].callback(
+            FakeResponse(body=b'{"total_rows": 1, "rows": ['))
+        self.assertEquals(self.client.getRetryStats()['retries'], 0)
+        return self.assertFailure(d, ValueError)
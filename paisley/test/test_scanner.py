@@ -0,0 +1,129 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_scanner -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Tests for paginated scanning.
+"""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+
+from paisley import scanner
+
+
+# a view with duplicate keys, sorted like couchdb does
+ROWS = [{'key': key, 'id': docId, 'value': None} for key, docId in [
+    (1, 'a'), (1, 'b'), (1, 'c'), (2, 'a'), (2, 'd'), (3, 'e'), (3, 'f')]]
+
+
+class StubCouch(object):
+    """
+    A stub couchdb object that pages through preset rows.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.pending = []
+
+    def _page(self, rows, limit, startkey=None, startkey_docid=None):
+        if startkey is not None:
+            start = (startkey, startkey_docid or '')
+            rows = [r for r in rows if (r['key'], r['id']) >= start]
+        return {'total_rows': len(ROWS), 'offset': 0, 'rows': rows[:limit]}
+
+    def openView(self, dbName, docId, viewId, **kwargs):
+        self.requests.append(kwargs)
+        return defer.succeed(self._page(ROWS, **kwargs))
+
+    def listDoc(self, dbName, **kwargs):
+        self.requests.append(kwargs)
+        rows = [{'key': r['id'], 'id': r['id']} for r in ROWS[:3]]
+        return defer.succeed(self._page(rows, **kwargs))
+
+
+class ScannerTestCase(TestCase):
+
+    def setUp(self):
+        self.couch = StubCouch()
+
+    def test_scanView(self):
+        s = scanner.Scanner(self.couch, 'test', 'design', 'view', pageSize=2)
+        rows = []
+        d = s.scan(rows.append)
+
+        def cb(count):
+            self.assertEquals(count, 7)
+            self.assertEquals(rows, ROWS)
+            self.assertEquals(s.cursor, None)
+            self.assertEquals(self.couch.requests[0], {'limit': 3})
+            self.assertEquals(self.couch.requests[1],
+                {'limit': 3, 'startkey': 1, 'startkey_docid': 'c'})
+        d.addCallback(cb)
+        return d
+
+    def test_scanAllDocs(self):
+        s = scanner.Scanner(self.couch, 'test', pageSize=2)
+        rows = []
+        d = s.scan(rows.append)
+
+        def cb(count):
+            self.assertEquals(count, 3)
+            self.assertEquals([r['id'] for r in rows], ['a', 'b', 'c'])
+            self.assertEquals(self.couch.requests[1],
+                {'limit': 3, 'startkey': 'c'})
+        d.addCallback(cb)
+        return d
+
+    def test_prefetch(self):
+        s = scanner.Scanner(self.couch, 'test', 'design', 'view', pageSize=3)
+        d = s.nextPage()
+
+        def cb(rows):
+            self.assertEquals(rows, ROWS[:3])
+            # the next page has been requested already
+            self.assertEquals(len(self.couch.requests), 2)
+        d.addCallback(cb)
+        return d
+
+    def test_resume(self):
+        s = scanner.Scanner(self.couch, 'test', 'design', 'view', pageSize=3)
+        d = s.nextPage()
+        # done with the first page once the second one is asked for
+        d.addCallback(lambda _: s.nextPage())
+
+        def resumeCb(_):
+            resumed = scanner.Scanner(self.couch, 'test', 'design', 'view',
+                pageSize=3, cursor=s.cursor)
+            rows = []
+            d = resumed.scan(rows.append)
+            d.addCallback(lambda _: self.assertEquals(rows, ROWS[3:]))
+            return d
+        d.addCallback(resumeCb)
+        return d
+
+    def test_resumeMidPage(self):
+        s = scanner.Scanner(self.couch, 'test', 'design', 'view', pageSize=3)
+        cursors = []
+
+        def rowCallback(row):
+            cursors.append(s.cursor)
+        d = s.scan(rowCallback)
+
+        def resumeCb(_):
+            # saved while handling the fifth row, in the second page
+            resumed = scanner.Scanner(self.couch, 'test', 'design', 'view',
+                pageSize=3, cursor=cursors[4])
+            rows = []
+            d = resumed.scan(rows.append)
+            d.addCallback(lambda _: self.assertEquals(rows, ROWS[3:]))
+            return d
+        d.addCallback(resumeCb)
+        return d
+
+    def test_cursor(self):
+        cursor = scanner.encodeCursor([1, u'\xe9'], 'doc/1')
+        self.assertEquals(scanner.decodeCursor(cursor),
+            ([1, u'\xe9'], 'doc/1'))
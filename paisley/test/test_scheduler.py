@@ -0,0 +1,218 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_scheduler -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Test for the request scheduler.
+"""
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+from paisley import client, scheduler
+
+from paisley.test.test_client import FakeAgent, FakeResponse
+
+
+class SchedulerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.started = []
+
+    def _scheduler(self, **kwargs):
+        return scheduler.Scheduler(clock=self.clock, **kwargs)
+
+    def _submit(self, s, name, host='a', priority='default'):
+        """
+        Submit a request that runs until the test fires its deferred.
+        """
+
+        def request():
+            d = defer.Deferred()
+            self.started.append((name, d))
+            return d
+        return s.submit(request, host, priority)
+
+    def _finish(self, name):
+        for started, d in self.started:
+            if started == name:
+                d.callback(name)
+                return
+        self.fail("%s not started" % (name, ))
+
+    def test_unlimited(self):
+        s = self._scheduler()
+        results = []
+        for name in range(5):
+            self._submit(s, name).addCallback(results.append)
+        self.assertEquals(len(self.started), 5)
+        self._finish(3)
+        self.assertEquals(results, [3])
+
+    def test_maxPerHost(self):
+        s = self._scheduler(maxPerHost=1)
+        self._submit(s, 'a1')
+        self._submit(s, 'a2')
+        self._submit(s, 'b1', host='b')
+        self.assertEquals([n for n, d in self.started], ['a1', 'b1'])
+        self.assertEquals(s.stats()['hosts'], {'a': 1, 'b': 1})
+
+        self._finish('a1')
+        self.assertEquals([n for n, d in self.started], ['a1', 'b1', 'a2'])
+
+    def test_maxInFlight(self):
+        s = self._scheduler(maxInFlight=2)
+        for name in ['a1', 'b1', 'c1']:
+            self._submit(s, name, host=name[0])
+        self.assertEquals(len(self.started), 2)
+        self.assertEquals(s.stats()['queued'], 1)
+
+        self._finish('a1')
+        self.assertEquals(self.started[-1][0], 'c1')
+        self.assertEquals(s.stats()['inFlight'], 2)
+
+    def test_priorities(self):
+        s = self._scheduler(maxInFlight=1)
+        self._submit(s, 'first')
+        for i in range(20):
+            self._submit(s, 'bulk%d' % i, priority='bulk')
+        for i in range(20):
+            self._submit(s, 'int%d' % i, priority='interactive')
+
+        for i in range(18):
+            self._finish(self.started[-1][0])
+        order = [n for n, d in self.started[1:]]
+        # interactive requests go first, but bulk ones are not starved
+        self.assertEquals(order[:4], ['int%d' % i for i in range(4)])
+        self.assertEquals(
+            [n for n in order if n.startswith('bulk')], ['bulk0', 'bulk1'])
+        self.assertEquals(len(order), 18)
+
+    def test_waitStats(self):
+        s = self._scheduler(maxInFlight=1)
+        self._submit(s, 'first')
+        self._submit(s, 'second', priority='bulk')
+        self.clock.advance(3)
+        self._finish('first')
+
+        lanes = s.stats()['lanes']
+        self.assertEquals(lanes['default']['started'], 1)
+        self.assertEquals(lanes['default']['waitMax'], 0)
+        self.assertEquals(lanes['bulk']['started'], 1)
+        self.assertEquals(lanes['bulk']['waitMax'], 3)
+        self.assertEquals(lanes['bulk']['waitAverage'], 3)
+
+    def test_reject(self):
+        s = self._scheduler(maxInFlight=1, maxQueued=1)
+        self._submit(s, 'first')
+        self._submit(s, 'queued')
+        d = self._submit(s, 'rejected', priority='interactive')
+        self.assertEquals(s.stats()['rejected'], 1)
+        return self.assertFailure(d, scheduler.QueueFull)
+
+    def test_shed(self):
+        s = self._scheduler(maxInFlight=1, maxQueued=2,
+            overflow=scheduler.OVERFLOW_SHED)
+        self._submit(s, 'first')
+        old = self._submit(s, 'old', priority='bulk')
+        self._submit(s, 'urgent', priority='interactive')
+        # the oldest request of the least urgent lane makes room
+        self._submit(s, 'new', priority='default')
+        # a bulk request cannot push out more urgent ones
+        rejected = self._submit(s, 'bulk', priority='bulk')
+
+        stats = s.stats()
+        self.assertEquals(stats['shed'], 1)
+        self.assertEquals(stats['rejected'], 1)
+        self.assertEquals(stats['lanes']['bulk']['queued'], 0)
+
+        self._finish('first')
+        self.assertEquals(self.started[-1][0], 'urgent')
+        return defer.gatherResults([
+            self.assertFailure(old, scheduler.QueueFull),
+            self.assertFailure(rejected, scheduler.QueueFull)])
+
+    def test_cancelQueued(self):
+        s = self._scheduler(maxInFlight=1)
+        self._submit(s, 'first')
+        d = self._submit(s, 'cancelled')
+        d.cancel()
+        self.assertEquals(s.stats()['queued'], 0)
+        self._finish('first')
+        self.assertEquals(len(self.started), 1)
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_cancelRunning(self):
+        s = self._scheduler(maxInFlight=1)
+        d = self._submit(s, 'cancelled')
+        self._submit(s, 'next')
+        d.cancel()
+        self.assertEquals(self.started[-1][0], 'next')
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_failure(self):
+        s = self._scheduler(maxInFlight=1)
+        d = s.submit(lambda: defer.fail(RuntimeError()))
+        self.assertEquals(s.stats()['inFlight'], 0)
+        return self.assertFailure(d, RuntimeError)
+
+    def test_unknownPriority(self):
+        s = self._scheduler()
+        self.assertRaises(ValueError, s.submit, lambda: None, 'a', 'urgent')
+
+
+class ClientSchedulerTestCase(TestCase):
+
+    def setUp(self):
+        self.agent = FakeAgent()
+        self.client = client.CouchDB("localhost", maxInFlight=1,
+            timeout=None)
+        self.client.client = self.agent
+
+    def test_options(self):
+        c = client.CouchDB("localhost", maxInFlight=4, maxPerHost=2,
+            maxQueued=8, overflow=scheduler.OVERFLOW_SHED)
+        self.assertEquals(c.scheduler.maxInFlight, 4)
+        self.assertEquals(c.scheduler.maxPerHost, 2)
+        self.assertEquals(c.scheduler.maxQueued, 8)
+        self.assertEquals(c.scheduler.overflow, scheduler.OVERFLOW_SHED)
+
+    def test_queued(self):
+        d1 = self.client.get("/mydb/a")
+        d2 = self.client.get("/mydb/b")
+        self.assertEquals(len(self.agent.requests), 1)
+        self.assertEquals(self.client.getSchedulerStats()['queued'], 1)
+
+        # the slot is held until the body has been received
+        self.agent.requests[0][4].callback(FakeResponse(body=b'{}'))
+        self.assertEquals(len(self.agent.requests), 2)
+        self.agent.requests[1][4].callback(FakeResponse(body=b'[]'))
+
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(lambda results: self.assertEquals(
+            [bytes(r) for r in results], [b'{}', b'[]']))
+        return d
+
+    def test_bulkPriority(self):
+        self.client.get("/mydb/a")
+        self.client.saveDocs("mydb", [{}])
+        self.client.get("/mydb/b", priority='interactive')
+        self.agent.requests[0][4].callback(FakeResponse(body=b'{}'))
+        self.assertEquals(self.agent.requests[1][1],
+            b"http://localhost:5984/mydb/b")
+
+    def test_interactiveOpenDoc(self):
+        self.client.get("/mydb/a")
+        self.client.saveDocs("mydb", [{}])
+        self.client.saveDoc("mydb", {}, priority='bulk')
+        d = self.client.openDoc("mydb", "mydoc", priority='interactive')
+        self.agent.requests[0][4].callback(FakeResponse(body=b'{}'))
+        # the document is opened before the queued bulk work
+        self.assertEquals(self.agent.requests[1][1],
+            b"http://localhost:5984/mydb/mydoc")
+        self.agent.requests[1][4].callback(FakeResponse(body=b'{"a": 1}'))
+        d.addCallback(self.assertEquals, {"a": 1})
+        return d
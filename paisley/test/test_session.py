@@ -0,0 +1,241 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_session -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Test for session cookie authentication.
+"""
+
+import io
+from http.cookies import SimpleCookie
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+from twisted.web import error as tw_error
+
+from paisley import client, session
+
+from paisley.test.test_client import FakeAgent, FakeResponse
+
+
+def sessionResponse(value='abc', attributes='Version=1; Path=/; HttpOnly'):
+    return FakeResponse(body=b'{"ok": true, "name": "user", "roles": ["r"]}',
+        headers={
+            'Content-Type': ['application/json'],
+            'Set-Cookie': ['AuthSession=%s; %s' % (value, attributes)],
+        })
+
+
+class ParseExpiryTestCase(TestCase):
+
+    def _morsel(self, attributes):
+        return SimpleCookie('AuthSession=abc; ' + attributes)['AuthSession']
+
+    def test_maxAge(self):
+        self.assertEquals(session.parseExpiry(
+            self._morsel('Max-Age=600'), 0), 600)
+
+    def test_expires(self):
+        morsel = self._morsel('Expires=Thu, 01 Jan 1970 00:10:00 GMT')
+        self.assertEquals(session.parseExpiry(morsel, 60), 540)
+        # measured against the clock of the server
+        self.assertEquals(session.parseExpiry(morsel, 60,
+            'Thu, 01 Jan 1970 00:00:00 GMT'), 600)
+
+    def test_none(self):
+        self.assertEquals(session.parseExpiry(self._morsel('Path=/'), 0),
+            None)
+
+
+class SessionManagerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.agent = FakeAgent()
+        self.manager = session.SessionManager(self.agent,
+            b'http://localhost:5984', 'user', 'secret', clock=self.clock)
+
+    def test_login(self):
+        results = []
+        self.manager.login().addCallback(results.append)
+        self.manager.login().addCallback(results.append)
+        # one login for both
+        self.assertEquals(len(self.agent.requests), 1)
+        method, uri, headers, producer, d = self.agent.requests[0]
+        self.assertEquals((method, uri),
+            (b'POST', b'http://localhost:5984/_session'))
+        self.assertEquals(producer.body, b'name=user&password=secret')
+
+        d.callback(sessionResponse())
+        self.assertEquals(len(results), 2)
+        self.assertEquals(results[0]['roles'], ['r'])
+        self.assertEquals(self.manager.getCookie(), 'AuthSession=abc')
+        self.assertEquals(self.manager.stats()['expiresIn'], 600)
+
+    def test_renewed(self):
+        self.manager.login()
+        self.agent.requests[0][4].callback(sessionResponse(
+            attributes='Max-Age=300'))
+        self.manager.getCookie()
+        self.clock.advance(240)
+        self.assertEquals(len(self.agent.requests), 2)
+        self.assertEquals(self.manager.renewals, 1)
+
+        # the old cookie is still valid until the new one arrives
+        self.assertEquals(self.manager.getCookie(), 'AuthSession=abc')
+        self.agent.requests[1][4].callback(sessionResponse('def'))
+        self.assertEquals(self.manager.getCookie(), 'AuthSession=def')
+
+    def test_unusedLapses(self):
+        self.manager.login()
+        self.agent.requests[0][4].callback(sessionResponse())
+        self.clock.advance(600)
+        self.assertEquals(len(self.agent.requests), 1)
+        self.assertEquals(self.manager.getCookie(), None)
+
+    def test_refused(self):
+        d1 = self.manager.login()
+        d2 = self.manager.login()
+        self.agent.requests[0][4].callback(FakeResponse(401,
+            body=b'{"error": "unauthorized"}'))
+        self.assertEquals(self.manager.failures, 1)
+        self.assertFailure(d1, client.AuthenticationError)
+        return self.assertFailure(d2, client.AuthenticationError)
+
+    def test_timedOut(self):
+        self.manager.timeout = 10
+        d1 = self.manager.login()
+        d2 = self.manager.login()
+        self.clock.advance(10)
+        self.assertEquals(self.manager.failures, 1)
+        self.assertFailure(d1, client.RequestTimeout)
+        self.assertFailure(d2, client.RequestTimeout)
+
+        # the next request logs in again
+        self.manager.login()
+        self.assertEquals(len(self.agent.requests), 2)
+        self.agent.requests[1][4].callback(sessionResponse())
+        self.assertEquals(self.manager.getCookie(), 'AuthSession=abc')
+        return d2
+
+    def test_renewAfterRejection(self):
+        self.manager.login()
+        self.agent.requests[0][4].callback(sessionResponse())
+        self.manager.renew('AuthSession=abc')
+        self.manager.renew('AuthSession=abc')
+        self.assertEquals(len(self.agent.requests), 2)
+        self.agent.requests[1][4].callback(sessionResponse('def'))
+
+        # rejected with the old cookie, but renewed since
+        results = []
+        self.manager.renew('AuthSession=abc').addCallback(results.append)
+        self.assertEquals(len(self.agent.requests), 2)
+        self.assertEquals(len(results), 1)
+
+    def test_shared(self):
+        first = client.CouchDB("localhost", username="user", password="x")
+        second = client.CouchDB("localhost", username="user", password="x")
+        other = client.CouchDB("localhost", username="other", password="x")
+        self.assertIdentical(session.getSessionManager(first),
+            session.getSessionManager(second))
+        self.assertNotIdentical(session.getSessionManager(first),
+            session.getSessionManager(other))
+
+
+class ClientSessionTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.agent = FakeAgent()
+        self.manager = session.SessionManager(self.agent,
+            b'http://localhost:5984', 'user', 'secret', clock=self.clock)
+        self.client = client.CouchDB("localhost", username="user",
+            password="secret", sessionManager=self.manager)
+        self.client.client = self.agent
+
+    def _login(self):
+        self.manager.login()
+        self.agent.requests.pop()[4].callback(sessionResponse())
+
+    def test_loginFirst(self):
+        d1 = self.client.get("/mydb/a")
+        d2 = self.client.get("/mydb/b")
+        self.assertEquals(len(self.agent.requests), 1)
+        self.agent.requests[0][4].callback(sessionResponse())
+
+        self.assertEquals([r[1] for r in self.agent.requests[1:]],
+            [b"http://localhost:5984/mydb/a", b"http://localhost:5984/mydb/b"])
+        headers = self.agent.requests[1][2]
+        self.assertEquals(headers.getRawHeaders('Cookie'), ['AuthSession=abc'])
+        # the password is never sent with requests
+        self.assertEquals(headers.getRawHeaders('Authorization'), None)
+        for request in self.agent.requests[1:]:
+            request[4].callback(FakeResponse(body=b'{}'))
+        return d1.addCallback(lambda _: d2)
+
+    def test_rejected(self):
+        self._login()
+        d1 = self.client.get("/mydb/a")
+        d2 = self.client.get("/mydb/b")
+        for request in self.agent.requests[:]:
+            request[4].callback(FakeResponse(401, body=b'{}'))
+        # both wait for one login
+        self.assertEquals(len(self.agent.requests), 3)
+        self.assertEquals(self.agent.requests[2][1],
+            b"http://localhost:5984/_session")
+        self.agent.requests[2][4].callback(sessionResponse('def'))
+
+        for request in self.agent.requests[3:]:
+            self.assertEquals(request[2].getRawHeaders('Cookie'),
+                ['AuthSession=def'])
+            request[4].callback(FakeResponse(body=b'{}'))
+        self.assertEquals(len(self.agent.requests), 5)
+        return d1.addCallback(lambda _: d2)
+
+    def test_notAllowed(self):
+        self._login()
+        d = self.client.get("/mydb/a")
+        self.agent.requests[0][4].callback(FakeResponse(401, body=b'{}'))
+        self.agent.requests[1][4].callback(sessionResponse())
+        # rejected again with a new session: not allowed after all
+        self.agent.requests[2][4].callback(FakeResponse(401, body=b'{}'))
+        self.assertEquals(len(self.agent.requests), 3)
+        return self.assertFailure(d, tw_error.Error)
+
+    def test_streamedNotReplayed(self):
+        self._login()
+        d = self.client.putAttachment("mydb", "a", "file", io.BytesIO(b'x'))
+        self.agent.requests[0][4].callback(FakeResponse(401, body=b'{}'))
+        self.agent.requests[1][4].callback(sessionResponse('def'))
+        # the file has been read already, so it is not sent again
+        self.assertEquals(len(self.agent.requests), 2)
+        return self.assertFailure(d, tw_error.Error)
+
+    def test_loginRefused(self):
+        d = self.client.get("/mydb/a")
+        self.agent.requests[0][4].callback(FakeResponse(401, body=b'{}'))
+        self.assertEquals(len(self.agent.requests), 1)
+        return self.assertFailure(d, client.AuthenticationError)
+
+    def test_getSession(self):
+        d = self.client.getSession()
+        self.agent.requests[0][4].callback(sessionResponse())
+        d.addCallback(lambda _: self.assertEquals(
+            self.client.getSessionRoles(), ['r']))
+        return d
+
+    def test_warmup(self):
+        d = self.client.warmup(connections=2)
+        self.assertEquals(len(self.agent.requests), 1)
+        self.agent.requests[0][4].callback(sessionResponse())
+
+        # logged in before opening the connections
+        self.assertEquals([r[0] for r in self.agent.requests[1:]],
+            [b'GET', b'HEAD'])
+        self.agent.requests[1][4].callback(FakeResponse(
+            body=b'{"version": "1.6.1"}'))
+        self.agent.requests[2][4].callback(FakeResponse())
+        d.addCallback(self.assertEquals, (1, 6, 1))
+        return d
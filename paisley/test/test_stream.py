@@ -0,0 +1,280 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_stream -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Test for incremental receiving of responses.
+"""
+
+import io
+import json
+
+from twisted.internet import defer
+from twisted.internet.interfaces import IConsumer
+from twisted.trial.unittest import TestCase
+from twisted.web._newclient import ResponseDone
+from twisted.web.http_headers import Headers
+from twisted.python.failure import Failure
+
+from zope.interface import implementer
+
+from paisley import stream
+
+
+RESPONSE = {
+    'total_rows': 3,
+    'update_seq': 7,
+    'offset': 0,
+    'rows': [
+        {'id': 'a"]}', 'key': [1, 'x\\'], 'value': {'s': u'“{['}},
+        {'id': 'b', 'key': None, 'value': 1.5e3},
+        {'id': 'c', 'key': True, 'value': []},
+    ],
+}
+
+
+class RowParserTestCase(TestCase):
+
+    def setUp(self):
+        self.rows = []
+        self.headers = []
+        self.parser = stream.RowParser(self.rows.append,
+            lambda h: self.headers.append(dict(h)))
+        self.data = json.dumps(RESPONSE, ensure_ascii=False).encode('utf-8')
+
+    def _feed(self, size):
+        for i in range(0, len(self.data), size):
+            self.parser.feed(self.data[i:i + size])
+        self.parser.finish()
+
+    def _check(self):
+        self.failUnless(self.parser.isDone())
+        self.assertEquals(self.rows, RESPONSE['rows'])
+        self.assertEquals(self.parser.rows, 3)
+        self.assertEquals(self.headers,
+            [{'total_rows': 3, 'update_seq': 7, 'offset': 0}])
+
+    def test_whole(self):
+        self._feed(len(self.data))
+        self._check()
+
+    def test_byteByByte(self):
+        # also splits multi-byte characters and numbers
+        self._feed(1)
+        self._check()
+
+    def test_rowsBeforeResponseEnds(self):
+        end = self.data.index(b'{"id": "b"')
+        self.parser.feed(self.data[:end])
+        self.assertEquals(self.rows, RESPONSE['rows'][:1])
+        self.assertEquals(self.parser.header['total_rows'], 3)
+
+    def test_trailingMembers(self):
+        self.data = b'{"rows": [{"id": "a"}], "last_seq": 5}'
+        self._feed(4)
+        self.assertEquals(self.rows, [{'id': 'a'}])
+        self.assertEquals(self.parser.header, {'last_seq': 5})
+
+    def test_bufferBounded(self):
+        self.parser.feed(self.data[:self.data.index(b'{"id": "c"') + 3])
+        self.failUnless(len(self.parser._buffer) < 16)
+
+    def test_notAnObject(self):
+        self.assertRaises(ValueError, self.parser.feed, b'["rows"]')
+
+    def test_truncated(self):
+        self.parser.feed(self.data[:-5])
+        self.assertRaises(ValueError, self.parser.finish)
+
+
+class RowReceiverTestCase(TestCase):
+
+    def test_receive(self):
+        rows = []
+        d = defer.Deferred()
+        receiver = stream.RowReceiver(d, rows.append)
+
+        receiver.dataReceived(b'{"total_rows": 1, "offset": 0, "rows": [')
+        receiver.dataReceived(b'{"id": "a", "key": 1, "value": null}]}')
+        receiver.connectionLost(Failure(ResponseDone()))
+
+        def cb(header):
+            self.assertEquals(header, {'total_rows': 1, 'offset': 0})
+            self.assertEquals(rows, [{'id': 'a', 'key': 1, 'value': None}])
+        d.addCallback(cb)
+        return d
+
+    def test_truncated(self):
+        d = defer.Deferred()
+        receiver = stream.RowReceiver(d, lambda row: None)
+
+        receiver.dataReceived(b'{"total_rows": 1, "offset": 0, "rows": [')
+        receiver.connectionLost(Failure(ResponseDone()))
+        return self.assertFailure(d, ValueError)
+
+
+class BodyReceiverTestCase(TestCase):
+
+    def test_receive(self):
+        consumer = io.BytesIO()
+        d = defer.Deferred()
+        receiver = stream.BodyReceiver(d, consumer)
+
+        receiver.dataReceived(b'abc')
+        receiver.dataReceived(b'def')
+        receiver.connectionLost(Failure(ResponseDone()))
+
+        def cb(written):
+            self.assertEquals(written, 6)
+            self.assertEquals(consumer.getvalue(), b'abcdef')
+        d.addCallback(cb)
+        return d
+
+    def test_connectionLost(self):
+        d = defer.Deferred()
+        receiver = stream.BodyReceiver(d, io.BytesIO())
+
+        receiver.dataReceived(b'abc')
+        receiver.connectionLost(Failure(RuntimeError()))
+        return self.assertFailure(d, RuntimeError)
+
+    def test_producerRegistered(self):
+        consumer = FakeConsumer()
+        d = defer.Deferred()
+        receiver = stream.BodyReceiver(d, consumer)
+        transport = FakeTransport()
+
+        receiver.makeConnection(transport)
+        self.assertIdentical(consumer.producer, transport)
+        self.assertEquals(consumer.streaming, True)
+        receiver.dataReceived(b'abc')
+        receiver.connectionLost(Failure(ResponseDone()))
+        self.assertIdentical(consumer.producer, None)
+        self.assertEquals(consumer.data, [b'abc'])
+        return d
+
+    def test_range(self):
+        consumer = io.BytesIO()
+        d = defer.Deferred()
+        receiver = stream.BodyReceiver(d, consumer, contentRange=(10, 14))
+
+        receiver.checkResponse(FakeResponse(206, 'bytes 10-14/100'))
+        receiver.dataReceived(b'abcde')
+        receiver.connectionLost(Failure(ResponseDone()))
+        d.addCallback(self.assertEquals, 5)
+        return d
+
+    def test_rangeAtEnd(self):
+        d = defer.Deferred()
+        receiver = stream.BodyReceiver(d, io.BytesIO(),
+            contentRange=(10, None))
+
+        receiver.checkResponse(FakeResponse(206, 'bytes 10-99/100'))
+        receiver.connectionLost(Failure(ResponseDone()))
+        return d
+
+    def test_rangeIgnored(self):
+        consumer = io.BytesIO()
+        d = defer.Deferred()
+        receiver = stream.BodyReceiver(d, consumer, contentRange=(10, 14))
+        transport = FakeTransport()
+
+        # the whole body instead of the part
+        receiver.checkResponse(FakeResponse(200))
+        receiver.makeConnection(transport)
+        receiver.dataReceived(b'x' * 100)
+        self.failUnless(transport.stopped)
+        self.assertEquals(consumer.getvalue(), b'')
+        return self.assertFailure(d, stream.RangeMismatch)
+
+    def test_otherRange(self):
+        d = defer.Deferred()
+        receiver = stream.BodyReceiver(d, io.BytesIO(), contentRange=(10, 14))
+
+        receiver.checkResponse(FakeResponse(206, 'bytes 0-14/100'))
+        receiver.dataReceived(b'x' * 15)
+        return self.assertFailure(d, stream.RangeMismatch)
+
+
+class FakeResponse(object):
+
+    def __init__(self, code, contentRange=None):
+        self.code = code
+        self.headers = Headers()
+        if contentRange is not None:
+            self.headers.setRawHeaders('Content-Range', [contentRange])
+
+
+@implementer(IConsumer)
+class FakeConsumer(object):
+
+    def __init__(self):
+        self.producer = None
+        self.streaming = None
+        self.data = []
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.streaming = streaming
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.data.append(data)
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.paused = False
+        self.stopped = False
+        self.disconnecting = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+class RowReceiverBackpressureTestCase(TestCase):
+
+    def setUp(self):
+        self.handled = []
+        self.d = defer.Deferred()
+        self.receiver = stream.RowReceiver(self.d, self._row)
+        self.receiver.transport = FakeTransport()
+
+    def _row(self, row):
+        d = defer.Deferred()
+        self.handled.append(d)
+        return d
+
+    def test_paused(self):
+        self.receiver.dataReceived(b'{"rows": [{"id": "a"}, {"id": "b"},')
+        self.failUnless(self.receiver.transport.paused)
+        self.handled[0].callback(None)
+        self.failUnless(self.receiver.transport.paused)
+        self.handled[1].callback(None)
+        self.failIf(self.receiver.transport.paused)
+
+    def test_firesWhenHandled(self):
+        results = []
+        self.d.addCallback(results.append)
+        self.receiver.dataReceived(b'{"rows": [{"id": "a"}], "x": 1}')
+        self.receiver.connectionLost(Failure(ResponseDone()))
+        self.assertEquals(results, [])
+        self.handled[0].callback(None)
+        self.assertEquals(results, [{'x': 1}])
+
+    def test_handlingFailed(self):
+        self.receiver.dataReceived(b'{"rows": [{"id": "a"},')
+        self.handled[0].errback(RuntimeError())
+        self.failUnless(self.receiver.transport.stopped)
+        return self.assertFailure(self.d, RuntimeError)
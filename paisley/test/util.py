@@ -430,4 +430,4 @@ class CouchDBTestCase(unittest.TestCase):
 
 
 def eight_bit_test_string():
-    return ''.join(chr(cn) for cn in xrange(0x100)) * 2
+    return bytes(bytearray(range(0x100))) * 2
@@ -33,7 +33,7 @@ class View(object):
             if options.get('include_docs', False) is True:
                 obj.fromDict(x['doc'])
                 # FIXME: why does this not arrive as unicode ?
-                self._couch.mapped(unicode(x['id']), obj)
+                self._couch.mapped(unicode(x['id']), obj, self._dbName)
             else:
                 # if we don't have the doc, don't cache
                 obj.fromDict(x)
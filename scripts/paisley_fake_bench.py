@@ -0,0 +1,81 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Benchmark client throughput and memory against the in-memory CouchDB.
+
+Saves DOCS documents in bulk, then reads them back with concurrent
+openDoc calls and with one streamed view, and reports requests per second
+and the peak resident memory of the process.  The fake server runs in the
+same process, so its share is included.
+
+Usage: paisley_fake_bench.py [docs] [latency in seconds] [bytes/second]
+
+Does not need a running CouchDB.
+"""
+
+import resource
+import sys
+import time
+
+from twisted.internet import defer, task
+
+from paisley.test.fakecouch import FakeCouchDBServer
+
+DOCS = 2000
+CONCURRENCY = 8
+
+
+def report(name, count, seconds):
+    sys.stdout.write('  %-24s %8d in %6.2f s: %8.1f /s\n' % (
+        name, count, seconds, count / seconds))
+
+
+@defer.inlineCallbacks
+def bench(reactor, docs, latency, throughput):
+    server = FakeCouchDBServer(latency=latency, throughput=throughput)
+    couch = server.start(maxPersistentPerHost=CONCURRENCY,
+        maxInFlight=CONCURRENCY)
+    server.resource.addView('bench', 'd', 'byValue',
+        lambda doc: [(doc['value'], None)])
+    yield couch.createDB('bench')
+
+    sys.stdout.write('%d docs, latency %ss, throughput %s bytes/s:\n' % (
+        docs, latency, throughput or 'unlimited'))
+
+    start = time.time()
+    yield couch.saveDocs('bench', [{'_id': 'doc%06d' % i, 'value': i,
+        'body': 'x' * 200} for i in range(docs)])
+    report('saveDocs (documents)', docs, time.time() - start)
+
+    start = time.time()
+    semaphore = defer.DeferredSemaphore(CONCURRENCY)
+    yield defer.gatherResults([semaphore.run(couch.openDoc, 'bench',
+        'doc%06d' % i) for i in range(docs)])
+    report('openDoc', docs, time.time() - start)
+
+    rows = []
+    start = time.time()
+    yield couch.openView('bench', 'd', 'byValue', include_docs=True,
+        rowCallback=lambda row: rows.append(row['id']))
+    report('streamed view (rows)', len(rows), time.time() - start)
+
+    sys.stdout.write('  requests served: %d, bytes sent: %d\n' % (
+        server.resource.requests, server.resource.bytesSent))
+    sys.stdout.write('  peak memory: %d kB\n' % (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, ))
+    yield server.stop()
+
+
+def main(reactor, *argv):
+    docs = int(argv[0]) if argv else DOCS
+    latency = float(argv[1]) if len(argv) > 1 else 0
+    throughput = int(argv[2]) if len(argv) > 2 else None
+    return bench(reactor, docs, latency, throughput)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,104 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Benchmark preparing requests.
+
+Compares the previous preparation of a request, which built the headers,
+the Authorization header and the url anew for every request, with the
+headers and url prefix prepared once per client.  Also reports the cost
+per call of a complete get against an agent that answers at once, to put
+the preparation in perspective.
+
+Does not need a running CouchDB.
+"""
+
+import sys
+import time
+
+from base64 import b64encode
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web.http_headers import Headers
+from twisted.web._newclient import ResponseDone
+
+from paisley import client
+
+CALLS = 100000
+RUN_TIMES = 5
+
+
+class Response(object):
+    code = 200
+    length = 2
+    headers = Headers({'Content-Type': ['application/json']})
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(b'{}')
+        protocol.connectionLost(Failure(ResponseDone()))
+
+
+class Agent(object):
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        return defer.succeed(Response())
+
+
+def rebuilt(couch, uri):
+    # the preparation as it was: everything anew for every request
+    headers = {}
+    headers["Accept"] = ["application/json"]
+    headers["Content-Type"] = ["application/json"]
+    headers["User-Agent"] = ["paisley"]
+    if couch.username:
+        headers["Authorization"] = ["Basic %s" % b64encode((
+            "%s:%s" % (couch.username, couch.password)).encode('utf-8'))]
+    url = (couch.url_template % (uri, )).encode('utf-8')
+    return url, Headers(headers)
+
+
+def prepared(couch, uri):
+    headers = couch._prepareHeaders(None, True)
+    prefix, route = couch._route(True)
+    return prefix + uri.encode('utf-8'), headers.raw
+
+
+def bench(name, f, *args):
+    times = []
+    for x in range(RUN_TIMES):
+        startTime = time.time()
+        for i in range(CALLS):
+            f(*args)
+        times.append(time.time() - startTime)
+
+    best = min(times) / CALLS * 1000000
+    sys.stdout.write('  %-28s min: %6.2f us/call avg: %6.2f us/call\n' % (
+        name, best, sum(times) / len(times) / CALLS * 1000000))
+    return best
+
+
+def run():
+    # Basic authentication, as the rebuilt headers do
+    couch = client.CouchDB('localhost', username='user', password='secret',
+        cookieAuth=False)
+    couch.client = Agent()
+    uri = '/mydb/mydoc'
+
+    sys.stdout.write('preparing a request, %d calls:\n' % (CALLS, ))
+    before = bench('rebuilt per request', rebuilt, couch, uri)
+    after = bench('prepared per client', prepared, couch, uri)
+    sys.stdout.write('  saved: %.0f%%\n' % (
+        100.0 * (before - after) / before, ))
+
+    sys.stdout.write('complete get, %d calls:\n' % (CALLS, ))
+    bench('get', couch.get, uri)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        CALLS = int(sys.argv[1])
+    run()
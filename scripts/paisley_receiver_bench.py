@@ -0,0 +1,118 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2014
+# See LICENSE for details.
+
+"""
+Benchmark receiving and parsing a large JSON response.
+
+Compares the previous receive path, which decoded every chunk to text
+before joining and parsing it, with paisley.client.ResponseReceiver,
+which keeps bytes and hands them to the JSON decoder as they are.
+Reports time and peak memory used on top of the received chunks, for
+receiving alone and for receiving and parsing.
+
+Does not need a running CouchDB.
+"""
+
+import sys
+import time
+import tracemalloc
+
+from encodings import utf_8
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web._newclient import ResponseDone
+
+from paisley import client, pjson as json
+
+CHUNK_SIZE = 64 * 1024
+RUN_TIMES = 5
+
+
+def makeResponse(rows):
+    return json.dumps({
+        'total_rows': rows,
+        'offset': 0,
+        'rows': [{
+            'id': u'doc%08d' % i,
+            'key': [u'caf\xe9', i],
+            'value': {u'name': u'n\xe4me %d' % i, u'tags': [u'a', u'b']},
+        } for i in range(rows)],
+    }, ensure_ascii=False).encode('utf-8')
+
+
+def chunks(body):
+    return [body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE)]
+
+
+def decodingReceive(received, parse=True):
+    # the receive path as it was: decode every chunk, join text, parse
+    decoder = utf_8.IncrementalDecoder()
+    recv_chunks = []
+    for chunk in received:
+        recv_chunks.append(decoder.decode(chunk))
+    recv_chunks.append(decoder.decode(b'', True))
+    body = u''.join(recv_chunks)
+    if parse:
+        return json.loads(body)
+    return body
+
+
+def bytesReceive(received, parse=True):
+    result = []
+    d = defer.Deferred()
+    if parse:
+        d.addCallback(json.loads)
+    d.addCallback(result.append)
+    receiver = client.ResponseReceiver(d, decode_utf8=False)
+    for chunk in received:
+        receiver.dataReceived(chunk)
+    receiver.connectionLost(Failure(ResponseDone()))
+    return result[0]
+
+
+def bench(name, f, *args):
+    times = []
+    for x in range(RUN_TIMES):
+        startTime = time.time()
+        f(*args)
+        times.append(time.time() - startTime)
+
+    # memory allocated on top of the received chunks
+    tracemalloc.start()
+    f(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    sys.stdout.write('  %-36s min: %.3fs avg: %.3fs peak: %6.1f MB\n' % (
+        name, min(times), sum(times) / len(times), peak / 1024.0 / 1024.0))
+    return min(times), peak
+
+
+def run(rows):
+    body = makeResponse(rows)
+    received = chunks(body)
+    sys.stdout.write('%d rows, %d bytes in %d chunks\n' % (
+        rows, len(body), len(received)))
+
+    assert decodingReceive(received) == bytesReceive(received)
+
+    for parse in (False, True):
+        sys.stdout.write(parse and 'receive and parse:\n' or 'receive:\n')
+        before = bench('decode per chunk, join text',
+            decodingReceive, received, parse)
+        after = bench('bytes, join chunks',
+            bytesReceive, received, parse)
+        sys.stdout.write('  saved: %.0f%% time, %.0f%% peak memory\n' % (
+            100.0 * (before[0] - after[0]) / before[0],
+            100.0 * (before[1] - after[1]) / before[1]))
+
+
+if __name__ == '__main__':
+    rows = 200000
+    if len(sys.argv) > 1:
+        rows = int(sys.argv[1])
+    run(rows)